@@ -0,0 +1,242 @@
+import collections
+import csv
+import glob
+import itertools
+import logging
+import os
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+from external_sort import TIME_COLUMNS
+
+# Tables written next to each panelist's consolidated app_accessibility_data
+ACCESSIBILITY_NODES_FILE = "app_accessibility_nodes.csv"
+ACCESSIBILITY_SCREENS_FILE = "app_accessibility_screens.csv"
+
+# Columns of the accessibility event copied onto its node and screen rows
+EVENT_COLUMNS = ["id_user", TIME_COLUMNS["app_accessibility_data"], "apk", "id_session", "id_interval", "type"]
+
+# One row per view node of an XML payload, in document order
+NODE_COLUMNS = EVENT_COLUMNS + ["node_index", "depth", "class", "text", "content_description", "bounds"]
+
+# One row per accessibility event: the visible text of the screen, and how many nodes it has (0 for plain text)
+SCREEN_COLUMNS = EVENT_COLUMNS + ["node_count", "visible_text", "xml_error"]
+
+# Attribute names of the node fields, as written by uiautomator dumps and by AccessibilityNodeInfo serializers
+CLASS_ATTRIBUTES = ("class", "className", "ClassName")
+TEXT_ATTRIBUTES = ("text", "Text")
+CONTENT_DESCRIPTION_ATTRIBUTES = ("content-desc", "contentDescription", "ContentDescription")
+BOUNDS_ATTRIBUTES = ("bounds", "boundsInScreen", "BoundsInScreen")
+
+# Characters of a payload fed to the XML parser at a time
+XML_FEED_SIZE = 64 * 1024
+
+# Events flattened per work item; XML payloads can be large, so chunks are far smaller than for sentiment scoring
+ACCESSIBILITY_CHUNK_ROWS = 2_000
+
+# Chunks flattened ahead of the one being written, per worker
+ACCESSIBILITY_CHUNKS_PER_WORKER = 2
+
+
+def first_attribute(attributes, names):
+    """
+    Returns the first of the given attributes that an element has, or an empty string.
+    """
+    for name in names:
+        if name in attributes:
+            return attributes[name]
+    return ""
+
+
+def flatten_payload(payload):
+    """
+    Flattens one serialized view hierarchy into node rows, with an incremental parser.
+
+    The payload is fed to xml.etree.ElementTree.XMLPullParser in XML_FEED_SIZE pieces and every element is dropped
+    from the tree once it has been read, so memory does not grow with the size of the hierarchy. Nodes parsed
+    before a syntax error, including elements it left open, are kept.
+
+    Args:
+        payload (str): The XML text.
+    Returns:
+        tuple: (list of [node_index, depth, class, text, content_description, bounds] in document order, visible
+        text of the screen, error message or an empty string)
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    nodes = []
+    stack = []
+    error = ""
+
+    def add_node(node_index, element):
+        attributes = element.attrib
+        text = first_attribute(attributes, TEXT_ATTRIBUTES) or (element.text or "").strip()
+        visible = attributes.get("visible-to-user", "true") != "false"
+        nodes.append(([node_index, len(stack), first_attribute(attributes, CLASS_ATTRIBUTES) or element.tag, text,
+                       first_attribute(attributes, CONTENT_DESCRIPTION_ATTRIBUTES),
+                       first_attribute(attributes, BOUNDS_ATTRIBUTES)], visible))
+
+    def read_events():
+        for event, element in parser.read_events():
+            if event == "start":
+                stack.append((len(nodes) + len(stack), element))
+                continue
+            add_node(*stack.pop())
+            if stack:
+                # The element that just ended is the last child of its parent
+                del stack[-1][1][-1]
+
+    try:
+        for start in range(0, len(payload), XML_FEED_SIZE):
+            parser.feed(payload[start:start + XML_FEED_SIZE])
+            read_events()
+        parser.close()
+        read_events()
+    except ET.ParseError as e:
+        error = str(e)
+        # Elements left open by the error still have their attributes
+        while stack:
+            add_node(*stack.pop())
+
+    # Elements end after their children, so they are put back in document order
+    nodes.sort(key=lambda node: node[0][0])
+    visible_text = []
+    for node, visible in nodes:
+        line = node[3] or node[4]
+        if visible and line and (not visible_text or visible_text[-1] != line):
+            visible_text.append(line)
+    return [node for node, _ in nodes], "\n".join(visible_text), error
+
+
+def is_xml_payload(text):
+    """
+    Returns whether an accessibility text value is a serialized view hierarchy rather than plain text.
+    """
+    return text.lstrip().startswith("<")
+
+
+def flatten_chunk(rows, event_positions, text_position):
+    """
+    Flattens a chunk of accessibility events, inside a worker process.
+
+    Args:
+        rows (list): CSV rows of app_accessibility_data.
+        event_positions (list): Position of each of EVENT_COLUMNS in the rows, None for columns the file lacks.
+        text_position (int): Position of the text column.
+    Returns:
+        tuple: (node rows, screen rows, number of payloads that are not well-formed XML)
+    """
+    node_rows, screen_rows, malformed = [], [], 0
+    for row in rows:
+        event = [row[position] if position is not None and position < len(row) else ""
+                 for position in event_positions]
+        text = row[text_position] if text_position < len(row) else ""
+        if not is_xml_payload(text):
+            screen_rows.append(event + [0, text, ""])
+            continue
+
+        nodes, visible_text, error = flatten_payload(text)
+        malformed += bool(error)
+        node_rows.extend(event + node for node in nodes)
+        screen_rows.append(event + [len(nodes), visible_text, error])
+    return node_rows, screen_rows, malformed
+
+
+def flatten_csv_file(csv_path, pool, max_pending, chunk_rows=ACCESSIBILITY_CHUNK_ROWS):
+    """
+    Writes the node and screen tables of one consolidated app_accessibility_data file, next to it.
+
+    The file is streamed in chunks of chunk_rows events, which are flattened in parallel and written in order, so
+    memory is bounded by the chunks in flight.
+
+    Args:
+        csv_path (str): Path of the consolidated file.
+        pool (ProcessPoolExecutor): Worker processes.
+        max_pending (int): Chunks flattened ahead of the one being written.
+        chunk_rows (int): Events per chunk.
+    Returns:
+        tuple: (screens written, nodes written, malformed payloads). Nothing is written if the file has no text
+        column.
+    """
+    folder = os.path.dirname(csv_path)
+    nodes_path = os.path.join(folder, ACCESSIBILITY_NODES_FILE)
+    screens_path = os.path.join(folder, ACCESSIBILITY_SCREENS_FILE)
+    screens = nodes = malformed = 0
+    pending = collections.deque()
+
+    with open(csv_path, newline="", encoding="utf-8", errors="replace") as csv_file:
+        reader = csv.reader(csv_file)
+        header = [column.lstrip("\ufeff") for column in next(reader, [])]
+        if "text" not in header:
+            return 0, 0, 0
+        event_positions = [header.index(column) if column in header else None for column in EVENT_COLUMNS]
+        text_position = header.index("text")
+
+        with open(nodes_path + ".tmp", "w", newline="", encoding="utf-8") as nodes_file, \
+                open(screens_path + ".tmp", "w", newline="", encoding="utf-8") as screens_file:
+            node_writer = csv.writer(nodes_file, lineterminator="\n")
+            screen_writer = csv.writer(screens_file, lineterminator="\n")
+            node_writer.writerow(NODE_COLUMNS)
+            screen_writer.writerow(SCREEN_COLUMNS)
+
+            def write_next():
+                nonlocal screens, nodes, malformed
+                node_rows, screen_rows, chunk_malformed = pending.popleft().result()
+                node_writer.writerows(node_rows)
+                screen_writer.writerows(screen_rows)
+                screens += len(screen_rows)
+                nodes += len(node_rows)
+                malformed += chunk_malformed
+
+            while True:
+                rows = list(itertools.islice(reader, chunk_rows))
+                if not rows:
+                    break
+                pending.append(pool.submit(flatten_chunk, rows, event_positions, text_position))
+                if len(pending) >= max_pending:
+                    write_next()
+            while pending:
+                write_next()
+
+    os.replace(nodes_path + ".tmp", nodes_path)
+    os.replace(screens_path + ".tmp", screens_path)
+    return screens, nodes, malformed
+
+
+def needs_flattening(csv_path):
+    """
+    Returns whether the tables of a consolidated app_accessibility_data file are missing or older than it.
+    """
+    folder = os.path.dirname(csv_path)
+    outputs = [os.path.join(folder, name) for name in (ACCESSIBILITY_NODES_FILE, ACCESSIBILITY_SCREENS_FILE)]
+    if not all(os.path.exists(path) for path in outputs):
+        return True
+    return os.path.getmtime(csv_path) > min(os.path.getmtime(path) for path in outputs)
+
+
+def flatten_accessibility_data(query_id, num_workers=1):
+    """
+    Writes the node and screen tables of every panelist whose consolidated app_accessibility_data changed since
+    they were written, see flatten_csv_file.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+        num_workers (int): Number of worker processes.
+    Returns:
+        tuple: (screens written, nodes written)
+    """
+    pattern = os.path.join(query_id, "combined", "panelists", "*", "metadata",
+                           "app_accessibility_data-consolidated.csv")
+    total_screens = total_nodes = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for combined_csv in sorted(glob.glob(pattern)):
+            if not needs_flattening(combined_csv):
+                continue
+            screens, nodes, malformed = flatten_csv_file(combined_csv, pool,
+                                                         num_workers * ACCESSIBILITY_CHUNKS_PER_WORKER)
+            logging.info(f"Flattened {screens} accessibility events into {nodes} nodes for {combined_csv}.")
+            if malformed:
+                logging.warning(f"{malformed} accessibility payloads of {combined_csv} are not well-formed XML, "
+                                f"their nodes up to the error were kept.")
+            total_screens += screens
+            total_nodes += nodes
+    return total_screens, total_nodes
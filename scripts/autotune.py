@@ -0,0 +1,153 @@
+import logging
+import math
+import os
+
+# Bytes of zips downloaded between two tuning decisions when no --disk-budget-gb is given
+AUTOTUNE_BATCH_BYTES = 2 * 1024 ** 3
+
+# Factor in-flight downloads are raised by while throughput keeps improving
+AUTOTUNE_DOWNLOAD_GROWTH = 2
+
+# Throughput gain that justifies the last raise; below it the previous setting is restored
+AUTOTUNE_MIN_GAIN = 0.1
+
+# Batches a restored setting is kept before trying a higher one again, since panels differ over a run
+AUTOTUNE_HOLD_BATCHES = 3
+
+# Share of the machine's CPU time extraction may use before more workers would only contend for cores
+AUTOTUNE_TARGET_CPU = 0.85
+
+# Share of each worker's time spent on the CPU below which it is waiting on I/O, and more workers would not help
+AUTOTUNE_BUSY_WORKER = 0.5
+
+# Share of physical memory kept free when sizing the extraction pool
+AUTOTUNE_MEMORY_RESERVE = 0.15
+
+
+def new_autotune_state(max_downloads, max_workers):
+    """
+    Creates the state of the tuner, starting low and raising the settings while the measurements allow it.
+
+    Args:
+        max_downloads (int): Cap on downloads in flight, e.g. from --concurrency.
+        max_workers (int): Cap on extraction worker processes, e.g. from --redaction-workers.
+    Returns:
+        dict: The settings in use ("downloads", "workers"), their caps, and what the tuner learned so far.
+    """
+    return {
+        "downloads": max(1, max_downloads // 8),
+        "workers": max(1, max_workers // 2),
+        "max_downloads": max_downloads,
+        "max_workers": max_workers,
+        # Download setting and throughput before the last raise, and batches left before probing again
+        "previous": None,
+        "hold": 0,
+        "history": [],
+    }
+
+
+def memory_bytes():
+    """
+    Returns the total and the available physical memory, from /proc/meminfo on Linux and sysconf elsewhere.
+
+    Returns:
+        tuple: (total bytes, available bytes), or (None, None) when the platform reports neither.
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            fields = dict(line.split(":", 1) for line in meminfo)
+        return (int(fields["MemTotal"].split()[0]) * 1024, int(fields["MemAvailable"].split()[0]) * 1024)
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        return os.sysconf("SC_PHYS_PAGES") * page_size, os.sysconf("SC_AVPHYS_PAGES") * page_size
+    except (AttributeError, ValueError, OSError):
+        return None, None
+
+
+def tune_downloads(state, throughput):
+    """
+    Adjusts the downloads in flight by hill climbing on the throughput of the last batch.
+
+    The setting is raised by AUTOTUNE_DOWNLOAD_GROWTH while each raise improves throughput by AUTOTUNE_MIN_GAIN.
+    A raise that does not is undone, and the setting is held for AUTOTUNE_HOLD_BATCHES batches.
+
+    Args:
+        state (dict): Tuner state, see new_autotune_state.
+        throughput (float): Bytes per second of the last batch's downloads.
+    """
+    previous = state["previous"]
+    if previous and throughput < previous["throughput"] * (1 + AUTOTUNE_MIN_GAIN):
+        state["downloads"] = previous["downloads"]
+        state["previous"] = None
+        state["hold"] = AUTOTUNE_HOLD_BATCHES
+        return
+
+    state["previous"] = None
+    if state["hold"]:
+        state["hold"] -= 1
+    elif state["downloads"] < state["max_downloads"]:
+        state["previous"] = {"downloads": state["downloads"], "throughput": throughput}
+        state["downloads"] = min(state["max_downloads"], state["downloads"] * AUTOTUNE_DOWNLOAD_GROWTH)
+
+
+def tune_workers(state, cpu_seconds, wall_seconds, worker_rss_bytes, cpu_count):
+    """
+    Adjusts the extraction workers to the CPU use of the last batch and the memory left.
+
+    Workers are added, by half of their number, while they are busy on the CPU and the machine is not saturated.
+    Whatever the CPU use, the pool is kept small enough for its workers' peak memory to fit in the memory
+    available, less AUTOTUNE_MEMORY_RESERVE of the total.
+
+    Args:
+        state (dict): Tuner state, see new_autotune_state.
+        cpu_seconds (float): CPU time of the pipeline and its workers during the batch's extraction.
+        wall_seconds (float): Wall time of the batch's extraction.
+        worker_rss_bytes (float): Peak resident memory of any one process so far.
+        cpu_count (int): Number of CPUs of the machine.
+    Returns:
+        dict: The measurements the decision was based on.
+    """
+    workers = state["workers"]
+    machine_cpu = cpu_seconds / (wall_seconds * cpu_count) if wall_seconds else 0.0
+    worker_cpu = cpu_seconds / (wall_seconds * workers) if wall_seconds else 0.0
+    if machine_cpu < AUTOTUNE_TARGET_CPU and worker_cpu >= AUTOTUNE_BUSY_WORKER:
+        workers = min(state["max_workers"], workers + max(1, workers // 2))
+
+    total, available = memory_bytes()
+    if total and worker_rss_bytes:
+        # The pool is shut down between batches, so available memory does not include its workers
+        spare = available - total * AUTOTUNE_MEMORY_RESERVE
+        workers = min(workers, max(1, math.floor(spare / worker_rss_bytes)))
+
+    state["workers"] = workers
+    return {"machine_cpu": machine_cpu, "worker_cpu": worker_cpu,
+            "available_mb": available / 1024 ** 2 if available else None}
+
+
+def record_batch(state, download_bytes, download_seconds, cpu_seconds, extract_seconds, worker_rss_bytes,
+                 cpu_count):
+    """
+    Retunes the settings after a batch of zips was downloaded and extracted, and logs the settings chosen.
+
+    Args:
+        state (dict): Tuner state, see new_autotune_state.
+        download_bytes (int): Bytes of zips downloaded in the batch.
+        download_seconds (float): Wall time of the batch's downloads.
+        cpu_seconds (float): CPU time of the batch's extraction, see tune_workers.
+        extract_seconds (float): Wall time of the batch's extraction.
+        worker_rss_bytes (float): Peak resident memory of any one process so far.
+        cpu_count (int): Number of CPUs of the machine.
+    """
+    used = {"downloads": state["downloads"], "workers": state["workers"]}
+    throughput = download_bytes / download_seconds if download_seconds else 0.0
+    tune_downloads(state, throughput)
+    measured = tune_workers(state, cpu_seconds, extract_seconds, worker_rss_bytes, cpu_count)
+
+    state["history"].append({**used, "download_mb_per_second": throughput / 1024 ** 2, **measured,
+                             "next_downloads": state["downloads"], "next_workers": state["workers"]})
+    available = f", {measured['available_mb']:.0f} MB available" if measured["available_mb"] is not None else ""
+    logging.info(f"Autotune: batch ran {used['downloads']} downloads at {throughput / 1024 ** 2:.1f} MB/s and "
+                 f"{used['workers']} extraction workers at {measured['machine_cpu']:.0%} of the CPUs{available}; "
+                 f"next batch uses {state['downloads']} downloads and {state['workers']} workers.")
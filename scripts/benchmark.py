@@ -0,0 +1,450 @@
+import argparse
+import glob
+import hashlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import zipfile
+from datetime import datetime, timedelta, timezone
+
+import boto3
+import cv2
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Photo with two faces that ships with the app, pasted into the synthetic screenshots that should contain faces
+SAMPLE_FACE_IMAGE = os.path.join(SCRIPT_DIR, "..", "app", "src", "main", "assets", "img.png")
+
+# Where benchmark results are stored, one file per run. Ignored by git, keep results worth sharing elsewhere
+RESULTS_FOLDER = os.path.join(SCRIPT_DIR, "benchmark_results")
+
+# Bucket created on the local S3 stand-in
+BENCHMARK_BUCKET = "screenlake-zip-bench"
+
+# Synthetic panel per data size: panelists, zips per panelist, screenshots per zip and accessibility rows per zip
+BENCHMARK_SIZES = {
+    "small": {"panelists": 4, "zips": 3, "images": 5, "rows": 50},
+    "medium": {"panelists": 16, "zips": 10, "images": 10, "rows": 200},
+    "large": {"panelists": 64, "zips": 20, "images": 20, "rows": 500},
+}
+
+# Resolution of the synthetic screenshots, a common phone screen at half size
+SCREENSHOT_SIZE = (540, 1200)
+
+# Apps the synthetic panelists switch between
+APPS = ["com.android.chrome", "com.instagram.android", "com.whatsapp", "com.zhiliaoapp.musically", "com.screenlake"]
+
+# Words of the synthetic OCR and accessibility text
+WORDS = ("happy sad news video friends home search message photo like share follow comment watch play "
+         "open close settings account login create new post story reel chat call").split()
+
+
+def generate_panel(s3, bucket_name, panel_name="bench_panel", tenants=1, panels=1, panelists=4, zips=3, images=5,
+                   rows=50, face_ratio=0.3, seed=0):
+    """
+    Uploads synthetic panels in the layout the app uploads to, `academia/tenant/<tenantId>_<tenantName>/panel/
+    <panelId>/<buildVersion>/panelist/<emailHash>/image_zip_<uuid>_<n>.zip`.
+
+    Args:
+        s3: boto3 S3 client.
+        bucket_name (str): Bucket to upload to, created if needed.
+        panel_name (str): Prefix of the panel IDs.
+        tenants (int): Number of tenants.
+        panels (int): Number of panels per tenant.
+        panelists (int): Number of panelists per panel.
+        zips (int): Number of zips per panelist.
+        images (int): Number of screenshots per zip.
+        rows (int): Number of accessibility rows per zip.
+        face_ratio (float): Share of screenshots showing faces.
+        seed (int): Seed of the random generator, the same seed gives the same panel.
+    Returns:
+        list: Paths of the generated panels, as selected by get_bucket_and_path.
+    """
+    rng = random.Random(seed)
+    face_image = cv2.imread(SAMPLE_FACE_IMAGE)
+    if face_image is None:
+        print(f"{SAMPLE_FACE_IMAGE} not found, the screenshots will not contain faces.")
+
+    try:
+        s3.create_bucket(Bucket=bucket_name)
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    panel_paths = []
+    for tenant in range(tenants):
+        for panel in range(panels):
+            path = f"academia/tenant/{tenant + 1}_BenchTenant{tenant + 1}/panel/{panel_name}_{panel + 1}/V_1/"
+            panel_paths.append(path)
+            for panelist in range(panelists):
+                email_hash = hashlib.sha256(f"panelist{tenant}-{panel}-{panelist}@example.org".encode()).hexdigest()
+                start = datetime(2024, 3, 1, tzinfo=timezone.utc) + timedelta(hours=rng.randrange(24 * 28))
+                for number in range(zips):
+                    zip_start = start + timedelta(minutes=10 * number)
+                    data = build_zip(rng, panelist, zip_start, images, rows, face_ratio, face_image)
+                    key = f"{path}panelist/{email_hash}/image_zip_{uuid.UUID(int=rng.getrandbits(128))}_{number}.zip"
+                    s3.put_object(Bucket=bucket_name, Key=key, Body=data)
+    return panel_paths
+
+
+def build_zip(rng, panelist, start, images, rows, face_ratio, face_image=None):
+    """
+    Builds one synthetic upload with screenshots and the four CSVs the app writes.
+
+    Consecutive screenshots mostly show the same screen with small changes, like real captures a few seconds apart.
+
+    Args:
+        rng (random.Random): Random generator.
+        panelist (int): Number of the panelist, used as id_user.
+        start (datetime): Capture time of the first screenshot.
+        images (int): Number of screenshots.
+        rows (int): Number of accessibility rows.
+        face_ratio (float): Share of screenshots showing faces.
+        face_image: Image pasted into screenshots with faces, or None.
+    Returns:
+        bytes: The zip file.
+    """
+    upload_id = str(uuid.UUID(int=rng.getrandbits(128)))
+    session_id = str(uuid.UUID(int=rng.getrandbits(128)))
+    segments = [(rng.choice(APPS), str(uuid.UUID(int=rng.getrandbits(128)))) for _ in range(3)]
+    start_ms = int(start.timestamp() * 1000)
+    user = str(1000 + panelist)
+
+    screenshot_rows = [["id_user", "file", "zipFileId", "apk", "id_session", "id_segment", "app", "text", "weekday",
+                        "t_epoch_ts_ms", "t_natural_utc_ts", "t_natural_second_ts", "t_natural_day_ts"]]
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_ref:
+        screen = None
+        for number in range(images):
+            taken = start + timedelta(seconds=3 * number)
+            apk, segment_id = segments[number * len(segments) // images]
+            if screen is None or rng.random() < 0.3:
+                screen = synthetic_screen(rng, face_image if rng.random() < face_ratio else None)
+
+            name = f"img_{uuid.UUID(int=rng.getrandbits(128))}_{taken.strftime('%Y_%m_%d_%H_%M_%S')}_" \
+                   f"{taken.microsecond // 1000:03d}.jpg"
+            frame = screen.copy()
+            cv2.putText(frame, taken.strftime("%H:%M:%S"), (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+            zip_ref.writestr(name, cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes())
+            screenshot_rows.append([user, f"/data/user/0/com.screenlake/files/{name}", f"image_zip_{upload_id}.zip",
+                                    apk, session_id, segment_id, "", random_text(rng, 40), taken.strftime("%a"),
+                                    str(int(taken.timestamp() * 1000)), taken.isoformat(),
+                                    taken.strftime("%H:%M:%S"), taken.strftime("%m/%d/%Y")])
+
+        accessibility_rows = [["id_user", "type", "t_unix_ts_ms", "apk", "id_session", "id_interval", "text"]]
+        for number in range(rows):
+            accessibility_rows.append([user, rng.choice(["SCREEN_TEXT", "VIEW_CLICKED", "VIEW_SCROLLED"]),
+                                       str(start_ms + number * 3000 * images // max(rows, 1)),
+                                       rng.choice(segments)[0], session_id,
+                                       str(uuid.UUID(int=rng.getrandbits(128))), random_text(rng, 60)])
+
+        end_ms = start_ms + 3000 * images
+        session_rows = [["id_user", "session_start", "session_end", "id_session", "seconds_since_last_active_ms",
+                         "session_duration_ms", "session_count_per_day", "interval", "id_panel", "id_tenant",
+                         "t_natural_second_session_start", "t_natural_day_session_start",
+                         "t_natural_second_session_end", "t_natural_day_session_end"],
+                        [user, iso_millis(start_ms), iso_millis(end_ms), session_id, "0", str(end_ms - start_ms), "1",
+                         "0.3", "bench_panel", "bench_tenant", start.strftime("%H:%M:%S"),
+                         start.strftime("%m/%d/%Y"), "", ""]]
+
+        segment_rows = [["apk", "t_unix_ts_segment_start", "duration_segment_ms", "id_session", "id_segment",
+                         "apk_prev_1", "apk_prev_2", "apk_prev_3", "apk_prev_4", "apk_next_1", "id_user"]]
+        for number, (apk, segment_id) in enumerate(segments):
+            previous = [segments[number - offset][0] if number >= offset else "NA" for offset in range(1, 5)]
+            following = segments[number + 1][0] if number + 1 < len(segments) else "NA"
+            segment_rows.append([apk, str(start_ms + number * (end_ms - start_ms) // len(segments)),
+                                 str((end_ms - start_ms) // len(segments)), session_id, segment_id, *previous,
+                                 following, user])
+
+        for prefix, csv_rows in (("screenshot_data", screenshot_rows), ("app_accessibility_data", accessibility_rows),
+                                 ("session_data", session_rows), ("app_segment_data", segment_rows)):
+            zip_ref.writestr(f"{prefix}_csv_{upload_id}.csv", "".join(quoted_csv_row(row) for row in csv_rows))
+    return buffer.getvalue()
+
+
+def synthetic_screen(rng, face_image=None):
+    """
+    Draws a screenshot-like image with coloured bars and lines of text, and optionally a photo with faces.
+
+    Args:
+        rng (random.Random): Random generator.
+        face_image: Image pasted into the middle of the screen, or None.
+    Returns:
+        numpy.ndarray: BGR image of SCREENSHOT_SIZE.
+    """
+    width, height = SCREENSHOT_SIZE
+    screen = np.full((height, width, 3), rng.randrange(200, 256), np.uint8)
+    cv2.rectangle(screen, (0, 0), (width, 60), [rng.randrange(256) for _ in range(3)], -1)
+    for line in range(30):
+        cv2.putText(screen, random_text(rng, 4), (20, 120 + line * 36), cv2.FONT_HERSHEY_SIMPLEX, 0.8,
+                    (40, 40, 40), 2)
+
+    if face_image is not None:
+        photo = cv2.resize(face_image, (width - 40, (width - 40) * face_image.shape[0] // face_image.shape[1]))
+        photo = photo[:height // 2]
+        top = rng.randrange(80, height - photo.shape[0])
+        screen[top:top + photo.shape[0], 20:20 + photo.shape[1]] = photo
+    return screen
+
+
+def random_text(rng, words):
+    """
+    Returns the given number of random words.
+    """
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def iso_millis(epoch_ms):
+    """
+    Formats epoch milliseconds like the app's session times, e.g. 2024-03-12T20:52:10.155Z.
+    """
+    return datetime.fromtimestamp(epoch_ms / 1000, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def quoted_csv_row(values):
+    """
+    Formats a CSV row with every field quoted, as the app writes them.
+    """
+    return ",".join('"' + str(value).replace('"', '""') + '"' for value in values) + "\n"
+
+
+def start_s3_stand_in(port):
+    """
+    Starts a moto S3 server on localhost and points boto3 at it, in this process and the pipeline subprocesses.
+
+    Args:
+        port (int): Port of the server.
+    Returns:
+        The running server, stop it with server.stop().
+    """
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError as e:
+        raise SystemExit(f"The benchmark needs moto, install it with 'pip install \"moto[server]\"' ({e})")
+
+    # The server logs every request it serves
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=port)
+    server.start()
+    os.environ.update(AWS_ENDPOINT_URL=f"http://127.0.0.1:{port}", AWS_ACCESS_KEY_ID="benchmark",
+                      AWS_SECRET_ACCESS_KEY="benchmark", AWS_DEFAULT_REGION="us-east-1")
+    return server
+
+
+def run_pipeline(path, workers, mode, work_folder, extra_args=()):
+    """
+    Runs consolidatecsvs.py non-interactively on a generated panel and reads back its run report.
+
+    Args:
+        path (str): Path of the panel.
+        workers (int): Number of processors and redaction workers.
+        mode (str): 'staged' or 'stream'.
+        work_folder (str): Folder the pipeline runs in, which holds its query folder.
+        extra_args: More command line options of the pipeline.
+    Returns:
+        dict: Wall time of the whole process and the stage metrics of its run report.
+    """
+    command = [sys.executable, os.path.join(SCRIPT_DIR, "consolidatecsvs.py"), "--bucket", BENCHMARK_BUCKET,
+               "--path", path, "--start-date", "2000-01-01", "--end-date", "2100-01-01", "--processors",
+               str(workers), "--redaction-workers", str(workers), "--query-id", "benchmark", *extra_args]
+    if mode == "stream":
+        command.append("--stream")
+
+    started = time.perf_counter()
+    completed = subprocess.run(command, cwd=work_folder, capture_output=True, text=True)
+    wall_seconds = time.perf_counter() - started
+    if completed.returncode:
+        raise RuntimeError(f"Pipeline failed with exit code {completed.returncode}:\n{completed.stderr[-2000:]}")
+
+    report_path = sorted(glob.glob(os.path.join(work_folder, "benchmark", "reports", "run-*.json")))[-1]
+    with open(report_path) as report_file:
+        run_report = json.load(report_file)
+    stages = {name: {key: metrics[key] for key in ("wall_seconds", "cpu_seconds", "items", "bytes")}
+              for name, metrics in run_report["stages"].items()}
+    return {"wall_seconds": wall_seconds, "peak_rss_mb": run_report["run"]["peak_rss_mb"], "stages": stages}
+
+
+def git_revision():
+    """
+    Returns the short git revision of the scripts, marked "-dirty" when they have uncommitted changes.
+    """
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--", "."], cwd=SCRIPT_DIR, capture_output=True,
+                                 text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{revision}-dirty" if changes else revision
+
+
+def run_benchmarks(args):
+    """
+    Runs the pipeline for every combination of data size, worker count and mode, and stores the results.
+
+    Args:
+        args (argparse.Namespace): Options of the run command.
+    Returns:
+        str: Path of the results file.
+    """
+    server = start_s3_stand_in(args.port)
+    try:
+        s3 = boto3.client("s3")
+        results = []
+        for size in args.sizes:
+            print(f"Generating the {size} panel...")
+            # Each size gets a panel of its own, so its runs never see the zips of other sizes
+            path = generate_panel(s3, BENCHMARK_BUCKET, f"{size}_panel", face_ratio=args.face_ratio, seed=args.seed,
+                                  **BENCHMARK_SIZES[size])[0]
+
+            for workers in args.workers:
+                for mode in args.modes:
+                    for repeat in range(args.repeat):
+                        work_folder = tempfile.mkdtemp(prefix="benchmark-")
+                        try:
+                            result = run_pipeline(path, workers, mode, work_folder, args.pipeline_args)
+                        finally:
+                            shutil.rmtree(work_folder, ignore_errors=True)
+                        results.append({"size": size, "workers": workers, "mode": mode, "repeat": repeat, **result})
+                        print(f"{size:>6} {mode:>7} {workers:>3} workers: {result['wall_seconds']:.2f}s")
+    finally:
+        server.stop()
+
+    revision = git_revision()
+    os.makedirs(args.output_folder, exist_ok=True)
+    results_path = os.path.join(args.output_folder, f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{revision}.json")
+    with open(results_path, "w") as results_file:
+        json.dump({
+            "revision": revision,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count()},
+            "sizes": {size: BENCHMARK_SIZES[size] for size in args.sizes},
+            "pipeline_args": args.pipeline_args,
+            "results": results,
+        }, results_file, indent=4)
+    print(f"Results written to {results_path}.")
+    return results_path
+
+
+def load_results(reference, output_folder=RESULTS_FOLDER):
+    """
+    Loads a results file, given its path or the git revision it was recorded at (the latest one wins).
+
+    Args:
+        reference (str): Path of a results file, or a revision such as 1a2b3c4.
+        output_folder (str): Folder searched for revisions.
+    Returns:
+        dict: The results.
+    """
+    if not os.path.exists(reference):
+        matches = sorted(glob.glob(os.path.join(output_folder, f"*-{reference}*.json")))
+        if not matches:
+            raise SystemExit(f"No results found for '{reference}' in {output_folder}.")
+        reference = matches[-1]
+    with open(reference) as results_file:
+        return json.load(results_file)
+
+
+def average_timings(results):
+    """
+    Averages the wall times of repeated runs, per size, worker count, mode and stage.
+
+    Args:
+        results (dict): Results file contents.
+    Returns:
+        dict: {(size, workers, mode, stage): seconds}, with the stage "total" for the whole pipeline process.
+    """
+    timings = {}
+    for result in results["results"]:
+        key = (result["size"], result["workers"], result["mode"])
+        timings.setdefault(key + ("total",), []).append(result["wall_seconds"])
+        for stage, metrics in result["stages"].items():
+            timings.setdefault(key + (stage,), []).append(metrics["wall_seconds"])
+    return {key: sum(values) / len(values) for key, values in timings.items()}
+
+
+def compare_results(baseline, candidate, output_folder=RESULTS_FOLDER):
+    """
+    Prints the stage timings of two benchmark results side by side.
+
+    Args:
+        baseline (str): Results path or revision to compare against.
+        candidate (str): Results path or revision to compare.
+        output_folder (str): Folder searched for revisions.
+    """
+    baseline_results = load_results(baseline, output_folder)
+    candidate_results = load_results(candidate, output_folder)
+    baseline_timings = average_timings(baseline_results)
+    candidate_timings = average_timings(candidate_results)
+
+    print(f"{'size':>6} {'mode':>7} {'workers':>7} {'stage':>12} "
+          f"{baseline_results['revision']:>14} {candidate_results['revision']:>14} {'change':>8}")
+    for key in sorted(baseline_timings.keys() & candidate_timings.keys()):
+        size, workers, mode, stage = key
+        before, after = baseline_timings[key], candidate_timings[key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"{size:>6} {mode:>7} {workers:>7} {stage:>12} {before:>13.3f}s {after:>13.3f}s {change:>8}")
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line options of the benchmark.
+
+    Args:
+        argv: Argument list to parse, defaults to sys.argv.
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark consolidatecsvs.py on synthetic panels served from a "
+                                                 "local S3 stand-in.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="Run the benchmarks and store the results.")
+    run.add_argument("--sizes", nargs="+", choices=BENCHMARK_SIZES, default=["small"],
+                     help="Data sizes to run (default: small).")
+    run.add_argument("--workers", nargs="+", type=int, default=[2, 4],
+                     help="Worker counts to run each size with (default: 2 4).")
+    run.add_argument("--modes", nargs="+", choices=["staged", "stream"], default=["staged", "stream"],
+                     help="Pipeline modes to run (default: both).")
+    run.add_argument("--repeat", type=int, default=1, help="Runs per combination (default: 1).")
+    run.add_argument("--face-ratio", type=float, default=0.3,
+                     help="Share of screenshots showing faces (default: 0.3).")
+    run.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data (default: 0).")
+    run.add_argument("--port", type=int, default=5055, help="Port of the local S3 stand-in (default: 5055).")
+    run.add_argument("--output-folder", default=RESULTS_FOLDER,
+                     help="Folder the results are written to (default: scripts/benchmark_results).")
+    run.add_argument("pipeline_args", nargs=argparse.REMAINDER,
+                     help="Options passed on to consolidatecsvs.py after --, e.g. -- --dedup --parquet.")
+
+    compare = subparsers.add_parser("compare", help="Compare the results of two runs.")
+    compare.add_argument("baseline", help="Results file or git revision to compare against.")
+    compare.add_argument("candidate", help="Results file or git revision to compare.")
+    compare.add_argument("--output-folder", default=RESULTS_FOLDER,
+                         help="Folder searched for revisions (default: scripts/benchmark_results).")
+
+    args = parser.parse_args(argv)
+    if args.command == "run" and args.pipeline_args[:1] == ["--"]:
+        args.pipeline_args = args.pipeline_args[1:]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "run":
+        run_benchmarks(args)
+    else:
+        compare_results(args.baseline, args.candidate, args.output_folder)
+
+
+if __name__ == "__main__":
+    main()
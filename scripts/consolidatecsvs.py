@@ -1,21 +1,88 @@
+import argparse
+import csv
+import glob
+import hashlib
+import io
+import itertools
 import multiprocessing
 import json
 import pathlib
+import queue
+import re
 import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import zipfile
-import pandas as pd
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
 import pytz
 from tqdm import tqdm
 import logging
-import boto3
 from datetime import datetime, timedelta
 import os
-import cv2
+import pipeline_metrics
+from s3_download import DOWNLOAD_MAX_IN_FLIGHT, RANGED_GET_PART_SIZE, download_objects
+from external_sort import DEDUP_KEYS, TIME_COLUMNS, merge_sorted_csvs, sort_csv_file
+from shards import in_shard, parse_shard, shard_name, shard_of
+from autotune import AUTOTUNE_BATCH_BYTES, new_autotune_state, record_batch
 
-s3 = boto3.client('s3')
+# Bucket the app uploads panel data to
+DEFAULT_BUCKET_NAME = "screenlake-zip-prod"
 
-# Load the pre-trained face detection model
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+# Threads listing panelist prefixes concurrently
+LISTING_WORKERS = 16
+
+# Name of a date folder, e.g. 2024-05-01 or 2024_05_01
+DATE_FOLDER_PATTERN = re.compile(r'(\d{4})[-_](\d{2})[-_](\d{2})')
+
+# Pipeline stages recorded per object in the sync manifest. They are its columns in this order, so stages added
+# later go last and older manifests get them appended, see open_manifest
+MANIFEST_STAGES = ("downloaded", "extracted", "redacted", "consolidated", "listed")
+
+# Stages a run can be limited to with --stage, in the order they run
+PIPELINE_STAGES = ("list", "download", "extract", "consolidate")
+
+# Number of work items queued ahead of each worker, so long listings never sit in the pool all at once
+QUEUE_DEPTH_PER_WORKER = 4
+
+# Stages that can be profiled with --profile-stage, see pipeline_metrics.instrument
+PROFILED_STAGES = ("download", "stream", "extract", "consolidate", "dedup", "sentiment", "enrich",
+                   "accessibility", "global", "parquet", "index")
+
+# How worker processes are started. Forking while the listing threads hold locks of the S3 client or logging can
+# leave a child stuck on a lock that no thread will release, so workers start from a clean fork server instead
+WORKER_START_METHOD = "forkserver"
+
+# Format of the log lines of the pipeline and its worker processes
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+# Per-thread (and therefore per-process) state of pool workers, such as their S3 client
+_worker_state = threading.local()
+
+# Images handed to a redaction worker per work item
+REDACTION_CHUNK_SIZE = 32
+
+# File extensions of the formats redacted images can be re-encoded in
+IMAGE_FORMAT_EXTENSIONS = {"jpeg": ".jpg", "webp": ".webp"}
+
+# Capture time in screenshot file names, e.g. img_<uuid>Screenshot_2024-05-01_14-03-22.jpg
+# or img_<uuid>_2024_03_12_13_54_57_501.jpg with milliseconds, as in the sample upload under app/src/main/assets
+SCREENSHOT_TIME_PATTERN = re.compile(
+    r'(?<!\d)(\d{4})[-_](\d{2})[-_](\d{2})_(\d{2})[-_](\d{2})[-_](\d{2})(?:_(\d{3}))?(?!\d)')
+
+# Buffer size used when copying CSV bodies into the consolidated files
+CSV_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Byte order mark some CSV writers put in front of the header
+UTF8_BOM = b'\xef\xbb\xbf'
+
+# File name prefixes of the CSVs consolidated per panelist
+CSV_PREFIXES = ["screenshot_data", "app_accessibility_data", "app_segment_data", "session_data"]
+
+# Columns identifying where a row comes from, prepended to the global datasets
+GLOBAL_LABEL_COLUMNS = ("panelist_id", "tenant", "panel", "version")
 
 
 # Step 1: Connect to AWS S3
@@ -36,13 +103,40 @@ def connect_to_s3():
         else:
             aws_access_key = input("Enter AWS Access Key: ")
             aws_secret_key = input("Enter AWS Secret Key: ")
-            return boto3.client('s3', aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key)
+            return use_credentials(aws_access_key, aws_secret_key)
     else:
         aws_access_key = input("Enter AWS Access Key: ")
         aws_secret_key = input("Enter AWS Secret Key: ")
-        return boto3.client('s3', aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key)
+        return use_credentials(aws_access_key, aws_secret_key)
+
+    return new_s3_client()
+
+
+def use_credentials(aws_access_key, aws_secret_key):
+    """
+    Makes the entered credentials the default for this run, so worker processes and threads pick them up too.
+    Args:
+        aws_access_key: AWS Access Key
+        aws_secret_key: AWS Secret Key
+    Returns:
+        boto3 S3 client
+    """
+    os.environ['AWS_ACCESS_KEY_ID'] = aws_access_key
+    os.environ['AWS_SECRET_ACCESS_KEY'] = aws_secret_key
+    return new_s3_client(aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key)
+
+
+def new_s3_client(**credentials):
+    """
+    Creates an S3 client, importing boto3 on first use so runs of stages that never reach S3 do not load it.
+    Args:
+        credentials: Keyword arguments of the client, such as aws_access_key_id.
+    Returns:
+        boto3 S3 client
+    """
+    import boto3
 
-    return boto3.client('s3')
+    return boto3.session.Session().client('s3', **credentials)
 
 
 def get_date_range_from_user():
@@ -53,7 +147,18 @@ def get_date_range_from_user():
     """
     start_date_str = input("Enter the start date (YYYY-MM-DD, or press Enter for 1 year ago): ")
     end_date_str = input("Enter the end date (YYYY-MM-DD, or press Enter for today): ")
+    return parse_date_range(start_date_str, end_date_str)
 
+
+def parse_date_range(start_date_str, end_date_str):
+    """
+    Parses a date range, defaulting to the last year.
+    Args:
+        start_date_str: Start date as YYYY-MM-DD, empty or None for 1 year ago.
+        end_date_str: End date as YYYY-MM-DD, empty or None for today.
+    Returns:
+        tuple: start_date, end_date
+    """
     # Set default or specified start date
     if not start_date_str:
         start_date = datetime.now() - timedelta(days=365)
@@ -81,9 +186,25 @@ def list_folders_in_path(s3, bucket_name, path):
     Returns:
         list: Folders under the specified path
     """
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=path, Delimiter='/')
-    common_prefixes = response.get('CommonPrefixes', [])
-    return [prefix.get('Prefix') for prefix in common_prefixes]
+    return list_path(s3, bucket_name, path)[0]
+
+
+def list_path(s3, bucket_name, path):
+    """
+    Lists the folders and the objects directly under a path, across all result pages.
+    Args:
+        s3: Boto3 S3 client
+        bucket_name: Name of the S3 bucket
+        path: Path within the S3 bucket
+    Returns:
+        tuple: Folders under the specified path, and the S3 object refs directly in it
+    """
+    folders, objects = [], []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=path, Delimiter='/'):
+        folders.extend(prefix.get('Prefix') for prefix in page.get('CommonPrefixes', []))
+        objects.extend(page.get('Contents', []))
+    return folders, objects
 
 
 def get_bucket_and_path():
@@ -93,8 +214,8 @@ def get_bucket_and_path():
     Returns:
         Tuple containing the selected bucket name and directory path.
     """
-    default_bucket_name = "screenlake-zip-prod"
-    s3 = boto3.client('s3')
+    default_bucket_name = DEFAULT_BUCKET_NAME
+    s3 = new_s3_client()
 
     # Prompt for the S3 bucket (default: screenlake-zip-prod)
     bucket_name = input(f"Enter the S3 bucket name (default: {default_bucket_name}): ") or default_bucket_name
@@ -201,337 +322,1149 @@ def query_by_date_range(s3, bucket_name, path, start_date, end_date):
 
 
 # Step 4: Set batch and processor parameters
-def set_batch_and_processors():
+def set_batch_and_processors(query_id, num_processors=None):
     """
-    Sets up the batch size for zip file downloads and the number of processors to use.
-    Also prepares the directory structure for storing query results and configures a query ID.
+    Sets up the number of processors to use.
+    Also prepares the directory structure for storing query results under the given query ID.
 
+    Args:
+        query_id: Unique identifier of the query, see default_query_id.
+        num_processors: Number of processors, prompted for when None.
     Returns:
-        A tuple containing the batch size, number of processors, and the query ID.
+        A tuple containing the number of processors and the query ID.
     """
-    # Prompt the user for batch size and number of processors with default values
-    try:
-        zip_batch_size = int(input("Enter the batch size for zip file downloads (default: 25): ") or 25)
-        num_processors = int(input("Enter the number of processors (default: 4): ") or 4)
-    except ValueError as e:
-        logging.error("Invalid input, please enter a number.")
-        raise e
-
-    # Generate a unique query ID for each session to avoid conflicts
-    query_id = f"query_1234"
+    # Prompt the user for the number of processors with a default value
+    if num_processors is None:
+        try:
+            num_processors = int(input("Enter the number of processors (default: 4): ") or 4)
+        except ValueError as e:
+            logging.error("Invalid input, please enter a number.")
+            raise e
 
     # Configuration dictionary for the query
     query_config = {
         "queryId": query_id,
-        "batchSize": zip_batch_size,
+        "numProcessors": num_processors,
         "numFilesToDownload": 0,  # Initial setup, no files to download yet
         "numFilesDownloaded": 0,  # Tracker for downloaded files
-        "lastBatchBeginId": ""  # Placeholder for tracking batches
+        "lastSyncedAt": ""  # Set once a run has consolidated its files
     }
 
-    # Prepare directories for zipped and unzipped files
+    # Prepare directories for zipped files
     directories = {
         "base": query_id,
-        "zipped": os.path.join(query_id, "zipped"),
-        "unzipped": os.path.join(query_id, "unzipped")
+        "zipped": os.path.join(query_id, "zipped")
     }
 
     # Create the directories if they don't exist
     for directory in directories.values():
         os.makedirs(directory, exist_ok=True)
 
-    # Save the query configuration to a JSON file
+    # Save the query configuration to a JSON file, keeping what earlier runs recorded
     config_path = os.path.join(query_id, "query_config.json")
+    if os.path.exists(config_path):
+        with open(config_path) as config_file:
+            query_config = {**json.load(config_file), "numProcessors": num_processors}
+
     with open(config_path, "w") as config_file:
         json.dump(query_config, config_file)
 
     logging.info(f"Configuration saved to {config_path}.")
-    return zip_batch_size, num_processors, query_id
+    return num_processors, query_id
+
+
+def default_query_id(bucket_name, path):
+    """
+    Derives a stable query ID from the selected bucket and path, so every run against the same
+    panelists reuses the same folder and sync manifest.
+
+    Args:
+        bucket_name: Name of the S3 bucket.
+        path: Path within the S3 bucket.
+    Returns:
+        str: The query ID.
+    """
+    return f"query_{hashlib.sha1(f'{bucket_name}/{path}'.encode()).hexdigest()[:10]}"
+
+
+def read_query_config(query_id):
+    """
+    Returns the query configuration saved by set_batch_and_processors and update_query_config.
+    """
+    with open(os.path.join(query_id, "query_config.json")) as config_file:
+        return json.load(config_file)
+
+
+def update_query_config(query_id, **fields):
+    """
+    Updates fields of the query configuration saved by set_batch_and_processors.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        **fields: Configuration keys and their new values.
+    """
+    config_path = os.path.join(query_id, "query_config.json")
+    query_config = read_query_config(query_id)
+    query_config.update(fields)
+    with open(config_path, "w") as config_file:
+        json.dump(query_config, config_file)
+
+
+def open_manifest(query_id):
+    """
+    Opens the sync manifest of a query, creating it on the first run.
+
+    The manifest has one row per S3 object version, keyed by key, ETag and LastModified, with the time each
+    stage in MANIFEST_STAGES completed for it.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+    Returns:
+        sqlite3.Connection: Connection to the manifest database.
+    """
+    conn = sqlite3.connect(os.path.join(query_id, "manifest.sqlite"))
+    stage_columns = ", ".join(f"{stage}_at TEXT" for stage in MANIFEST_STAGES)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS objects (
+            key TEXT NOT NULL,
+            etag TEXT NOT NULL,
+            last_modified TEXT NOT NULL,
+            size INTEGER,
+            {stage_columns},
+            PRIMARY KEY (key, etag, last_modified)
+        )""")
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(objects)")}
+    for stage in MANIFEST_STAGES:
+        if f"{stage}_at" not in columns:
+            conn.execute(f"ALTER TABLE objects ADD COLUMN {stage}_at TEXT")
+    return conn
+
+
+def manifest_key(obj):
+    """
+    Returns the manifest primary key of an S3 object ref.
+    """
+    return obj['Key'], obj['ETag'], obj['LastModified'].isoformat()
+
+
+def filter_unsynced(manifest, objects):
+    """
+    Drops the objects that a previous run already consolidated.
+
+    An object whose ETag or LastModified changed since then is a new version and is kept.
+
+    Args:
+        manifest: Connection returned by open_manifest.
+        objects: Iterable of S3 object refs.
+    Yields:
+        S3 object refs that still need to be processed.
+    """
+    synced = completed_keys(manifest, "consolidated")
+
+    skipped = 0
+    for obj in objects:
+        if manifest_key(obj) in synced:
+            skipped += 1
+        else:
+            yield obj
+
+    logging.info(f"Skipped {skipped} files already synced by a previous run.")
+
+
+def completed_keys(manifest, stage):
+    """
+    Returns the manifest keys of the objects that completed a stage, see manifest_key.
+
+    Args:
+        manifest: Connection returned by open_manifest.
+        stage: One of MANIFEST_STAGES.
+    Returns:
+        set: (key, ETag, LastModified) tuples.
+    """
+    if stage not in MANIFEST_STAGES:
+        raise ValueError(f"Unknown manifest stage: {stage}")
+    return set(manifest.execute(f"SELECT key, etag, last_modified FROM objects WHERE {stage}_at IS NOT NULL"))
+
+
+def clear_stage(manifest, stage):
+    """
+    Forgets that a stage completed for any object, e.g. once the files it wrote are deleted.
+
+    Args:
+        manifest: Connection returned by open_manifest.
+        stage: One of MANIFEST_STAGES.
+    """
+    if stage not in MANIFEST_STAGES:
+        raise ValueError(f"Unknown manifest stage: {stage}")
+    manifest.execute(f"UPDATE objects SET {stage}_at = NULL")
+    manifest.commit()
 
 
-# Step 5: Download zip files in batches
-def download_zip_files_in_batches(s3, bucket_name, path, start_date, end_date, zip_batch_size, num_processors,
-                                  query_id):
+def pending_objects(manifest, done, pending):
     """
-     Downloads objects from S3 in batches, using multiple processes.
+    Returns the objects an earlier run took through one stage but not the next, for runs limited with --stage.
+
+    Args:
+        manifest: Connection returned by open_manifest.
+        done: Stage of MANIFEST_STAGES the objects completed.
+        pending: Stage of MANIFEST_STAGES they still need.
+    Returns:
+        list: S3 object refs with Key, ETag, LastModified and Size, in key order.
+    """
+    for stage in (done, pending):
+        if stage not in MANIFEST_STAGES:
+            raise ValueError(f"Unknown manifest stage: {stage}")
+
+    rows = manifest.execute(f"""
+        SELECT key, etag, last_modified, size FROM objects
+        WHERE {done}_at IS NOT NULL AND {pending}_at IS NULL AND consolidated_at IS NULL
+        ORDER BY key""")
+    return [{'Key': key, 'ETag': etag, 'LastModified': datetime.fromisoformat(last_modified), 'Size': size}
+            for key, etag, last_modified, size in rows]
+
+
+def mark_stage(manifest, objects, stage):
+    """
+    Records that a pipeline stage completed for the given objects.
+
+    Args:
+        manifest: Connection returned by open_manifest.
+        objects: Iterable of S3 object refs.
+        stage: One of MANIFEST_STAGES.
+    """
+    if stage not in MANIFEST_STAGES:
+        raise ValueError(f"Unknown manifest stage: {stage}")
+
+    completed_at = datetime.now(pytz.UTC).isoformat()
+    manifest.executemany(f"""
+        INSERT INTO objects (key, etag, last_modified, size, {stage}_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (key, etag, last_modified) DO UPDATE SET {stage}_at = excluded.{stage}_at""",
+                         [(*manifest_key(obj), obj.get('Size'), completed_at) for obj in objects])
+    manifest.commit()
+
+
+def get_worker_s3():
+    """
+    Returns the S3 client owned by the calling worker, creating it on first use.
+
+    Every pool thread gets its own client, and a forked process never reuses a client created by its parent.
+    Returns:
+        boto3 S3 client
+    """
+    if getattr(_worker_state, 'pid', None) != os.getpid():
+        _worker_state.pid = os.getpid()
+        _worker_state.s3 = new_s3_client()
+    return _worker_state.s3
+
+
+def configure_worker_logging(level):
+    """
+    Sets up logging in a pool worker process, which does not inherit the configuration of the parent.
+    Args:
+        level: Log level of the parent process.
+    """
+    logging.basicConfig(level=level, format=LOG_FORMAT)
+
+
+def run_work_queue(func, items, num_workers, executor='process', desc="Work items"):
+    """
+    Runs a function over every item on a persistent worker pool fed from a bounded queue.
+
+    Items are consumed lazily and at most QUEUE_DEPTH_PER_WORKER items per worker are queued at a time, so
+    each item is submitted exactly once and a failing item never stops the others. The time each worker spends on
+    its items is added to the running pipeline stage, see pipeline_metrics.record_worker.
+
+    Args:
+        func: Picklable callable applied to each item.
+        items: Iterable of work items.
+        num_workers: Number of worker processes, or threads when executor is 'thread'.
+        executor: 'process' for a process pool (CPU-bound work) or 'thread' for a thread pool (I/O-bound work).
+            Processes are started with WORKER_START_METHOD.
+        desc: Label of the progress bar.
+    Yields:
+        tuple: (item, result, error) per item, in completion order. error is None when func succeeded.
+    """
+    if executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=num_workers)
+    else:
+        pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+                                   initializer=configure_worker_logging, initargs=(logging.getLogger().level,))
+    max_pending = num_workers * QUEUE_DEPTH_PER_WORKER
+    items = iter(items)
+    pending = {}
+
+    with pool, tqdm(desc=desc) as pbar:
+        while True:
+            # Top up the queue before waiting on the next completion
+            for item in itertools.islice(items, max_pending - len(pending)):
+                pending[pool.submit(pipeline_metrics.timed_call, func, item)] = item
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                pbar.update(1)
+                if error:
+                    yield item, None, error
+                    continue
+
+                result, worker, busy_seconds = future.result()
+                pipeline_metrics.record_worker(worker, busy_seconds)
+                yield item, result, None
+
+
+# Step 5: Download zip files
+@pipeline_metrics.instrument("download")
+def download_zip_files(objects_to_download, bucket_name, num_workers, query_id, executor='process',
+                       downloader='pool', part_size=RANGED_GET_PART_SIZE):
+    """
+     Downloads the given objects from S3, one work item per object.
 
      Args:
-         s3_client: Boto3 S3 client instance.
+         objects_to_download: Iterable of S3 object refs, see query_s3_objects_in_date_range.
          bucket_name: Name of the S3 bucket.
-         path: Path within the S3 bucket from which to download objects.
-         start_date: Start date for querying objects.
-         end_date: End date for querying objects.
-         zip_batch_size: Number of files to download in each batch.
-         num_processors: Number of parallel processes to use for downloading.
+         num_workers: Number of parallel processes, or threads when executor is 'thread'. With the asyncio
+             downloader, the number of requests in flight.
          query_id: Unique identifier for the query/download session.
+         executor: 'process' or 'thread', see run_work_queue.
+         downloader: 'pool' to download on a run_work_queue pool, or 'asyncio' to drive all downloads from this
+             process with a shared connection pool, see s3_download.download_objects.
+         part_size: With the asyncio downloader, zips larger than this many bytes are fetched as parallel ranged
+             GETs.
+     Returns:
+         tuple: Lists of downloaded and failed S3 object refs.
      """
-    objects_to_download = query_s3_objects_in_date_range(s3, bucket_name, path, start_date, end_date)
-    num_objects = len(objects_to_download)
+    if downloader == 'asyncio':
+        results = download_objects(objects_to_download, bucket_name, partial(local_zip_path, query_id), num_workers,
+                                   part_size)
+    else:
+        download = partial(download_object, query_id=query_id, bucket_name=bucket_name)
+        results = run_work_queue(download, objects_to_download, num_workers, executor, "Downloading files")
+
+    downloaded, failed = [], []
+    for obj, _, error in results:
+        if error:
+            logging.error(f"Error downloading {obj['Key']}: {error}")
+            pipeline_metrics.count(errors=1)
+            failed.append(obj)
+        else:
+            pipeline_metrics.count(items=1, nbytes=obj.get('Size', 0))
+            downloaded.append(obj)
 
-    # Divide the objects into batches
-    object_batches = [objects_to_download[i:i + zip_batch_size] for i in range(0, num_objects, zip_batch_size)]
+    logging.info(f"Downloaded {len(downloaded)} files, {len(failed)} failed.")
+    return downloaded, failed
 
-    processes = []
-    with tqdm(total=len(object_batches), desc="Batches") as pbar_batch:
-        for batch in object_batches:
-            if len(processes) == num_processors or len(processes) == len(object_batches):
-                for process in processes:
-                    pbar_batch.update(1)
-                    process.join()
 
-                processes = []
-            else:
-                process = multiprocessing.Process(target=download_batch,
-                                                  args=(batch, query_id, bucket_name))
-                process.start()
-                processes.append(process)
+def download_object(obj, query_id, bucket_name):
+    """
+    Downloads a single file from an S3 bucket with the calling worker's S3 client.
+
+    Args:
+        obj: S3 object ref to download.
+        query_id: Unique identifier for the query/download session.
+        bucket_name: Name of the S3 bucket.
+    Returns:
+        str: Local path of the downloaded file.
+    """
+    file_path = local_zip_path(query_id, obj['Key'])  # Construct local file path
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)  # Ensure the directory exists
+
+    # Download file if it doesn't already exist
+    if not os.path.exists(file_path):
+        get_worker_s3().download_file(bucket_name, obj['Key'], file_path)
+    return file_path
 
-            if len(processes) == len(object_batches):
-                for process in processes:
-                    process.join()
+
+def local_zip_path(query_id, key):
+    """
+    Returns where download_object stores the object with the given S3 key.
+    """
+    return os.path.join(f'{query_id}/zipped', *key.split('/')[1:])
 
 
-def download_batch(batch, query_id, bucket_name):
+def staged_batches(objects, budget_bytes):
     """
-    Downloads a batch of files from an S3 bucket.
+    Splits the objects to download into consecutive batches whose zips fit on disk together.
+
+    Batches are generators reading lazily from the same listing, so each batch is downloaded while it is listed.
+    A batch ends before the first object that would take its zips over the budget, which then starts the next
+    batch; an object larger than the whole budget gets a batch of its own. Each batch has to be consumed before
+    the next one is requested.
 
     Args:
-        s3_client: Boto3 S3 client instance.
-        batch: List of objects to download.
-        query_id: Unique identifier for the query/download session.
-        bucket_name: Name of the S3 bucket.
+        objects: Iterable of S3 object refs, see query_s3_objects_in_date_range.
+        budget_bytes (int): Bytes of zips staged at once, or None for a single batch holding every object.
+    Yields:
+        Generators of S3 object refs.
     """
-    for obj in tqdm(batch, desc="Downloading files"):
-        file_path = os.path.join(f'{query_id}/zipped', *obj['Key'].split('/')[1:])  # Construct local file path
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)  # Ensure the directory exists
+    if not budget_bytes:
+        yield iter(objects)
+        return
+
+    objects = iter(objects)
+    # Object that did not fit in the previous batch, or was read ahead to see whether another batch follows
+    held = []
+
+    def batch():
+        staged = 0
+        while True:
+            obj = held.pop() if held else next(objects, None)
+            if obj is None:
+                return
+            size = obj.get('Size') or 0
+            if staged and staged + size > budget_bytes:
+                held.append(obj)
+                logging.info(f"Disk budget reached with {staged / 1024 ** 2:.1f} MB of zips staged, extracting them "
+                             f"before downloading more.")
+                return
+            staged += size
+            yield obj
 
-        # Download file if it doesn't already exist
-        if not os.path.exists(file_path):
-            s3.download_file(bucket_name, obj['Key'], file_path)
+    while True:
+        if not held:
+            obj = next(objects, None)
+            if obj is None:
+                return
+            held.append(obj)
+        yield batch()
 
 
-def query_s3_objects_in_date_range(s3, bucket_name, path, start_date, end_date):
+def release_zips(query_id, objects):
     """
-    Get all S3 objects in a specified range.
+    Deletes the local zips of the given objects once they are extracted, see download_object.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        objects: S3 object refs of the zips.
     Returns:
-        List of S3 object refs in range.
+        int: Bytes freed.
     """
-    objects = []
-    next_token = None
+    freed = 0
+    for obj in objects:
+        zip_path = local_zip_path(query_id, obj['Key'])
+        try:
+            freed += os.path.getsize(zip_path)
+            os.remove(zip_path)
+        except FileNotFoundError:
+            continue
+    return freed
 
-    count = 0  # Initialize a count variable to track the number of files fetched
-    while True:
-        params = {
-            'Bucket': bucket_name,
-            'Prefix': path
-        }
 
-        if next_token:
-            params['ContinuationToken'] = next_token  # Include ContinuationToken if it exists
+@pipeline_metrics.instrument("list")
+def query_s3_objects_in_date_range(s3, bucket_name, path, start_date, end_date, num_workers=LISTING_WORKERS,
+                                   shard=None):
+    """
+    Get all S3 objects in a specified range.
 
-        response = s3.list_objects_v2(**params)
-        objects.extend(response.get('Contents', []))
+    The path is split into one shard per subfolder (one per panelist under a panelist/ path), and the shards
+    are listed concurrently. Objects are yielded page by page while the listing is still running, so downloads
+    can start before it finishes.
+
+    Args:
+        s3: Boto3 S3 client used to discover the shards.
+        bucket_name: Name of the S3 bucket.
+        path: Path within the S3 bucket.
+        start_date: Start of the date range as datetime.
+        end_date: End of the date range as datetime.
+        num_workers: Number of shards listed at the same time.
+        shard (tuple): (i, N) from --shard to only list the panelist folders of that shard, see shard_prefixes.
+            Objects outside panelist folders are still listed, and left to in_shard.
+    Yields:
+        S3 object refs in range.
+    """
+    start_date = start_date.replace(tzinfo=pytz.UTC)
+    end_date = end_date.replace(tzinfo=pytz.UTC)
+
+    # Walk down single-folder levels such as panelist/ until the prefix fans out into one folder per panelist
+    shards, top_level_objects = list_path(s3, bucket_name, path)
+    while len(shards) == 1 and not top_level_objects:
+        path = shards[0]
+        shards, top_level_objects = list_path(s3, bucket_name, path)
+
+    if shard:
+        shards = shard_prefixes(s3, bucket_name, shards, shard)
+    shards = [prefix for prefix in shards if not prefix_outside_date_range(prefix, start_date, end_date)]
+    logging.info(f"Listing {len(shards)} folders under {path}.")
+
+    for obj in top_level_objects:
+        if start_date <= obj['LastModified'] <= end_date:
+            pipeline_metrics.count(nbytes=obj['Size'], stage_name="list")
+            yield obj
+
+    # Listing threads hand over one page at a time; a full queue pauses them until downloads catch up
+    pages = queue.Queue(maxsize=num_workers * QUEUE_DEPTH_PER_WORKER)
+    stopped = threading.Event()
+
+    def hand_over(page):
+        # Waits for room in the queue, and gives up once the consumer has stopped reading
+        while not stopped.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def list_shard(prefix):
+        try:
+            paginator = get_worker_s3().get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                in_range = [obj for obj in page.get('Contents', []) if start_date <= obj['LastModified'] <= end_date]
+                if not hand_over(in_range):
+                    return
+        finally:
+            hand_over(None)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        futures = [pool.submit(list_shard, shard) for shard in shards]
+        try:
+            remaining = len(futures)
+            while remaining:
+                page = pages.get()
+                if page is None:
+                    remaining -= 1
+                    continue
+                pipeline_metrics.count(nbytes=sum(obj['Size'] for obj in page), stage_name="list")
+                yield from page
+        finally:
+            stopped.set()
+
+    # Surface listing errors, such as access denied on a shard
+    for future in futures:
+        future.result()
+
+
+def shard_prefixes(s3, bucket_name, prefixes, shard):
+    """
+    Narrows the listing prefixes down to the panelist folders of a shard, so each shard only lists its own panelists.
+
+    Prefixes above the panelist folders, such as the versions of a panel, are expanded level by level with delimiter
+    listings until they reach the folders under a panelist/ folder, which are kept when shards.shard_of assigns
+    them to the shard. Folders holding objects of their own are kept whole, since their objects can only be
+    assigned after listing, see in_shard.
 
-        if 'NextContinuationToken' in response:
-            next_token = response['NextContinuationToken']
+    Args:
+        s3: Boto3 S3 client.
+        bucket_name: Name of the S3 bucket.
+        prefixes: Folder prefixes to list, see list_path.
+        shard (tuple): (i, N) as returned by parse_shard.
+    Returns:
+        list: Prefixes to list, sorted.
+    """
+    selected = []
+    pending = list(prefixes)
+    paginator = s3.get_paginator('list_objects_v2')
+    while pending:
+        prefix = pending.pop()
+        parts = prefix.rstrip('/').split('/')
+        if len(parts) >= 2 and parts[-2] == 'panelist':
+            if shard_of(parts[-1], shard[1]) == shard[0]:
+                selected.append(prefix)
+            continue
+
+        folders, has_objects = [], False
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+            if page.get('Contents'):
+                has_objects = True
+                break
+            folders.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+        if has_objects or not folders:
+            selected.append(prefix)
         else:
-            break  # Exit the loop when there are no more objects to fetch
+            pending.extend(folders)
+    return sorted(selected)
 
-    filtered_objects = []
 
-    for obj in objects:
-        start_date = start_date.replace(tzinfo=pytz.UTC)
-        end_date = end_date.replace(tzinfo=pytz.UTC)
-        last_modified = obj['LastModified']
-        last_modified = last_modified.replace(tzinfo=pytz.UTC)  # Make sure LastModified is timezone-aware
-        if start_date <= last_modified <= end_date:
-            filtered_objects.append(obj)
-            count += 1  # Increment the count for each file fetched
-            logging.info(f'Files fetched: {count}", end="\r')  # Print the count with carriage return to overwrite the line
+def prefix_outside_date_range(prefix, start_date, end_date):
+    """
+    Checks whether a key prefix is a date folder outside the date range, so it can be skipped without listing it.
 
-    # Print a newline to separate the progress count
-    logging.info("")
+    Only the last folder of the prefix is looked at, and only when its whole name is a date, so dates in the names
+    of the tenant, panel or version folders above it never prune anything. A date folder is assumed to hold the
+    objects uploaded on that day, whose LastModified falls on it; prefixes that are not date folders are never
+    skipped.
 
-    return filtered_objects
+    Args:
+        prefix: S3 key prefix.
+        start_date: Timezone-aware start of the date range.
+        end_date: Timezone-aware end of the date range.
+    Returns:
+        bool: True if the prefix can be pruned.
+    """
+    match = DATE_FOLDER_PATTERN.fullmatch(prefix.rstrip('/').rsplit('/', 1)[-1])
+    if not match:
+        return False
+
+    try:
+        prefix_date = datetime(*map(int, match.groups())).date()
+    except ValueError:
+        return False
+    return not start_date.date() <= prefix_date <= end_date.date()
 
 
-def unzip_file(zip_file, destination_folder, image_folder):
+# Step 5 (streaming mode): Download zip files straight into extraction
+def stream_and_extract(obj, query_id, bucket_name, buffer_size, detect_scale=1.0, reuse_threshold=0.0,
+                       image_store=None, image_output=None):
     """
-    Unzips a file to a specified destination folder, with additional processing for images.
+    Downloads one object into a spooled buffer and redacts its images without staging the zip on disk.
+
+    Its CSV members are handed back to the parent process, which appends them to the consolidated files.
 
     Args:
-        zip_file: Path to the zip file.
-        destination_folder: Folder where files should be extracted to.
-        image_folder: Folder where images should be stored after processing.
+        obj: S3 object ref of the zip file.
+        query_id: Unique identifier for the query/download session.
+        bucket_name: Name of the S3 bucket.
+        buffer_size: Bytes of the zip held in memory before it spills to a temp file.
+        detect_scale: Scale images are shrunk to for face detection, see detect_faces.
+        reuse_threshold: Frame difference below which faces are reused, see new_reuse_state.
+        image_store: Folder of the content-addressed image store, or None to write images to their folder only.
+        image_output: Output settings from new_image_output, or None to save images at full size.
+    Returns:
+        list: (member name, bytes) of the CSV members, or None if the zip could not be read.
+    """
+    image_folder = panelist_image_folder(query_id, obj['Key'].split('/')[-2])
+
+    # The buffer stays in memory up to buffer_size bytes and only rolls over to a temp file past that
+    with tempfile.SpooledTemporaryFile(max_size=buffer_size) as buffer:
+        get_worker_s3().download_fileobj(bucket_name, obj['Key'], buffer)
+        buffer.seek(0)
+        if not unzip_file(buffer, image_folder, detect_scale=detect_scale, reuse_threshold=reuse_threshold,
+                          image_store=image_store, image_output=image_output):
+            return None
+
+        buffer.seek(0)
+        with zipfile.ZipFile(buffer, 'r') as zip_ref:
+            return [(info.filename, zip_ref.read(info)) for info in zip_ref.infolist()
+                    if info.filename.endswith('.csv')]
+
+
+@pipeline_metrics.instrument("stream")
+def stream_zip_files(objects_to_download, bucket_name, num_workers, query_id, buffer_size, executor='process',
+                     detect_scale=1.0, reuse_threshold=0.0, image_store=None, image_output=None, appended=(),
+                     on_appended=None):
     """
+    Downloads, redacts and consolidates objects in one pass, so each zip is processed as soon as it arrives.
+
+    The CSVs of every zip are appended to the consolidated files of its panelist as its result comes in, unless an
+    earlier run that stopped before consolidating the zip already appended them.
+
+    Args:
+        objects_to_download: Iterable of S3 object refs, see query_s3_objects_in_date_range.
+        bucket_name: Name of the S3 bucket.
+        num_workers: Number of workers downloading and extracting concurrently.
+        query_id: Unique identifier for the query/download session.
+        buffer_size: Bytes of each zip held in memory before it spills to a temp file.
+        executor: 'process' or 'thread', see run_work_queue.
+        detect_scale: Scale images are shrunk to for face detection, see detect_faces.
+        reuse_threshold: Frame difference below which faces are reused, see new_reuse_state.
+        image_store: Folder of the content-addressed image store, or None to write images to their folder only.
+        image_output: Output settings from new_image_output, or None to save images at full size.
+        appended: Manifest keys of the objects whose CSVs are already in the consolidated files, see manifest_key.
+        on_appended: Function called with each object ref right after its CSVs are appended.
+    Returns:
+        tuple: Lists of extracted and failed S3 object refs.
+    """
+    stream = partial(stream_and_extract, query_id=query_id, bucket_name=bucket_name, buffer_size=buffer_size,
+                     detect_scale=detect_scale, reuse_threshold=reuse_threshold, image_store=image_store,
+                     image_output=image_output)
+
+    extracted, failed = [], []
+    for obj, csv_members, error in run_work_queue(stream, objects_to_download, num_workers, executor,
+                                                  "Streaming zips"):
+        if error or csv_members is None:
+            logging.error(f"Error streaming {obj['Key']}: {error or 'zip could not be read'}")
+            pipeline_metrics.count(errors=1)
+            failed.append(obj)
+        else:
+            pipeline_metrics.count(items=1, nbytes=obj.get('Size', 0))
+            if manifest_key(obj) not in appended:
+                with pipeline_metrics.stage("consolidate"):
+                    consolidate_csv_members(((name, io.BytesIO(data)) for name, data in csv_members),
+                                            consolidated_folder(query_id, obj['Key'].split('/')[-2]), append=True)
+                if on_appended:
+                    on_appended(obj)
+            extracted.append(obj)
+
+    logging.info(f"Streamed {len(extracted)} zips, {len(failed)} failed.")
+    if image_store:
+        summarize_image_store(image_store)
+    return extracted, failed
+
+
+def unzip_file(zip_file, image_folder, redaction_type='redact', detect_scale=1.0, reuse_threshold=0.0,
+               image_store=None, image_output=None):
+    """
+    Redacts the images of a zip file into a folder.
+
+    Images are decoded straight from the zip and never extracted. CSV members are left alone, since the pipeline
+    consolidates them straight from the zips, see combine_csv_files.
+
+    Args:
+        zip_file: Path to the zip file, or a seekable file object holding the zip bytes.
+        image_folder: Folder where images should be stored after redaction.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detect_scale (float): Scale images are shrunk to for face detection, see detect_faces.
+        reuse_threshold (float): Frame difference below which faces are reused, see new_reuse_state.
+        image_store (str): Folder of the content-addressed image store, see store_redacted_image, or None to write
+            images to image_folder only.
+        image_output (dict): Output settings from new_image_output, or None to save images at full size.
+    Returns:
+        bool: True if the archive was processed, False if it could not be read.
+    """
+    from redaction import new_reuse_state, redact_image_bytes, store_redacted_image
+
     try:
         count_of_existing_files, count_of_non_existing_files = 0, 0
+        reuse_state = new_reuse_state(reuse_threshold)
+        stored = []
+        image_bytes, output_bytes = 0, 0
 
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            for file_info in zip_ref.infolist():
-                # Determine the extraction path
-                extracted_file_path = os.path.join(destination_folder, file_info.filename)
-                is_image = file_info.filename.lower().endswith(('.jpg', '.jpeg'))
+        try:
+            with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+                # Images go in capture order so consecutive frames can share face detections
+                for file_info in sorted(zip_ref.infolist(), key=lambda info: capture_order(info.filename)):
+                    if not is_image_file(file_info.filename):
+                        continue
+                    output_path = os.path.join(image_folder, output_image_name(file_info.filename, image_output))
 
-                if file_info.filename.endswith('.csv') or is_image:
                     # Check if the file already exists to avoid re-extraction
-                    if not os.path.exists(extracted_file_path):
-                        zip_ref.extract(file_info, destination_folder)
-                        logging.info(f"Extracted: {file_info.filename}")
-
-                        if is_image:
-                            # Additional processing for images
-                            processed_image_path = os.path.join(image_folder, file_info.filename)
-                            detect_and_redact_faces(extracted_file_path, processed_image_path)
-                            count_of_non_existing_files += 1
-                    else:
+                    if os.path.exists(output_path):
                         count_of_existing_files += 1
+                        continue
 
-            logging.info(f"Existing files count: {count_of_existing_files}")
-            logging.info(f"Processed new files count: {count_of_non_existing_files}")
-
-        # Attempt to remove the original zip file after extraction
-        try:
-            # os.remove(zip_file)
-            logging.info(f"Removed zip file: {zip_file}")
-        except OSError as e:
-            logging.error(f"Error deleting zip file {zip_file}: {e}")
-
+                    data = zip_ref.read(file_info)
+                    if image_store:
+                        digest = store_redacted_image(data, output_path, image_store, redaction_type, detect_scale,
+                                                      reuse_state, image_output)
+                        stored.append((file_info.filename, digest, len(data)))
+                    else:
+                        redact_image_bytes(data, output_path, redaction_type, detect_scale, reuse_state,
+                                           image_output)
+                    image_bytes += len(data)
+                    output_bytes += os.path.getsize(output_path)
+                    count_of_non_existing_files += 1
+
+                logging.info(f"Existing files count: {count_of_existing_files}")
+                logging.info(f"Processed new files count: {count_of_non_existing_files}")
+                if reuse_threshold:
+                    logging.info(f"Face detections skipped: {reuse_state['skipped']}")
+                if image_output and image_bytes:
+                    logging.info(f"Images written: {output_bytes} bytes from {image_bytes} uploaded, "
+                                 f"{image_bytes - output_bytes} saved")
+        finally:
+            # Images stored before an error are mapped as well, since the next run skips them
+            if stored:
+                record_stored_images(image_store, os.path.basename(os.path.dirname(image_folder)), stored)
+
+        return True
     except Exception as e:
         logging.error(f"Error unzipping {zip_file}: {e}")
+        return False
 
 
-def process_child_folder_and_unzip_synchronous(parent, children, query_id):
+def is_image_file(filename):
     """
-    Unzips child folders synchronously within a given parent directory.
+    Returns whether a zip member is a screenshot.
+    """
+    return filename.lower().endswith(('.jpg', '.jpeg'))
 
-    Args:
-        parent: Parent directory containing child folders.
-        children: List of child folders to be unzipped.
-        query_id: Unique identifier for the operation, used in directory structuring.
+
+def capture_order(filename):
     """
-    for child in children:
-        child_path = os.path.join(parent, child)
-        destination_folder = f"{query_id}/unzipped/panelists/{os.path.basename(parent)}"
-        image_folder = f"{query_id}/combined/panelists/{os.path.basename(parent)}/images"
+    Sort key putting screenshots in capture order, using the time in their file name when it has one.
+    """
+    # The time is the last date-like part of the name, after the image UUID
+    matches = SCREENSHOT_TIME_PATTERN.findall(filename)
+    return (''.join(part or '000' for part in matches[-1]) if matches else '', filename)
 
-        # Create destination and image folders
-        os.makedirs(destination_folder, exist_ok=True)
-        os.makedirs(image_folder, exist_ok=True)
 
-        unzip_file(child_path, destination_folder, image_folder)
+def capture_time(filename):
+    """
+    Returns the capture time in a screenshot file name as 'YYYY-MM-DD HH:MM:SS[.mmm]', or None if it has none.
+    """
+    matches = SCREENSHOT_TIME_PATTERN.findall(filename)
+    if not matches:
+        return None
+    year, month, day, hour, minute, second, millis = matches[-1]
+    return f"{year}-{month}-{day} {hour}:{minute}:{second}" + (f".{millis}" if millis else "")
 
 
-def process_child_folder_and_unzip_async(path):
+def panelist_image_folder(query_id, panelist):
     """
-    Asynchronously unzips all child folders within a specified path.
+    Builds, and creates if needed, the folder redacted images of a panelist are written to.
 
     Args:
-        path: Path containing child folders to be unzipped.
+        query_id: Unique identifier for the query/download session.
+        panelist: Name of the panelist folder (the last folder of the S3 key).
+    Returns:
+        str: The image folder.
     """
-    zipped_child_folders = []
-    result_dict = {}
-    # Get a list of child folders with their full paths
-    for root, dirs, files in os.walk(path):
-        for dir_name in dirs:
-            child_folder = os.path.join(root, dir_name)
-            zipped_child_folders.append(child_folder)
+    image_folder = f"{query_id}/combined/panelists/{panelist}/images"
+    os.makedirs(image_folder, exist_ok=True)
+    return image_folder
 
-            child_files = [file for file in os.listdir(child_folder) if file.endswith('.zip')]
-            result_dict[child_folder] = child_files
 
-    # Create a pool of worker processes
-    num_processes = multiprocessing.cpu_count()
-    processes = []
+def consolidated_folder(query_id, panelist):
+    """
+    Returns the folder holding the consolidated CSVs of a panelist.
+    """
+    return os.path.join(query_id, 'combined', 'panelists', panelist, 'metadata')
 
-    for key in result_dict:
-        if len(processes) == num_processes:
-            for process in processes:
-                process.join()
 
-            processes = []
-        else:
-            process = multiprocessing.Process(target=process_child_folder_and_unzip_synchronous,
-                                              args=(key, list(result_dict[key]), path))
-            process.start()
-            processes.append(process)
+def group_zips_by_panelist(query_id, objects):
+    """
+    Maps each panelist to the local paths of its downloaded zips, see download_object.
 
-        if len(processes) == len(zipped_child_folders):
-            for process in processes:
-                process.join()
+    Args:
+        query_id: Unique identifier for the query/download session.
+        objects: S3 object refs of the downloaded zips.
+    Returns:
+        dict: Panelist folder name to sorted zip paths.
+    """
+    zip_files = {}
+    for obj in objects:
+        zip_files.setdefault(obj['Key'].split('/')[-2], []).append(local_zip_path(query_id, obj['Key']))
+    return {panelist: sorted(paths) for panelist, paths in zip_files.items()}
 
 
-def process_child_folders_csvs(path):
+def collect_extraction_jobs(query_id, zip_files, image_output=None, appended=()):
     """
-    Gathers CSV files from child folders within a given directory.
+    Splits the downloaded zips into the work items of the shared extraction pool, see extract_zips.
+
+    Every zip gives one item reading its CSV members, and one item per REDACTION_CHUNK_SIZE of its images that have
+    not been redacted yet, in capture order. Work is therefore scheduled per zip and per image chunk rather than per
+    panelist, so a panelist with far more data than the others is spread over all workers.
 
     Args:
-        path (str): The path to the parent directory.
+        query_id: Unique identifier for the query/download session.
+        zip_files (dict): Panelist folder name to its zip paths in consolidation order, see group_zips_by_panelist.
+        image_output (dict): Output settings from new_image_output, which set the file names images are written to.
+        appended: Paths of the zips whose CSVs are already in the consolidated files, which get no CSV item.
+    Yields:
+        tuple: (panelist, position of the zip within the panelist, zip path, image names or None for the CSV item)
+    """
+    for panelist, paths in zip_files.items():
+        for position, zip_path in enumerate(paths):
+            if zip_path not in appended:
+                yield panelist, position, zip_path, None
+
+            try:
+                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                    names = zip_ref.namelist()
+            except (OSError, zipfile.BadZipFile):
+                # Reported by the zip's CSV item
+                continue
 
-    Returns:
-        dict: A mapping of child folder names to lists of their CSV files.
+            image_folder = panelist_image_folder(query_id, panelist)
+            images = sorted((name for name in names
+                             if is_image_file(name)
+                             and not os.path.exists(os.path.join(image_folder, output_image_name(name, image_output)))),
+                            key=capture_order)
+            for i in range(0, len(images), REDACTION_CHUNK_SIZE):
+                yield panelist, position, zip_path, images[i:i + REDACTION_CHUNK_SIZE]
+
+
+def extract_job(job, query_id, redaction_type='redact', detect_scale=1.0, reuse_threshold=0.0, image_store=None,
+                image_output=None):
     """
-    result_dict = {}
+    Runs one work item of collect_extraction_jobs inside an extraction worker.
 
-    for root, dirs, _ in os.walk(path):
-        for dir_name in dirs:
-            child_folder = os.path.join(root, dir_name)
-            child_files = [os.path.join(child_folder, file) for file in os.listdir(child_folder) if
-                           file.endswith('.csv')]
+    Args:
+        job: Tuple of (panelist, position, zip_path, image names or None).
+        query_id: Unique identifier for the query/download session.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detect_scale (float): Scale images are shrunk to for face detection, see detect_faces.
+        reuse_threshold (float): Frame difference below which faces are reused, see new_reuse_state.
+        image_store (str): Folder of the content-addressed image store, or None to write images to their folder only.
+        image_output (dict): Output settings from new_image_output, or None to save images at full size.
+    Returns:
+        For the CSV item, a list of (member name, bytes) of the zip's CSV members. For image items, the result of
+        redact_image_run.
+    """
+    panelist, _, zip_path, images = job
+    if images is None:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            return [(info.filename, zip_ref.read(info)) for info in zip_ref.infolist()
+                    if info.filename.endswith('.csv')]
 
-            # Include folder only if it contains CSV files
-            if child_files:
-                result_dict[dir_name] = child_files
+    image_folder = panelist_image_folder(query_id, panelist)
+    return redact_image_run((image_folder, [(zip_path, name) for name in images]), redaction_type, detect_scale,
+                            reuse_threshold, image_store, image_output)
 
-    return result_dict
 
+def redact_image_run(job, redaction_type='redact', detect_scale=1.0, reuse_threshold=0.0, image_store=None,
+                     image_output=None):
+    """
+    Redacts a run of consecutive images inside a worker.
 
-def detect_and_redact_faces(input_image_path, output_image_path, redaction_type='redact'):
+    Args:
+        job: Tuple of (image_folder, [(zip_path, member_name), ...]).
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detect_scale (float): Scale images are shrunk to for face detection, see detect_faces.
+        reuse_threshold (float): Frame difference below which faces are reused, see new_reuse_state.
+        image_store (str): Folder of the content-addressed image store, see store_redacted_image, or None to write
+            images to image_folder only.
+        image_output (dict): Output settings from new_image_output, or None to save images at full size.
+    Returns:
+        tuple: Zip paths of the images that could not be redacted, the number of skipped face detections, the
+        number of image bytes read and the number of image bytes written.
     """
-    Detects faces in an image and applies redaction or blurring.
+    from redaction import new_reuse_state, redact_image_bytes, store_redacted_image
+
+    image_folder, images = job
+    failed = []
+    image_bytes, output_bytes = 0, 0
+    reuse_state = new_reuse_state(reuse_threshold)
+    open_zips = {}
+    stored = []
+    try:
+        for zip_path, name in images:
+            # Consecutive images mostly come from the same zips, so keep them open between images
+            if zip_path not in open_zips:
+                open_zips[zip_path] = zipfile.ZipFile(zip_path, 'r')
+
+            try:
+                data = open_zips[zip_path].read(name)
+                image_bytes += len(data)
+                output_path = os.path.join(image_folder, output_image_name(name, image_output))
+                if image_store:
+                    digest = store_redacted_image(data, output_path, image_store, redaction_type, detect_scale,
+                                                  reuse_state, image_output)
+                    stored.append((name, digest, len(data)))
+                else:
+                    redact_image_bytes(data, output_path, redaction_type, detect_scale, reuse_state, image_output)
+                output_bytes += os.path.getsize(output_path)
+            except Exception as e:
+                logging.error(f"Error redacting {name} from {zip_path}: {e}")
+                failed.append(zip_path)
+    finally:
+        for zip_ref in open_zips.values():
+            zip_ref.close()
+        if stored:
+            record_stored_images(image_store, os.path.basename(os.path.dirname(image_folder)), stored)
+    return failed, reuse_state['skipped'], image_bytes, output_bytes
+
+
+@pipeline_metrics.instrument("extract")
+def extract_zips(query_id, zip_files, num_workers, redaction_type='redact', detect_scale=1.0, reuse_threshold=0.0,
+                 image_store=None, image_output=None, appended=(), on_appended=None):
+    """
+    Consolidates the CSVs and redacts the images of the downloaded zips on one shared pool of worker processes.
+
+    Workers take the next zip's CSV item or image chunk as soon as they are free, see collect_extraction_jobs, so
+    all cores stay busy however unevenly the data is spread over panelists. Each worker loads the face detection
+    model once and decodes images straight from the zip.
+
+    Workers decompress the CSV members, and the main process appends them to the consolidated files of their
+    panelist. Results arriving out of order are held back until the zips before them are appended, so rows end up
+    in the same order as when the zips are consolidated one after another. Zips whose CSVs were appended by an
+    earlier run that stopped before consolidating them only have their images redacted.
 
     Args:
-        input_image_path (str): Path to the input image.
-        output_image_path (str): Path where the processed image will be saved.
+        query_id: Unique identifier for the query/download session.
+        zip_files (dict): Panelist folder name to its zip paths in consolidation order, see group_zips_by_panelist.
+        num_workers: Number of worker processes.
         redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detect_scale (float): Scale images are shrunk to for face detection, see detect_faces.
+        reuse_threshold (float): Frame difference below which faces are reused, see new_reuse_state.
+        image_store (str): Folder of the content-addressed image store, see store_redacted_image, or None to write
+            images to the panelists' image folders only.
+        image_output (dict): Output settings from new_image_output, or None to save images at full size.
+        appended: Paths of the zips whose CSVs are already in the consolidated files.
+        on_appended: Function called with the path of each zip right after its CSVs are appended, e.g. to record it
+            before a later failure could make a rerun append them again.
+    Returns:
+        tuple: Sets of the paths of the zips that could not be read, and of the zips with at least one image that
+        could not be redacted.
     """
-    image = cv2.imread(input_image_path)
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+    extract = partial(extract_job, query_id=query_id, redaction_type=redaction_type, detect_scale=detect_scale,
+                      reuse_threshold=reuse_threshold, image_store=image_store, image_output=image_output)
+
+    # CSV members per panelist that wait for earlier zips, and the position of the next zip to append
+    held_back = {panelist: {} for panelist in zip_files}
+    next_position = dict.fromkeys(zip_files, 0)
+    for panelist, paths in zip_files.items():
+        held_back[panelist].update((position, None) for position, path in enumerate(paths) if path in appended)
+
+    unreadable, failed_zips = set(), set()
+    image_count, skipped_count = 0, 0
+    read_bytes, written_bytes = 0, 0
+    started = time.monotonic()
+    jobs = collect_extraction_jobs(query_id, zip_files, image_output, appended)
+    for job, result, error in run_work_queue(extract, jobs, num_workers, desc="Extracting zips"):
+        panelist, position, zip_path, images = job
+        if images is not None:
+            image_count += len(images)
+            if error:
+                logging.error(f"Error redacting images of {zip_path}: {error}")
+                pipeline_metrics.count(items=len(images), errors=len(images))
+                failed_zips.add(zip_path)
+            else:
+                failed, skipped, image_bytes, output_bytes = result
+                pipeline_metrics.count(items=len(images), nbytes=image_bytes, errors=len(failed))
+                failed_zips.update(failed)
+                skipped_count += skipped
+                read_bytes += image_bytes
+                written_bytes += output_bytes
+            continue
+
+        if error:
+            logging.error(f"Error reading {zip_path}: {error}")
+            pipeline_metrics.count(errors=1)
+            unreadable.add(zip_path)
+        held_back[panelist][position] = result or []
+        while next_position[panelist] in held_back[panelist]:
+            position = next_position[panelist]
+            members = held_back[panelist].pop(position)
+            next_position[panelist] += 1
+            if members is None:
+                continue
+            with pipeline_metrics.stage("consolidate"):
+                consolidate_csv_members(((name, io.BytesIO(data)) for name, data in members),
+                                        consolidated_folder(query_id, panelist), append=True)
+            if on_appended and zip_files[panelist][position] not in unreadable:
+                on_appended(zip_files[panelist][position])
+
+    elapsed = time.monotonic() - started
+    logging.info(f"Redacted {image_count} images in {elapsed:.1f}s "
+                 f"({image_count / elapsed if elapsed else 0:.1f} images/s), {len(failed_zips)} zips with errors.")
+    if reuse_threshold:
+        logging.info(f"Face detections skipped on near-identical frames: {skipped_count} of {image_count}.")
+    if read_bytes:
+        logging.info(f"Wrote {written_bytes / 1024 ** 2:.1f} MB of images for {read_bytes / 1024 ** 2:.1f} MB "
+                     f"uploaded, {(read_bytes - written_bytes) / 1024 ** 2:.1f} MB ({1 - written_bytes / read_bytes:.0%}) saved.")
+    if image_store:
+        summarize_image_store(image_store)
+    return unreadable, failed_zips
+
+
+def extract_downloaded(manifest, query_id, downloaded, num_workers, detect_scale=1.0, reuse_threshold=0.0,
+                       image_store=None, image_output=None):
+    """
+    Extracts downloaded zips, records the stages they completed in the manifest and deletes them.
 
-    for (x, y, w, h) in faces:
-        if redaction_type == 'blur':
-            blur_face(image, x, y, w, h)
-        else:  # Default to 'redact' for any other input
-            redact_face(image, x, y, w, h)
+    CSVs are appended to the consolidated files straight from the zips, and each zip is marked as extracted as soon
+    as they are, so a rerun after a failure never appends them twice. Zips that cannot be read stay unmarked as
+    extracted, and zips with images that cannot be decoded stay unmarked as redacted.
 
-    cv2.imwrite(output_image_path, image)
+    Args:
+        manifest: Connection returned by open_manifest.
+        query_id (str): Unique identifier for the query/download session.
+        downloaded (list): S3 object refs of the local zips, see local_zip_path.
+        num_workers (int): Number of processes extracting and redacting zips.
+        detect_scale (float): Scale images are shrunk to for face detection, see redaction.detect_faces.
+        reuse_threshold (float): Frame difference below which faces are reused, see redaction.new_reuse_state.
+        image_store (str): Folder of the content-addressed image store, or None to write images to the panelists'
+            image folders only.
+        image_output (dict): Output settings from new_image_output, or None to save images at full size.
+    Returns:
+        list: S3 object refs of the zips that were extracted and fully redacted.
+    """
+    zip_objects = {local_zip_path(query_id, obj['Key']): obj for obj in downloaded}
+    done = completed_keys(manifest, "extracted")
+    unreadable, failed_zips = extract_zips(
+        query_id, group_zips_by_panelist(query_id, downloaded), num_workers, detect_scale=detect_scale,
+        reuse_threshold=reuse_threshold, image_store=image_store, image_output=image_output,
+        appended={path for path, obj in zip_objects.items() if manifest_key(obj) in done},
+        on_appended=lambda path: mark_stage(manifest, [zip_objects[path]], "extracted"))
+    redacted = [obj for obj in downloaded if local_zip_path(query_id, obj['Key']) not in unreadable | failed_zips]
+    mark_stage(manifest, redacted, "redacted")
+
+    freed = release_zips(query_id, downloaded)
+    logging.info(f"Released {freed / 1024 ** 2:.1f} MB of extracted zips.")
+    return redacted
+
+
+def image_store_folder(query_id):
+    """
+    Returns the folder of the content-addressed image store of a query, see store_redacted_image.
+    """
+    return os.path.join(query_id, 'combined', 'image_store')
 
 
-def blur_face(image, x, y, w, h):
+def record_stored_images(image_store, panelist, images):
     """
-    Applies Gaussian blurring to a face region in the image.
+    Adds images to the mapping table of the image store, `images.sqlite` in its folder.
+
+    The table `images` has one row per panelist and file name, with the capture time parsed from the file name, the
+    SHA-256 digest of its upload, which starts its blob name, and its size as uploaded. Workers call this directly, SQLite serializes their writes.
 
     Args:
-        image: The image array.
-        x, y: The top-left corner of the face bounding box.
-        w, h: The width and height of the bounding box.
+        image_store (str): Folder of the image store, see image_store_folder.
+        panelist (str): Name of the panelist folder.
+        images (list): Tuples of (file name, digest, size in bytes).
     """
-    region_of_interest = image[y:y + h, x:x + w]
-    blurred = cv2.GaussianBlur(region_of_interest, (99, 99), 30)
-    image[y:y + h, x:x + w] = blurred
+    if not images:
+        return
+    os.makedirs(image_store, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(image_store, 'images.sqlite'), timeout=60)
+    try:
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    panelist TEXT NOT NULL,
+                    file TEXT NOT NULL,
+                    captured_at TEXT,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER,
+                    PRIMARY KEY (panelist, file)
+                )""")
+            conn.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)",
+                             [(panelist, name, capture_time(name), digest, size) for name, digest, size in images])
+    finally:
+        conn.close()
+
+
+def summarize_image_store(image_store):
+    """
+    Logs how many images the image store maps, and how many distinct blobs hold them.
 
+    Args:
+        image_store (str): Folder of the image store, see image_store_folder.
+    """
+    index_path = os.path.join(image_store, 'images.sqlite')
+    if not os.path.exists(index_path):
+        return
+    conn = sqlite3.connect(index_path, timeout=60)
+    try:
+        images, blobs, source_bytes, distinct_bytes = conn.execute("""
+            SELECT COUNT(*), COUNT(DISTINCT sha256), COALESCE(SUM(size), 0),
+                   (SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM images GROUP BY sha256))
+            FROM images""").fetchone()
+    finally:
+        conn.close()
+    logging.info(f"Image store maps {images} images to {blobs} blobs, "
+                 f"{(source_bytes - distinct_bytes) / 1024 ** 2:.1f} MB of duplicate uploads stored once.")
 
-def redact_face(image, x, y, w, h):
+
+def new_image_output(max_dimension=None, image_format=None, quality=None, thumbnail_size=None):
     """
-    Fills a face region in the image with black to redact it.
+    Creates the output settings of redacted images, applied in the same pass as redaction, see write_output_image.
 
     Args:
-        image: The image array.
-        x, y: The top-left corner of the face bounding box.
-        w, h: The width and height of the bounding box.
+        max_dimension (int): Longest side images are shrunk to, or None to keep their size.
+        image_format (str): 'jpeg' or 'webp' to re-encode images in, or None to keep the format of the upload.
+        quality (int): Encoding quality from 0 to 100, or None for OpenCV's default (95 for JPEG).
+        thumbnail_size (int): Longest side of a thumbnail written next to each image, or None for no thumbnails.
+    Returns:
+        dict: The settings, or None when all of them are left at their default and images are written as before.
+    """
+    if max_dimension is None and image_format is None and quality is None and thumbnail_size is None:
+        return None
+    return {'max_dimension': max_dimension, 'format': image_format, 'quality': quality,
+            'thumbnail_size': thumbnail_size}
+
+
+def output_image_name(name, image_output=None):
     """
-    image[y:y + h, x:x + w] = (0, 0, 0)
+    Returns the file name a redacted screenshot is written under, with the extension of its output format.
+    """
+    if image_output and image_output['format']:
+        return os.path.splitext(name)[0] + IMAGE_FORMAT_EXTENSIONS[image_output['format']]
+    return name
 
 
 def delete_folder(folder_path):
@@ -551,27 +1484,31 @@ def delete_folder(folder_path):
         print(f"An error occurred: {e}")
 
 
-def combine_csv_files(input_dict, query_id):
+@pipeline_metrics.instrument("consolidate")
+def combine_csv_files(input_dict, query_id, append=False):
     """
-        combine_csv_files(input_dict, query_id)
+        combine_csv_files(input_dict, query_id, append=False)
 
         Combines multiple CSV files grouped by specific prefixes into consolidated CSV files for each group.
 
         This method organizes and merges CSV files provided in an input dictionary, grouping files by their filename prefixes
-        and saving the combined output in a specified directory structure.
+        and saving the combined output in a specified directory structure. CSVs are read straight out of zip archives,
+        so they never have to be extracted to disk first.
 
         Parameters:
-            input_dict (dict): A dictionary where the keys represent folder names and the values are lists of file paths
-                               to the CSV files within those folders. For example:
+            input_dict (dict): A dictionary where the keys represent folder names and the values are lists of paths to
+                               zip files, whose `.csv` members are read, or to CSV files. For example:
                                {
-                                   "folder1": ["path/to/screenshot_data_1.csv", "path/to/session_data_1.csv"],
+                                   "folder1": ["path/to/image_zip_1.zip", "path/to/image_zip_2.zip"],
                                    "folder2": ["path/to/app_segment_data_1.csv", "path/to/app_accessibility_data_1.csv"]
                                }
             query_id (str): A unique identifier used to create the output folder structure. The output will be saved in
                             a directory named `<query_id>/combined/panelists/<folder>/metadata`.
+            append (bool): Append to consolidated files left by a previous run instead of replacing them. Used by
+                           incremental runs, whose input only holds the files that are new since that run.
 
         Valid Prefixes:
-            The method processes files whose names start with one of the following prefixes:
+            The method processes files whose names start with one of the prefixes in CSV_PREFIXES:
             - "screenshot_data"
             - "app_accessibility_data"
             - "app_segment_data"
@@ -582,21 +1519,23 @@ def combine_csv_files(input_dict, query_id):
             `<query_id>/combined/panelists/<folder>/metadata/<prefix>-consolidated.csv`.
 
         Process:
-        1. Groups the CSV files within each folder by their prefixes based on valid prefixes.
-        2. Creates the necessary directory structure for storing the consolidated files.
-        3. Merges all CSV files in each group into a single CSV file with a consolidated filename.
+        1. Reads the CSV files of each folder, and the CSV members of its zips, in the given order.
+        2. Groups them by their prefixes based on valid prefixes.
+        3. Appends each of them to the consolidated file of its prefix, which is opened once per folder.
 
         Details:
-        - The method writes the header from the first CSV file in each group and appends data from subsequent files without headers.
-        - If a folder has no files with valid prefixes, it is skipped.
+        - Files with the same header are concatenated as raw bytes, skipping the header of every file after the first,
+          so rows are never parsed into DataFrames. See `append_csv_stream`.
+        - Files whose header differs (older or newer app versions) are merged into the union of the columns.
+        - When appending to an existing consolidated file, no header is written unless new columns appear.
+        - Zips that cannot be read are logged and skipped.
 
         Exceptions:
             - May raise `FileNotFoundError` if a specified file does not exist.
-            - May raise `pandas.errors.EmptyDataError` if any of the input files are empty or corrupted.
 
         Example Usage:
             input_dict = {
-                "panelist1": ["data/screenshot_data_1.csv", "data/session_data_1.csv"],
+                "panelist1": ["zipped/panelist1/image_zip_1.zip", "zipped/panelist1/image_zip_2.zip"],
                 "panelist2": ["data/app_segment_data_2.csv", "data/app_accessibility_data_2.csv"]
             }
             query_id = "query_123"
@@ -609,58 +1548,790 @@ def combine_csv_files(input_dict, query_id):
             # query_123/combined/panelists/panelist2/metadata/app_segment_data-consolidated.csv
             # query_123/combined/panelists/panelist2/metadata/app_accessibility_data-consolidated.csv
     """
-    output_folder = f"{query_id}/combined"
+    for folder, files in input_dict.items():
+        panelist_folder = consolidated_folder(query_id, folder)
+        logging.debug(f"Consolidating {panelist_folder}")
+        consolidate_csv_members(read_csv_members(files), panelist_folder, append)
 
-    for folder, csv_files in input_dict.items():
-        prefix_dict = {}
 
-        # Group CSV files by prefixƒ
-        for csv_file in csv_files:
-            filename = os.path.basename(csv_file)
+def read_csv_members(files):
+    """
+    Opens the CSV files, and the CSV members of the zip files, in the given order.
 
-            # Check if the prefix matches one of the specified prefixes
-            valid_prefixes = ["screenshot_data", "app_accessibility_data", "app_segment_data", "session_data"]
-            for prefix in valid_prefixes:
-                if filename.startswith(prefix):
-                    if prefix not in prefix_dict:
-                        prefix_dict[prefix] = []
-                        prefix_dict[prefix].append(csv_file)
-                    else:
-                        prefix_dict[prefix].append(csv_file)
-
-        panelist_folder = os.path.join(os.path.join(output_folder, 'panelists'), folder + '/metadata')
-        print(panelist_folder)
-        pathlib.Path(panelist_folder).mkdir(parents=True, exist_ok=True)
-
-        # Combine CSV files within each prefix group
-        for prefix, files in prefix_dict.items():
-            combined_csv = os.path.join(panelist_folder, f"{prefix}-consolidated.csv")
-            header_written = False
-
-            for file in files:
-                df = pd.read_csv(file)
-                if not header_written:
-                    df.to_csv(combined_csv, index=False)
-                    header_written = True
+    Args:
+        files (list): Paths of zip or CSV files.
+    Yields:
+        tuple: (file name, binary file object), the file object is closed once the next one is requested.
+    """
+    for file in files:
+        if file.endswith('.csv'):
+            with open(file, 'rb') as csv_file:
+                yield os.path.basename(file), csv_file
+            continue
+
+        try:
+            with zipfile.ZipFile(file, 'r') as zip_ref:
+                members = [info for info in zip_ref.infolist() if info.filename.endswith('.csv')]
+                for info in members:
+                    with zip_ref.open(info) as member:
+                        yield info.filename, member
+        except zipfile.BadZipFile as e:
+            logging.error(f"Error reading {file}: {e}")
+
+
+def consolidate_csv_members(members, panelist_folder, append=False):
+    """
+    Appends CSV files to the consolidated file of their prefix in a panelist's metadata folder.
+
+    The files and the bytes they add are counted for the running pipeline stage.
+
+    Args:
+        members: Iterable of (file name, binary file object), see read_csv_members.
+        panelist_folder (str): Folder of the consolidated files.
+        append (bool): Append to existing consolidated files instead of replacing them.
+    """
+    outputs = {}
+    try:
+        for name, member in members:
+            filename = os.path.basename(name)
+            prefix = next((prefix for prefix in CSV_PREFIXES if filename.startswith(prefix)), None)
+            if prefix is None:
+                continue
+
+            if prefix not in outputs:
+                pathlib.Path(panelist_folder).mkdir(parents=True, exist_ok=True)
+                outputs[prefix] = open_consolidated_csv(
+                    os.path.join(panelist_folder, f"{prefix}-consolidated.csv"), append)
+            try:
+                append_csv_stream(outputs[prefix], member)
+                pipeline_metrics.count(items=1)
+            except (zipfile.BadZipFile, EOFError) as e:
+                # A corrupt member leaves at most a partial last row, which the next file starts a new line after
+                logging.error(f"Error reading {name}: {e}")
+                pipeline_metrics.count(errors=1)
+    finally:
+        for output in outputs.values():
+            pipeline_metrics.count(nbytes=output['file'].tell() - output['start'])
+            output['file'].close()
+
+
+def open_consolidated_csv(combined_csv, append=False):
+    """
+    Opens a consolidated CSV file for appending.
+
+    Args:
+        combined_csv (str): Path of the consolidated CSV file.
+        append (bool): Keep the rows of an existing file instead of truncating it.
+    Returns:
+        dict: Output state used by append_csv_stream, holding its path, open file, the size it was opened at,
+        columns (None until the header is written) and whether the file ends with a line break.
+    """
+    output = {'path': combined_csv, 'columns': None, 'ends_with_newline': True}
+    if append and os.path.exists(combined_csv):
+        with open(combined_csv, 'rb') as existing:
+            header = read_csv_header(existing)
+            if header:
+                existing.seek(-1, os.SEEK_END)
+                output['columns'] = header[0]
+                output['ends_with_newline'] = existing.read(1) == b'\n'
+
+    output['file'] = open(combined_csv, 'ab' if output['columns'] else 'wb')
+    output['start'] = output['file'].tell()
+    return output
+
+
+def append_csv_stream(output, stream):
+    """
+    Appends one CSV file to a consolidated CSV file, copying its rows as raw bytes whenever the headers match.
+
+    Files whose header differs from the consolidated header are rewritten row by row into the consolidated columns,
+    with empty values for the columns they lack. New columns are added to the end of the consolidated header, which
+    rewrites the rows already consolidated. Empty files are skipped.
+
+    Args:
+        output (dict): Output state, see open_consolidated_csv.
+        stream: Binary file object positioned at the start of the CSV file.
+    """
+    header = read_csv_header(stream)
+    if header is None:
+        return
+    names, header_line = header
+
+    if output['columns'] is None:
+        output['file'].write(header_line if header_line.endswith(b'\n') else header_line + b'\n')
+        output['columns'] = names
+    elif not set(names) <= set(output['columns']):
+        widen_consolidated_csv(output, names)
+
+    output['ends_with_newline'] = copy_csv_rows(stream, names, output['columns'], output['file'],
+                                                output['ends_with_newline'])
+
+
+def widen_consolidated_csv(output, names):
+    """
+    Adds the columns of a header that a consolidated CSV file lacks, rewriting the rows it already holds.
+
+    Args:
+        output (dict): Output state, see open_consolidated_csv.
+        names (list): Column names of the file about to be appended.
+    """
+    columns = output['columns'] + [name for name in names if name not in output['columns']]
+    output['file'].close()
+
+    temp_csv = output['path'] + '.tmp'
+    with open(output['path'], 'rb') as existing, open(temp_csv, 'wb') as widened:
+        read_csv_header(existing)
+        widened.write(format_csv_row(columns))
+        copy_csv_rows(existing, output['columns'], columns, widened)
+    os.replace(temp_csv, output['path'])
+
+    output['file'] = open(output['path'], 'ab')
+    output['start'] = output['file'].tell()
+    output['columns'] = columns
+    output['ends_with_newline'] = True
+
+
+def read_csv_header(stream):
+    """
+    Reads the header of a CSV file, leaving the stream at its first row.
+
+    Args:
+        stream: Binary file object positioned at the start of the CSV file.
+    Returns:
+        tuple: (column names, raw header line), or None for an empty file.
+    """
+    header_line = stream.readline()
+    if header_line.startswith(UTF8_BOM):
+        header_line = header_line[len(UTF8_BOM):]
+    if not header_line.strip():
+        return None
+
+    return next(csv.reader([header_line.decode('utf-8', errors='replace')])), header_line
+
+
+def copy_csv_rows(stream, names, columns, output, ends_with_newline=True, defaults=None):
+    """
+    Appends the remaining rows of a CSV stream to an output file with the given columns.
+
+    Rows are copied as raw bytes when the stream has exactly these columns and are remapped with the csv module
+    otherwise.
+
+    Args:
+        stream: Binary file object positioned after the header.
+        names (list): Columns of the stream.
+        columns (list): Columns of the output file.
+        output: Output file opened in binary mode, positioned at its end.
+        ends_with_newline (bool): Whether the output currently ends with a line break.
+        defaults (dict): Values of the output columns the stream lacks, empty by default.
+    Returns:
+        bool: Whether the output ends with a line break after the copy.
+    """
+    if names == columns:
+        block = stream.read(CSV_COPY_BUFFER_SIZE)
+        if not block:
+            return ends_with_newline
+        if not ends_with_newline:
+            output.write(b'\n')
+        while block:
+            output.write(block)
+            ends_with_newline = block.endswith(b'\n')
+            block = stream.read(CSV_COPY_BUFFER_SIZE)
+        return ends_with_newline
+
+    if not ends_with_newline:
+        output.write(b'\n')
+    positions = [names.index(column) if column in names else None for column in columns]
+    missing = [(defaults or {}).get(column, '') for column in columns]
+    text = io.TextIOWrapper(stream, encoding='utf-8', errors='replace', newline='')
+    try:
+        for row in csv.reader(text):
+            output.write(format_csv_row([row[position] if position is not None and position < len(row) else value
+                                         for position, value in zip(positions, missing)]))
+    finally:
+        # Leave the stream open for its owner
+        text.detach()
+    return True
+
+
+def format_csv_row(values):
+    """
+    Formats one CSV row, including its line break.
+
+    Args:
+        values (list): Field values of the row.
+    Returns:
+        bytes: The UTF-8 encoded row.
+    """
+    line = io.StringIO()
+    csv.writer(line, lineterminator='\n').writerow(values)
+    return line.getvalue().encode('utf-8')
+
+
+@pipeline_metrics.instrument("dedup")
+def deduplicate_consolidated_csvs(query_id, panelists, dedup_keys=None, num_workers=1):
+    """
+    Drops repeated records from the consolidated CSVs of the given panelists and sorts them by time.
+
+    Overlapping uploads and app retries put the same rows in several zips. Each panelist is a work item, and every
+    file is sorted with a memory-bounded external sort, see external_sort.sort_csv_file.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+        panelists: Names of the panelist folders to deduplicate.
+        dedup_keys (dict): Natural key columns per prefix, defaults to DEDUP_KEYS.
+        num_workers (int): Number of processes deduplicating concurrently.
+    """
+    deduplicate = partial(deduplicate_panelist, query_id=query_id, dedup_keys=dedup_keys or DEDUP_KEYS)
+
+    total_dropped = 0
+    for panelist, result, error in run_work_queue(deduplicate, sorted(panelists), num_workers,
+                                                   desc="Deduplicating panelists"):
+        if error:
+            logging.error(f"Error deduplicating {panelist}: {error}")
+            pipeline_metrics.count(errors=1)
+        else:
+            dropped, size = result
+            pipeline_metrics.count(items=1, nbytes=size)
+            total_dropped += dropped
+    logging.info(f"Dropped {total_dropped} duplicate rows.")
+
+
+def deduplicate_panelist(panelist, query_id, dedup_keys):
+    """
+    Deduplicates and sorts the consolidated CSVs of one panelist, see deduplicate_consolidated_csvs.
+
+    Args:
+        panelist (str): Name of the panelist folder.
+        query_id (str): Unique identifier for the query/download session.
+        dedup_keys (dict): Natural key columns per prefix.
+    Returns:
+        tuple: Number of duplicate rows dropped, and bytes of consolidated CSVs read.
+    """
+    total_dropped, size = 0, 0
+    for prefix in CSV_PREFIXES:
+        combined_csv = os.path.join(consolidated_folder(query_id, panelist), f"{prefix}-consolidated.csv")
+        if os.path.exists(combined_csv):
+            size += os.path.getsize(combined_csv)
+            written, dropped = sort_csv_file(combined_csv, TIME_COLUMNS[prefix], dedup_keys[prefix])
+            logging.info(f"{combined_csv}: kept {written} rows, dropped {dropped} duplicates.")
+            total_dropped += dropped
+    return total_dropped, size
+
+
+@pipeline_metrics.instrument("global")
+def build_global_datasets(query_id, path, num_workers=1):
+    """
+    Builds one study-wide dataset per prefix from the consolidated CSVs of every panelist.
+
+    Rows get the panelist folder, and the tenant, panel and version of the path, as extra columns, and are sorted by
+    time across panelists. The files are written to `<query_id>/combined/global/<prefix>-consolidated.csv` and
+    rebuilt on every run. Each panelist is sorted as its own work item, and the sorted panelists are merged with
+    bounded memory, see external_sort.merge_sorted_csvs.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+        path (str): S3 path the panelists were listed under, see get_bucket_and_path.
+        num_workers (int): Number of processes preparing panelists concurrently.
+    """
+    labels = path_labels(path)
+    global_folder = os.path.join(query_id, 'combined', 'global')
+    os.makedirs(global_folder, exist_ok=True)
+
+    for prefix in CSV_PREFIXES:
+        combined_csvs = sorted(glob.glob(os.path.join(query_id, 'combined', 'panelists', '*', 'metadata',
+                                                      f'{prefix}-consolidated.csv')))
+        if not combined_csvs:
+            continue
+
+        columns = list(GLOBAL_LABEL_COLUMNS)
+        for combined_csv in combined_csvs:
+            with open(combined_csv, 'rb') as file:
+                header = read_csv_header(file)
+            if header:
+                columns.extend(column for column in header[0] if column not in columns)
+
+        with tempfile.TemporaryDirectory(dir=global_folder, prefix=f'.{prefix}-') as run_folder:
+            prepare = partial(prepare_global_run, prefix=prefix, columns=columns, labels=labels,
+                              run_folder=run_folder)
+            runs = []
+            for combined_csv, run_path, error in run_work_queue(prepare, combined_csvs, num_workers,
+                                                                desc=f"Preparing global {prefix}"):
+                if error:
+                    logging.error(f"Error preparing {combined_csv} for the global dataset: {error}")
+                    pipeline_metrics.count(errors=1)
                 else:
-                    df.to_csv(combined_csv, mode='a', header=False, index=False)
+                    pipeline_metrics.count(items=1, nbytes=os.path.getsize(combined_csv))
+                    runs.append(run_path)
 
+            rows = merge_sorted_csvs(sorted(runs), os.path.join(global_folder, f"{prefix}-consolidated.csv"),
+                                     TIME_COLUMNS[prefix])
+        logging.info(f"Wrote {rows} {prefix} rows of {len(runs)} panelists to the global dataset.")
 
-# Step 7: Main function to orchestrate the workflow
-def main():
-    s3 = connect_to_s3()
-    bucket_name, path = get_bucket_and_path()
-    start_date, end_date = get_date_range_from_user()
 
-    zip_batch_size, num_processors, query_id = set_batch_and_processors()
-    download_zip_files_in_batches(s3, bucket_name, path, start_date, end_date, zip_batch_size, num_processors, query_id)
-    process_child_folder_and_unzip_async(query_id)
+def prepare_global_run(combined_csv, prefix, columns, labels, run_folder):
+    """
+    Copies the consolidated CSV of one panelist into the global columns and sorts it by time.
+
+    Args:
+        combined_csv (str): Path of the panelist's consolidated CSV.
+        prefix (str): Prefix of the dataset.
+        columns (list): Columns of the global dataset.
+        labels (dict): Tenant, panel and version of the path, see path_labels.
+        run_folder (str): Folder the sorted copy is written to.
+    Returns:
+        str: Path of the sorted copy.
+    """
+    panelist = os.path.basename(os.path.dirname(os.path.dirname(combined_csv)))
+    run_path = os.path.join(run_folder, f"{panelist}.csv")
+
+    with open(combined_csv, 'rb') as source, open(run_path, 'wb') as run:
+        run.write(format_csv_row(columns))
+        header = read_csv_header(source)
+        if header:
+            copy_csv_rows(source, header[0], columns, run, defaults={'panelist_id': panelist, **labels})
+
+    sort_csv_file(run_path, TIME_COLUMNS[prefix])
+    return run_path
+
+
+def path_labels(path):
+    """
+    Reads the tenant, panel and app version folders out of an S3 path, see get_bucket_and_path.
+
+    Args:
+        path (str): Path such as academia/tenant/<tenantId>_<tenantName>/panel/<panelId>/<buildVersion>/.
+    Returns:
+        dict: tenant, panel and version, empty for the parts the path does not go down to.
+    """
+    parts = [part for part in path.split('/') if part]
+    labels = dict.fromkeys(("tenant", "panel", "version"), "")
+    for name in ("tenant", "panel"):
+        if name in parts[:-1]:
+            labels[name] = parts[parts.index(name) + 1]
+    if "panel" in parts:
+        version_index = parts.index("panel") + 2
+        if version_index < len(parts) and parts[version_index] != "panelist":
+            labels["version"] = parts[version_index]
+    return labels
+
+
+def remove_consolidated_csvs(query_id):
+    """
+    Deletes the consolidated CSVs of every panelist, so a full rerun rebuilds them from scratch.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+    """
+    for combined_csv in glob.glob(os.path.join(query_id, 'combined', 'panelists', '*', 'metadata',
+                                               '*-consolidated.csv')):
+        os.remove(combined_csv)
+
 
-    result = process_child_folders_csvs(os.path.join(query_id, 'unzipped'))
-    combine_csv_files(result, query_id)
+@pipeline_metrics.instrument("sentiment")
+def write_sentiment_scores(query_id, lexicon_path, num_workers=1):
+    """
+    Adds valence, arousal and dominance columns to the consolidated text datasets of a query, see
+    sentiment.score_consolidated_csvs.
+
+    pandas is only needed for this stage, so it is imported here rather than at the top of the script.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+        lexicon_path (str): Path of the lexicon, e.g. NRC-VAD-Lexicon.txt.
+        num_workers (int): Number of scoring processes.
+    """
+    try:
+        from sentiment import score_consolidated_csvs
+    except ImportError as e:
+        raise SystemExit(f"--sentiment-lexicon requires pandas, install it with 'pip install pandas' ({e})")
+
+    rows = score_consolidated_csvs(query_id, lexicon_path, num_workers)
+    pipeline_metrics.count(items=rows)
+
+
+@pipeline_metrics.instrument("enrich")
+def write_enriched_screenshots(query_id, num_workers=1):
+    """
+    Writes screenshot_enriched.csv next to the consolidated files of every panelist, giving each screenshot the
+    session and app segment it was taken in, see enrich.enrich_panelists.
+
+    pandas is only needed for this stage, so it is imported here rather than at the top of the script.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+        num_workers (int): Number of joining processes.
+    """
+    try:
+        from enrich import enrich_panelists
+    except ImportError as e:
+        raise SystemExit(f"--enrich requires pandas, install it with 'pip install pandas' ({e})")
+
+    rows = enrich_panelists(query_id, num_workers)
+    pipeline_metrics.count(items=rows)
+
+
+@pipeline_metrics.instrument("accessibility")
+def write_accessibility_tables(query_id, num_workers=1):
+    """
+    Flattens the view hierarchy XML of every panelist's app_accessibility_data into node and screen tables, see
+    accessibility_xml.flatten_accessibility_data.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+        num_workers (int): Number of parsing processes.
+    """
+    from accessibility_xml import flatten_accessibility_data
+
+    screens, nodes = flatten_accessibility_data(query_id, num_workers)
+    pipeline_metrics.count(items=screens)
+    logging.info(f"Flattened {screens} accessibility events into {nodes} nodes.")
+
+
+@pipeline_metrics.instrument("parquet")
+def write_parquet_output(query_id):
+    """
+    Writes the Parquet datasets of a query, see parquet_output.write_parquet_datasets.
+
+    pyarrow is only needed for this output, so it is imported here rather than at the top of the script.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+    """
+    try:
+        from parquet_output import write_parquet_datasets
+    except ImportError as e:
+        raise SystemExit(f"--parquet requires pyarrow, install it with 'pip install pyarrow' ({e})")
+
+    write_parquet_datasets(query_id)
+
+
+@pipeline_metrics.instrument("index")
+def update_time_index(query_id):
+    """
+    Brings the time index of a query up to date, see time_index.build_time_index.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+    """
+    from time_index import build_time_index
+
+    records, images = build_time_index(query_id)
+    pipeline_metrics.count(items=records + images)
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line options of the script.
+
+    Args:
+        argv: Argument list to parse, defaults to sys.argv.
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Download, redact and consolidate panel data from AWS S3.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Extract each zip as soon as it is downloaded instead of staging all zips on disk first.")
+    parser.add_argument("--stream-buffer-mb", type=int, default=64,
+                        help="Megabytes of each zip kept in memory in streaming mode before spilling to a temp file "
+                             "(default: 64).")
+    parser.add_argument("--downloader", choices=["asyncio", "pool"], default="asyncio",
+                        help="Download zips from a single process with an asyncio event loop and a shared "
+                             "connection pool, or on a pool of workers set by --executor (default: asyncio). "
+                             "Streaming mode always uses the pool.")
+    parser.add_argument("--part-size-mb", type=int, default=RANGED_GET_PART_SIZE // (1024 * 1024),
+                        help="With the asyncio downloader, zips larger than this are fetched as parallel ranged "
+                             f"GETs of this many megabytes (default: {RANGED_GET_PART_SIZE // (1024 * 1024)}).")
+    parser.add_argument("--disk-budget-gb", type=float,
+                        help="Stage at most this many gigabytes of zips on disk at once. Downloads pause when the "
+                             "budget is reached until the staged zips are extracted and deleted. Output files are not "
+                             "counted. Default: no limit.")
+    parser.add_argument("--executor", choices=["process", "thread"], default="process",
+                        help="Run pool downloads on a process pool or on a thread pool (default: process).")
+    parser.add_argument("--listing-workers", type=int, default=LISTING_WORKERS,
+                        help=f"Number of panelist folders listed concurrently (default: {LISTING_WORKERS}).")
+    parser.add_argument("--redaction-workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of processes extracting and redacting zips (default: number of CPUs).")
+    parser.add_argument("--autotune", action="store_true",
+                        help="Tune the downloads in flight and the extraction workers between batches of zips, from "
+                             "the measured download throughput, CPU use and free memory. --concurrency and "
+                             "--redaction-workers become the caps, and the processor prompt is skipped. Only "
+                             "applies without --stream.")
+    parser.add_argument("--detect-scale", type=float, default=1.0,
+                        help="Scale images are shrunk to for face detection, e.g. 0.5. Faces smaller than "
+                             "30 pixels divided by this scale are missed (default: 1.0, full resolution).")
+    parser.add_argument("--reuse-threshold", type=float, default=0.0,
+                        help="Reuse the face boxes of the last screenshot detection ran on when a screenshot "
+                             "differs from it by at most this grey level (0-255) in every cell of a 32x32 "
+                             "thumbnail. "
+                             "Default: 0, always run face detection.")
+    parser.add_argument("--image-store", choices=["files", "content"], default="files",
+                        help="'content' stores every distinct screenshot once, redacted, under "
+                             "<query_id>/combined/image_store/blobs by the SHA-256 of its upload and a hash of the "
+                             "redaction and image output settings, with a mapping table in image_store/images.sqlite. "
+                             "The panelists' image folders then hold hard links to the blobs, and screenshots already "
+                             "in the store with the same settings are never redacted again, also across runs "
+                             "(default: files).")
+    parser.add_argument("--max-dimension", type=int,
+                        help="Shrink redacted images so their longest side is at most this many pixels. Faces are "
+                             "still detected and covered at full resolution (default: keep the size).")
+    parser.add_argument("--image-format", choices=sorted(IMAGE_FORMAT_EXTENSIONS),
+                        help="Re-encode redacted images as JPEG or WebP. Their file names get the matching extension "
+                             "(default: keep the uploaded format).")
+    parser.add_argument("--image-quality", type=int,
+                        help="Encoding quality of redacted images from 0 to 100 (default: OpenCV's, 95 for JPEG).")
+    parser.add_argument("--thumbnail-size", type=int,
+                        help="Also write a thumbnail with this longest side for every image, in a thumbnails folder "
+                             "next to the panelist's images folder (default: no thumbnails).")
+    parser.add_argument("--parquet", action="store_true",
+                        help="Also write the consolidated data as zstd-compressed Parquet datasets partitioned by "
+                             "panelist and day under <query_id>/combined/parquet. Requires pyarrow.")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Drop rows repeated across zips from the consolidated files, and sort them by time.")
+    parser.add_argument("--dedup-key", action="append", default=[], metavar="PREFIX=COLUMN[,COLUMN...]",
+                        help="Columns identifying a record of a dataset for --dedup, e.g. "
+                             "session_data=id_user,id_session. Can be repeated, defaults to "
+                             + "; ".join(f"{prefix}={','.join(columns)}" for prefix, columns in DEDUP_KEYS.items())
+                             + ".")
+    parser.add_argument("--sentiment-lexicon", metavar="PATH",
+                        help="Score the text of screenshot_data and app_accessibility_data with a valence, arousal "
+                             "and dominance lexicon such as NRC-VAD-Lexicon.txt, adding valence, arousal, dominance "
+                             "and lexicon_tokens columns to their consolidated files.")
+    parser.add_argument("--enrich", action="store_true",
+                        help="Also write metadata/screenshot_enriched.csv for every panelist, adding to each "
+                             "screenshot the session and app segment it was taken in.")
+    parser.add_argument("--flatten-accessibility", action="store_true",
+                        help="Also parse the view hierarchy XML in app_accessibility_data into "
+                             "metadata/app_accessibility_nodes.csv, one row per node, and "
+                             "metadata/app_accessibility_screens.csv, the visible text of every event.")
+    parser.add_argument("--global-datasets", action="store_true",
+                        help="Also merge every panelist into one dataset per prefix under <query_id>/combined/global, "
+                             "sorted by time, with panelist_id, tenant, panel and version columns.")
+    parser.add_argument("--time-index", action="store_true",
+                        help="Also keep <query_id>/combined/time_index.sqlite up to date, indexing the consolidated "
+                             "rows and images of every panelist by time for time_index.py query.")
+    parser.add_argument("--prometheus-textfile", metavar="PATH",
+                        help="Also write the stage metrics of the run report to this file in the Prometheus text "
+                             "format, e.g. for the node exporter's textfile collector.")
+    parser.add_argument("--profile-stage", action="append", default=[], choices=PROFILED_STAGES,
+                        help="Profile a stage of the main process with cProfile and write <stage>.prof next to the "
+                             "run report. Work done inside pool workers is not profiled. Can be repeated.")
+    parser.add_argument("--bucket", default=DEFAULT_BUCKET_NAME,
+                        help=f"S3 bucket to read from when --path is given (default: {DEFAULT_BUCKET_NAME}).")
+    parser.add_argument("--path",
+                        help="S3 path of the panelists to process, e.g. "
+                             "academia/tenant/<tenant>/panel/<panel>/<version>/. Runs without any prompts: AWS "
+                             "credentials come from the environment or ~/.aws, and the dates and processors from the "
+                             "options below.")
+    parser.add_argument("--start-date", help="Start date (YYYY-MM-DD) with --path, defaults to 1 year ago.")
+    parser.add_argument("--end-date", help="End date (YYYY-MM-DD) with --path, defaults to today.")
+    parser.add_argument("--processors", type=int,
+                        help="Number of processors, instead of the prompt. Defaults to 4 with --path.")
+    parser.add_argument("--query-id",
+                        help="Folder the run writes to. Defaults to an ID derived from the bucket and path, so "
+                             "repeated runs against the same panelists share their sync manifest.")
+    parser.add_argument("--shard", type=parse_shard, metavar="I/N",
+                        help="Only process the panelists of shard I of N (counting from 0), assigned by a stable "
+                             "hash of the panelist folder, e.g. to spread a panel over N machines. The default "
+                             "--query-id gets a -shard-I-of-N suffix; combine the shards with shards.py merge.")
+    parser.add_argument("--stage", action="append", choices=PIPELINE_STAGES,
+                        help="Only run this stage, picking up the objects earlier runs left at the stage before it "
+                             "in the sync manifest: list records the objects in the date range, download fetches "
+                             "the listed zips, extract consolidates their CSVs and redacts their images, and "
+                             "consolidate runs the options that post-process the consolidated files, from --dedup "
+                             "to --time-index. Can be repeated; stages run in this order. extract and consolidate "
+                             "need no S3 access or prompts, and find the run by --query-id or --path. Default: "
+                             "every stage.")
+    parser.add_argument("--full-rerun", action="store_true",
+                        help="Ignore the sync manifest, process every object in the date range again and rebuild "
+                             "the consolidated files.")
+    parser.add_argument("--concurrency", type=int,
+                        help="Number of concurrent downloads. Defaults to the number of processors entered at the "
+                             f"prompt, or {DOWNLOAD_MAX_IN_FLIGHT} requests in flight with the asyncio downloader. "
+                             "Thread pools usually benefit from a much higher value.")
+    args = parser.parse_args(argv)
+
+    args.dedup_keys = dict(DEDUP_KEYS)
+    for value in args.dedup_key:
+        prefix, _, columns = value.partition("=")
+        if prefix not in DEDUP_KEYS or not columns:
+            parser.error(f"--dedup-key expects PREFIX=COLUMN[,COLUMN...] with one of {', '.join(DEDUP_KEYS)}, "
+                         f"got '{value}'")
+        args.dedup_keys[prefix] = tuple(column.strip() for column in columns.split(","))
+
+    stages = set(args.stage or PIPELINE_STAGES)
+    if args.stream and not {"download", "extract"} <= stages:
+        parser.error("--stream downloads and extracts each zip in one go, so it needs both of those stages")
+    if not stages & {"list", "download"} and not (args.query_id or args.path):
+        parser.error("--stage extract and consolidate need --query-id or --path to find the run")
+    return args
+
+
+# Step 7: Main function to orchestrate the workflow
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+
+    stages = set(args.stage or PIPELINE_STAGES)
+    s3 = start_date = end_date = None
+    if not stages & {"list", "download"}:
+        # Later stages work from the manifest and files of earlier runs, so they need neither S3 nor prompts
+        bucket_name, path = args.bucket, args.path
+        processors = args.processors or 4
+    elif args.path:
+        # Non-interactive run, e.g. from scheduled jobs or benchmark.py
+        s3 = new_s3_client()
+        bucket_name, path = args.bucket, args.path
+        if "list" in stages:
+            start_date, end_date = parse_date_range(args.start_date, args.end_date)
+        processors = args.processors or 4
+    else:
+        s3 = connect_to_s3()
+        bucket_name, path = get_bucket_and_path()
+        if "list" in stages:
+            start_date, end_date = get_date_range_from_user()
+        processors = args.processors or (multiprocessing.cpu_count() if args.autotune else None)
+
+    query_id = args.query_id or default_query_id(bucket_name, path)
+    if args.shard and not args.query_id:
+        query_id = f"{query_id}-{shard_name(args.shard)}"
+    num_processors, query_id = set_batch_and_processors(query_id, processors)
+    if s3:
+        update_query_config(query_id, bucket=bucket_name, path=path)
+    else:
+        query_config = read_query_config(query_id)
+        bucket_name, path = query_config.get("bucket", bucket_name), path or query_config.get("path", "")
+    if args.shard:
+        update_query_config(query_id, shard=f"{args.shard[0]}/{args.shard[1]}")
+    num_workers = args.concurrency or num_processors
+    manifest = open_manifest(query_id)
+
+    started_at = datetime.now(pytz.UTC)
+    report_folder = os.path.join(query_id, "reports")
+    run_name = f"run-{started_at.strftime('%Y%m%dT%H%M%SZ')}"
+    pipeline_metrics.configure(args.profile_stage, os.path.join(report_folder, f"{run_name}-profiles"))
+
+    objects = []
+    if "list" in stages:
+        # Listing runs in the background and feeds the downloads as objects are found
+        objects = query_s3_objects_in_date_range(s3, bucket_name, path, start_date, end_date, args.listing_workers,
+                                                 args.shard)
+        if args.shard:
+            # Objects listed outside the shard's panelist folders are assigned one by one
+            objects = (obj for obj in objects if in_shard(obj, args.shard))
+        if args.full_rerun:
+            remove_consolidated_csvs(query_id)
+            # The rows of every object are appended again
+            clear_stage(manifest, "extracted")
+        else:
+            objects = filter_unsynced(manifest, objects)
+        if "download" not in stages:
+            objects = list(objects)
+            mark_stage(manifest, objects, "listed")
+            logging.info(f"Recorded {len(objects)} listed files in the manifest.")
+    elif "download" in stages:
+        objects = pending_objects(manifest, "listed", "downloaded")
+
+    image_store = image_store_folder(query_id) if args.image_store == 'content' else None
+    image_output = new_image_output(args.max_dimension, args.image_format, args.image_quality, args.thumbnail_size)
+
+    # Failed objects are left unmarked, so the next run retries them. Only the objects in synced have their rows in
+    # the consolidated files and all their images redacted, and are marked as consolidated
+    processed, failed, synced = [], [], []
+    tuner = None
+    if args.stream:
+        if args.autotune:
+            logging.warning("--autotune only tunes staged runs, streaming with the configured workers.")
+        processed, failed = stream_zip_files(objects, bucket_name, num_workers, query_id,
+                                             args.stream_buffer_mb * 1024 * 1024, args.executor, args.detect_scale,
+                                             args.reuse_threshold, image_store, image_output,
+                                             completed_keys(manifest, "extracted"),
+                                             lambda obj: mark_stage(manifest, [obj], "extracted"))
+        for stage in ("downloaded", "redacted"):
+            mark_stage(manifest, processed, stage)
+        synced = processed
+    elif "download" in stages:
+        if args.downloader == 'asyncio':
+            num_workers = args.concurrency or DOWNLOAD_MAX_IN_FLIGHT
+        budget_bytes = int(args.disk_budget_gb * 1024 ** 3) if args.disk_budget_gb else None
+        download_concurrency, extraction_workers = num_workers, args.redaction_workers
+        tuner = new_autotune_state(num_workers, args.redaction_workers) if args.autotune and "extract" in stages \
+            else None
+        if tuner:
+            # The tuner decides between batches, so a run without a disk budget is split into batches too
+            budget_bytes = budget_bytes or AUTOTUNE_BATCH_BYTES
+
+        # With a disk budget the listing pauses after each batch of zips until they are extracted and released
+        for batch in staged_batches(objects, budget_bytes):
+            if tuner:
+                download_concurrency, extraction_workers = tuner["downloads"], tuner["workers"]
+            download_started = time.monotonic()
+            downloaded, download_failed = download_zip_files(batch, bucket_name, download_concurrency, query_id,
+                                                             args.executor, args.downloader,
+                                                             args.part_size_mb * 1024 * 1024)
+            download_seconds = time.monotonic() - download_started
+            failed += download_failed
+            mark_stage(manifest, downloaded, "downloaded")
+            processed += downloaded
+            if "extract" not in stages:
+                continue
 
-    delete_folder(os.path.join(query_id, "unzipped"))
-    delete_folder(os.path.join(query_id, "zipped"))
+            extract_started, cpu_before = time.monotonic(), pipeline_metrics.process_cpu_seconds()
+            synced += extract_downloaded(manifest, query_id, downloaded, extraction_workers, args.detect_scale,
+                                         args.reuse_threshold, image_store, image_output)
+            if tuner:
+                record_batch(tuner, sum(obj.get('Size') or 0 for obj in downloaded), download_seconds,
+                             pipeline_metrics.process_cpu_seconds() - cpu_before, time.monotonic() - extract_started,
+                             pipeline_metrics.peak_rss_mb() * 1024 ** 2, multiprocessing.cpu_count())
+    elif "extract" in stages:
+        # Zips released or lost since they were downloaded are left for a run that downloads them again
+        processed = [obj for obj in pending_objects(manifest, "downloaded", "extracted")
+                     if os.path.exists(local_zip_path(query_id, obj['Key']))]
+        synced = extract_downloaded(manifest, query_id, processed, args.redaction_workers, args.detect_scale,
+                                    args.reuse_threshold, image_store, image_output)
+
+    if "download" in stages:
+        update_query_config(query_id, numFilesToDownload=len(processed) + len(failed),
+                            numFilesDownloaded=len(processed))
+
+    if "consolidate" in stages:
+        if "extract" not in stages:
+            synced = pending_objects(manifest, "redacted", "consolidated")
+        if args.dedup:
+            deduplicate_consolidated_csvs(query_id, group_zips_by_panelist(query_id, synced), args.dedup_keys,
+                                          multiprocessing.cpu_count())
+        if args.sentiment_lexicon:
+            write_sentiment_scores(query_id, args.sentiment_lexicon, multiprocessing.cpu_count())
+        if args.enrich:
+            write_enriched_screenshots(query_id, multiprocessing.cpu_count())
+        if args.flatten_accessibility:
+            write_accessibility_tables(query_id, multiprocessing.cpu_count())
+        if args.global_datasets:
+            build_global_datasets(query_id, path, multiprocessing.cpu_count())
+        if args.parquet:
+            write_parquet_output(query_id)
+        if args.time_index:
+            update_time_index(query_id)
+        mark_stage(manifest, synced, "consolidated")
+    finished_at = datetime.now(pytz.UTC)
+    if "consolidate" in stages:
+        update_query_config(query_id, lastSyncedAt=finished_at.isoformat())
+    manifest.close()
+
+    run_report = pipeline_metrics.write_run_report(
+        os.path.join(report_folder, f"{run_name}.json"), query_id=query_id, bucket=bucket_name, path=path,
+        start_date=start_date.isoformat() if start_date else None,
+        end_date=end_date.isoformat() if end_date else None, arguments=vars(args),
+        stages=[stage for stage in PIPELINE_STAGES if stage in stages], started_at=started_at.isoformat(),
+        finished_at=finished_at.isoformat(), wall_seconds=(finished_at - started_at).total_seconds(),
+        objects_processed=len(processed), objects_failed=len(failed),
+        autotune=tuner["history"] if tuner else None)
+    logging.info(f"Run report written to {os.path.join(report_folder, run_name + '.json')}.")
+    if args.prometheus_textfile:
+        pipeline_metrics.write_prometheus_textfile(args.prometheus_textfile, run_report)
+
+    if "extract" in stages:
+        # Zips downloaded by a run without the extract stage are kept for the run that extracts them
+        delete_folder(os.path.join(query_id, "zipped"))
 
 
 if __name__ == "__main__":
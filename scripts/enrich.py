@@ -0,0 +1,174 @@
+import glob
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from external_sort import to_epoch_ms
+
+# Name of the enriched screenshot table written next to each panelist's consolidated files
+ENRICHED_SCREENSHOTS_FILE = "screenshot_enriched.csv"
+
+# Columns appended to every screenshot row: the session and the app segment it was taken in, by timestamp
+ENRICHED_COLUMNS = ["session_id", "session_start_ms", "session_end_ms",
+                    "segment_id", "segment_apk", "segment_start_ms", "segment_end_ms"]
+
+
+def read_intervals(csv_path, start_column, end_column, duration_column, id_column, extra_columns=None):
+    """
+    Reads the time intervals of a consolidated file, sorted by start.
+
+    An interval ends at its end column, or at its start plus its duration when the file has no end column. When it
+    has neither, an interval lasts until the next one starts.
+
+    Args:
+        csv_path (str): Path of the consolidated file.
+        start_column (str): Column of the interval start.
+        end_column (str): Column of the interval end.
+        duration_column (str): Column of the interval duration in milliseconds.
+        id_column (str): Column identifying the interval.
+        extra_columns (dict): More columns to keep, mapped to their output names.
+    Returns:
+        pandas.DataFrame: Columns start, end, id and the extra columns, without rows lacking a start. Empty when the
+        file is missing or lacks its start column.
+    """
+    extra_columns = extra_columns or {}
+    data = pd.read_csv(csv_path, dtype=str, keep_default_na=False, encoding_errors="replace") \
+        if os.path.exists(csv_path) else pd.DataFrame()
+    if start_column not in data.columns:
+        data = pd.DataFrame({start_column: pd.Series(dtype=str)})
+
+    intervals = pd.DataFrame({"start": to_epoch_ms(data[start_column])})
+    if end_column in data.columns:
+        intervals["end"] = to_epoch_ms(data[end_column])
+    elif duration_column in data.columns:
+        intervals["end"] = intervals["start"] + pd.to_numeric(data[duration_column], errors="coerce")
+    else:
+        intervals["end"] = np.nan
+    intervals["id"] = data[id_column] if id_column in data.columns else ""
+    for column, name in extra_columns.items():
+        intervals[name] = data[column] if column in data.columns else ""
+    return intervals.dropna(subset=["start"]).sort_values("start", kind="stable").reset_index(drop=True)
+
+
+def join_intervals(times, intervals):
+    """
+    Finds the interval each time falls in, with a backward as-of merge of the sorted times and interval starts.
+
+    Each time is matched to the latest interval starting at or before it, and kept only if that interval has not
+    ended yet; intervals without an end last until the next one starts. This is a single linear pass over both.
+
+    Args:
+        times (pandas.Series): Sorted epoch milliseconds, without missing values.
+        intervals (pandas.DataFrame): Sorted intervals, see read_intervals.
+    Returns:
+        pandas.DataFrame: The interval columns per time, with the index of times. Empty values where no interval
+        encloses the time.
+    """
+    matched = pd.merge_asof(pd.DataFrame({"time": times.to_numpy()}), intervals, left_on="time", right_on="start",
+                            direction="backward")
+    outside = matched["start"].isna() | (matched["end"].notna() & (matched["time"] > matched["end"]))
+    matched = matched.drop(columns="time").astype(object).where(~outside, "")
+    matched.index = times.index
+    return matched
+
+
+def format_ms(values):
+    """
+    Formats float epoch milliseconds as integer strings, leaving empty values empty.
+    """
+    return values.map(lambda value: "" if value == "" or pd.isna(value) else str(int(value)))
+
+
+def enrich_panelist(metadata_folder):
+    """
+    Writes the enriched screenshot table of one panelist, joining every screenshot to its session and app segment.
+
+    The panelist's screenshots, sessions and segments are loaded and sorted by time, and joined with as-of merges,
+    see join_intervals, so memory is bounded by one panelist's data and the join is linear after sorting.
+    Screenshots without a readable time are kept at the end, without session or segment.
+
+    Args:
+        metadata_folder (str): Folder of the panelist's consolidated files.
+    Returns:
+        int: Number of screenshots written, 0 if the panelist has no screenshot data.
+    """
+    screenshot_csv = os.path.join(metadata_folder, "screenshot_data-consolidated.csv")
+    if not os.path.exists(screenshot_csv):
+        return 0
+    screenshots = pd.read_csv(screenshot_csv, dtype=str, keep_default_na=False, encoding_errors="replace")
+    if "t_epoch_ts_ms" not in screenshots.columns:
+        return 0
+
+    times = to_epoch_ms(screenshots["t_epoch_ts_ms"])
+    order = times.sort_values(kind="stable").index
+    screenshots, times = screenshots.loc[order], times.loc[order]
+    timed = times.dropna()
+
+    sessions = read_intervals(os.path.join(metadata_folder, "session_data-consolidated.csv"),
+                              "session_start", "session_end", "session_duration_ms", "id_session")
+    segments = read_intervals(os.path.join(metadata_folder, "app_segment_data-consolidated.csv"),
+                              "t_unix_ts_segment_start", "t_unix_ts_segment_end", "duration_segment_ms", "id_segment",
+                              {"apk": "apk"})
+    session = join_intervals(timed, sessions)
+    segment = join_intervals(timed, segments)
+
+    enriched = pd.DataFrame({
+        "session_id": session["id"],
+        "session_start_ms": format_ms(session["start"]),
+        "session_end_ms": format_ms(session["end"]),
+        "segment_id": segment["id"],
+        "segment_apk": segment["apk"],
+        "segment_start_ms": format_ms(segment["start"]),
+        "segment_end_ms": format_ms(segment["end"]),
+    }, index=screenshots.index).fillna("")
+    screenshots = screenshots.drop(columns=[column for column in ENRICHED_COLUMNS if column in screenshots.columns])
+
+    output_path = os.path.join(metadata_folder, ENRICHED_SCREENSHOTS_FILE)
+    temp_path = output_path + ".tmp"
+    pd.concat([screenshots, enriched], axis=1).to_csv(temp_path, index=False, lineterminator="\n")
+    os.replace(temp_path, output_path)
+    return len(screenshots)
+
+
+def needs_enrichment(metadata_folder):
+    """
+    Returns whether the enriched screenshot table of a panelist is missing or older than the files it joins.
+    """
+    output_path = os.path.join(metadata_folder, ENRICHED_SCREENSHOTS_FILE)
+    if not os.path.exists(output_path):
+        return True
+    inputs = [os.path.join(metadata_folder, f"{prefix}-consolidated.csv")
+              for prefix in ("screenshot_data", "session_data", "app_segment_data")]
+    built = os.path.getmtime(output_path)
+    return any(os.path.exists(path) and os.path.getmtime(path) > built for path in inputs)
+
+
+def enrich_panelists(query_id, num_workers=1):
+    """
+    Writes the enriched screenshot table of every panelist whose consolidated files changed since it was written.
+
+    Each panelist is joined by one worker process, so a worker holds at most one panelist's data at a time.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+        num_workers (int): Number of worker processes.
+    Returns:
+        int: Number of screenshots written.
+    """
+    folders = [folder for folder in sorted(glob.glob(os.path.join(query_id, "combined", "panelists", "*", "metadata")))
+               if needs_enrichment(folder)]
+    total = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = {pool.submit(enrich_panelist, folder): folder for folder in folders}
+        for future in as_completed(futures):
+            try:
+                rows = future.result()
+            except (ValueError, KeyError, OSError) as e:
+                logging.error(f"Error enriching the screenshots in {futures[future]}: {e}")
+                continue
+            logging.info(f"Enriched {rows} screenshots in {futures[future]}.")
+            total += rows
+    return total
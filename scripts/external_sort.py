@@ -0,0 +1,271 @@
+import contextlib
+import csv
+import heapq
+import itertools
+import logging
+import os
+import sys
+import tempfile
+
+# Column each consolidated dataset is ordered by. Epoch columns are in milliseconds, except for some older
+# app_segment_data files in seconds; session_start is an ISO 8601 UTC string.
+TIME_COLUMNS = {
+    "screenshot_data": "t_epoch_ts_ms",
+    "app_accessibility_data": "t_unix_ts_ms",
+    "app_segment_data": "t_unix_ts_segment_start",
+    "session_data": "session_start",
+}
+
+# Natural key identifying a record of each dataset, used to drop rows repeated across overlapping uploads
+DEDUP_KEYS = {
+    "screenshot_data": ("id_user", "t_epoch_ts_ms", "file"),
+    "app_accessibility_data": ("id_user", "t_unix_ts_ms", "type", "text"),
+    "app_segment_data": ("id_user", "t_unix_ts_segment_start", "id_segment"),
+    "session_data": ("id_user", "session_start", "id_session"),
+}
+
+# Rows sorted in memory at a time; larger files are sorted in runs that are merged from temp files
+SORT_RUN_ROWS = 200_000
+
+# Sorted files merged at once; more are merged in several passes to bound the number of open files
+MERGE_FAN_IN = 64
+
+# Epoch values below this are in seconds rather than milliseconds (1e11 ms is early 1973)
+EPOCH_SECONDS_LIMIT = 10 ** 11
+
+# Accessibility text can be far longer than the csv module's default field limit. Set here once for every module
+# that reads consolidated CSVs, as they all import this one
+csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+
+
+def to_epoch_ms(values):
+    """
+    Converts time values as written by the app to epoch milliseconds.
+
+    pandas is imported on first use, so sorting and merging never load it.
+
+    Args:
+        values (pandas.Series): Epoch milliseconds or seconds, or ISO 8601 strings such as session_start. Naive
+            ISO times are taken as UTC.
+    Returns:
+        pandas.Series: Float milliseconds, NaN where the value is missing or cannot be parsed.
+    """
+    import pandas as pd
+
+    numbers = pd.to_numeric(values, errors="coerce").replace([float("inf"), float("-inf")], float("nan"))
+    numbers = numbers.where(numbers.abs() >= EPOCH_SECONDS_LIMIT, numbers * 1000)
+    # The app writes missing values as "null" or "NA"
+    text = values[numbers.isna() & ~values.isin(["", "null", "NA"])]
+    if len(text):
+        # Parsed one by one, as the ISO format of a column is not always the same on every row
+        times = pd.to_datetime(text, utc=True, errors="coerce", format="ISO8601")
+        milliseconds = (times - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(milliseconds=1)
+        numbers[text.index] = milliseconds.astype("float64")
+    return numbers.astype("float64")
+
+
+def time_sort_key(value):
+    """
+    Sort key of a time value, ordering epoch seconds and milliseconds alike and ISO strings by their text.
+
+    Args:
+        value (str): Time value as written in the CSV.
+    Returns:
+        tuple: Numbers first, then other text, then missing values.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        return (1, 0.0, value) if value and value not in ("null", "NA") else (2, 0.0, "")
+    return 0, number * 1000 if abs(number) < EPOCH_SECONDS_LIMIT else number, ""
+
+
+def sort_csv_file(csv_path, time_column, key_columns=None, run_rows=SORT_RUN_ROWS):
+    """
+    Sorts a CSV file by time in place, optionally dropping rows with the same natural key and time.
+
+    Sorting is stable and the first of several duplicate rows is kept. Memory is bounded by run_rows: longer files are
+    sorted in runs that are spilled to temp files next to the CSV and merged with heapq.merge.
+
+    Args:
+        csv_path (str): Path of the CSV file.
+        time_column (str): Column to sort by, rows keep their order if the file lacks it.
+        key_columns (tuple): Columns identifying a record, or None to keep duplicate rows. Columns missing from the
+            file are ignored, and the whole row is the key when none of them is present.
+        run_rows (int): Rows sorted in memory at a time.
+    Returns:
+        tuple: (rows written, duplicate rows dropped)
+    """
+    with open(csv_path, newline='', encoding='utf-8', errors='replace') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader, None)
+        if header is None:
+            return 0, 0
+
+        order = row_sort_key(header, time_column, key_columns)
+        folder = os.path.dirname(os.path.abspath(csv_path))
+        with tempfile.TemporaryDirectory(dir=folder, prefix='.sort-') as run_folder:
+            runs = []
+            while True:
+                rows = list(itertools.islice(reader, run_rows))
+                if not rows:
+                    break
+                rows.sort(key=order)
+                runs.append(write_run(rows, run_folder, f"run-{len(runs)}"))
+
+            # Very long files are merged in several passes, so no more than MERGE_FAN_IN runs are open at once
+            level = 0
+            while len(runs) > MERGE_FAN_IN:
+                groups = [runs[start:start + MERGE_FAN_IN] for start in range(0, len(runs), MERGE_FAN_IN)]
+                runs = [write_run(heapq.merge(*read_runs(group), key=order), run_folder, f"merge-{level}-{number}")
+                        for number, group in enumerate(groups)]
+                level += 1
+
+            temp_csv = csv_path + '.tmp'
+            with open(temp_csv, 'w', newline='', encoding='utf-8') as output:
+                writer = csv.writer(output, lineterminator='\n')
+                writer.writerow(header)
+                written, dropped = write_merged(read_runs(runs), order, writer, key_columns is not None)
+    os.replace(temp_csv, csv_path)
+    return written, dropped
+
+
+def row_sort_key(header, time_column, key_columns=None):
+    """
+    Builds the key rows of a CSV file are sorted by: its time, then its natural key.
+
+    Args:
+        header (list): Column names of the file.
+        time_column (str): Time column, see sort_csv_file.
+        key_columns (tuple): Natural key columns, see sort_csv_file.
+    Returns:
+        callable: Function of a row returning its sort key.
+    """
+    time_index = header.index(time_column) if time_column in header else None
+    key_indexes = [header.index(column) for column in key_columns or () if column in header]
+    if key_columns and not key_indexes:
+        logging.warning(f"None of the key columns {', '.join(key_columns)} are present, deduplicating on whole rows.")
+
+    def sort_key(row):
+        time = time_sort_key(row[time_index]) if time_index is not None and time_index < len(row) else (2, 0.0, "")
+        if key_indexes:
+            return time, tuple(row[index] if index < len(row) else "" for index in key_indexes)
+        return time, tuple(row) if key_columns else ()
+
+    return sort_key
+
+
+def write_run(rows, run_folder, name):
+    """
+    Writes one sorted run to a temp file.
+
+    Args:
+        rows: Iterable of sorted rows.
+        run_folder (str): Folder of the temp files.
+        name (str): Name of the run, unique within run_folder.
+    Returns:
+        str: Path of the run file.
+    """
+    run_path = os.path.join(run_folder, f"{name}.csv")
+    with open(run_path, 'w', newline='', encoding='utf-8') as run_file:
+        csv.writer(run_file, lineterminator='\n').writerows(rows)
+    return run_path
+
+
+def read_runs(run_paths):
+    """
+    Opens sorted run files as row iterators, which close their file once exhausted.
+
+    Args:
+        run_paths (list): Paths of the run files, in the order they were written.
+    Returns:
+        list: One row iterator per run.
+    """
+    def rows(run_path):
+        with open(run_path, newline='', encoding='utf-8') as run_file:
+            yield from csv.reader(run_file)
+
+    return [rows(run_path) for run_path in run_paths]
+
+
+def write_merged(runs, order, writer, dedup=False):
+    """
+    Merges sorted row iterators into a CSV writer, optionally skipping rows whose sort key repeats.
+
+    Args:
+        runs (list): Row iterators, each sorted by order. Equal rows are taken from earlier iterators first.
+        order (callable): Sort key of a row, see row_sort_key.
+        writer: csv.writer of the output.
+        dedup (bool): Drop rows with the same sort key as the row written before them.
+    Returns:
+        tuple: (rows written, duplicate rows dropped)
+    """
+    written, dropped, previous = 0, 0, None
+    for row in heapq.merge(*runs, key=order):
+        if dedup:
+            key = order(row)
+            if key == previous:
+                dropped += 1
+                continue
+            previous = key
+        writer.writerow(row)
+        written += 1
+    return written, dropped
+
+
+def merge_sorted_csvs(csv_paths, output_path, time_column, fan_in=MERGE_FAN_IN, key_columns=None):
+    """
+    Merges CSV files with the same header, each sorted by time, into one file sorted by time.
+
+    At most fan_in files are open at once; longer lists are merged in groups into temp files next to the output first.
+
+    Args:
+        csv_paths (list): Paths of the sorted files. Rows with the same time are taken from earlier files first.
+        output_path (str): Path of the merged file.
+        time_column (str): Column the files are sorted by.
+        fan_in (int): Files merged at once.
+        key_columns (tuple): Columns ordering rows with the same time across files, which every file must already
+            be sorted by. Rows with the same time are taken from earlier files first when None.
+    Returns:
+        int: Number of rows written.
+    """
+    folder = os.path.dirname(os.path.abspath(output_path))
+    with tempfile.TemporaryDirectory(dir=folder, prefix='.merge-') as merge_folder:
+        level = 0
+        while len(csv_paths) > fan_in:
+            groups = [csv_paths[start:start + fan_in] for start in range(0, len(csv_paths), fan_in)]
+            csv_paths = [os.path.join(merge_folder, f"merge-{level}-{number}.csv") for number in range(len(groups))]
+            for group, merged_path in zip(groups, csv_paths):
+                merge_csv_group(group, merged_path, time_column, key_columns)
+            level += 1
+        return merge_csv_group(csv_paths, output_path, time_column, key_columns)
+
+
+def merge_csv_group(csv_paths, output_path, time_column, key_columns=None):
+    """
+    Merges a group of sorted CSV files with the same header, see merge_sorted_csvs.
+
+    Args:
+        csv_paths (list): Paths of the sorted files.
+        output_path (str): Path of the merged file.
+        time_column (str): Column the files are sorted by.
+        key_columns (tuple): Columns ordering rows with the same time, see merge_sorted_csvs.
+    Returns:
+        int: Number of rows written.
+    """
+    temp_path = output_path + '.tmp'
+    with contextlib.ExitStack() as stack:
+        readers = [csv.reader(stack.enter_context(open(csv_path, newline='', encoding='utf-8', errors='replace')))
+                   for csv_path in csv_paths]
+        headers = [next(reader, None) for reader in readers]
+        header = next((header for header in headers if header), None)
+
+        written = 0
+        with open(temp_path, 'w', newline='', encoding='utf-8') as output:
+            if header is not None:
+                writer = csv.writer(output, lineterminator='\n')
+                writer.writerow(header)
+                runs = [reader for reader, file_header in zip(readers, headers) if file_header]
+                written, _ = write_merged(runs, row_sort_key(header, time_column, key_columns), writer)
+    os.replace(temp_path, output_path)
+    return written
@@ -0,0 +1,211 @@
+import csv
+import glob
+import logging
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+
+from external_sort import EPOCH_SECONDS_LIMIT, TIME_COLUMNS
+
+# Declared column types of each consolidated dataset, following the CSVs written by the app.
+# Columns missing here (older or newer app versions) are kept as strings.
+PARQUET_SCHEMAS = {
+    "screenshot_data": {
+        "id_user": pa.string(),
+        "file": pa.string(),
+        "zipFileId": pa.string(),
+        "apk": pa.string(),
+        "id_session": pa.string(),
+        "id_segment": pa.string(),
+        "app": pa.string(),
+        "text": pa.string(),
+        "weekday": pa.string(),
+        "t_epoch_ts_ms": pa.int64(),
+        "t_natural_utc_ts": pa.string(),
+        "t_natural_second_ts": pa.string(),
+        "t_natural_day_ts": pa.string(),
+        "valence": pa.float64(),
+        "arousal": pa.float64(),
+        "dominance": pa.float64(),
+        "lexicon_tokens": pa.int64(),
+    },
+    "app_accessibility_data": {
+        "id_user": pa.string(),
+        "type": pa.string(),
+        "t_unix_ts_ms": pa.int64(),
+        "apk": pa.string(),
+        "id_session": pa.string(),
+        "id_interval": pa.string(),
+        "text": pa.string(),
+        "valence": pa.float64(),
+        "arousal": pa.float64(),
+        "dominance": pa.float64(),
+        "lexicon_tokens": pa.int64(),
+    },
+    "app_segment_data": {
+        "apk": pa.string(),
+        "t_unix_ts_segment_start": pa.int64(),
+        "t_unix_ts_segment_end": pa.int64(),
+        "duration_segment_ms": pa.int64(),
+        "id_session": pa.string(),
+        "id_segment": pa.string(),
+        "apk_prev_1": pa.string(),
+        "apk_prev_2": pa.string(),
+        "apk_prev_3": pa.string(),
+        "apk_prev_4": pa.string(),
+        "apk_next_1": pa.string(),
+        "id_user": pa.string(),
+    },
+    "session_data": {
+        "id_user": pa.string(),
+        "session_start": pa.string(),
+        "session_end": pa.string(),
+        "id_session": pa.string(),
+        "seconds_since_last_active_ms": pa.int64(),
+        "session_duration_ms": pa.int64(),
+        "session_count_per_day": pa.int64(),
+        "interval": pa.string(),
+        "id_panel": pa.string(),
+        "id_tenant": pa.string(),
+        "t_natural_second_session_start": pa.string(),
+        "t_natural_day_session_start": pa.string(),
+        "t_natural_second_session_end": pa.string(),
+        "t_natural_day_session_end": pa.string(),
+    },
+}
+
+# Values read as null in typed columns. The app writes Kotlin nulls as "null" and missing apps as "NA".
+PARQUET_NULL_VALUES = ["", "null", "NA"]
+
+# Rows per Parquet row group, each with its own min/max statistics for skipping by time range
+PARQUET_ROW_GROUP_SIZE = 128 * 1024
+
+# Partition columns added to every dataset
+PARQUET_PARTITIONING = ds.partitioning(pa.schema([("panelist_id", pa.string()), ("day", pa.string())]),
+                                       flavor="hive")
+
+
+def write_parquet_datasets(query_id, compression="zstd"):
+    """
+    Converts every consolidated CSV of a query into compressed Parquet datasets, one per prefix.
+
+    Each dataset is partitioned by panelist and by day, as
+    `<query_id>/combined/parquet/<prefix>/panelist_id=<folder>/day=<YYYY-MM-DD>/part-<n>.parquet`.
+    A panelist's partitions are rewritten from its full consolidated CSV every time.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+        compression (str): Parquet compression codec.
+    """
+    pattern = os.path.join(query_id, "combined", "panelists", "*", "metadata", "*-consolidated.csv")
+    for combined_csv in sorted(glob.glob(pattern)):
+        prefix = os.path.basename(combined_csv)[:-len("-consolidated.csv")]
+        if prefix not in PARQUET_SCHEMAS:
+            continue
+
+        panelist = os.path.basename(os.path.dirname(os.path.dirname(combined_csv)))
+        output_folder = os.path.join(query_id, "combined", "parquet", prefix)
+        try:
+            rows = write_panelist_parquet(combined_csv, prefix, panelist, output_folder, compression)
+            logging.info(f"Wrote {rows} {prefix} rows of {panelist} to Parquet.")
+        except (pa.ArrowInvalid, ValueError) as e:
+            logging.error(f"Error converting {combined_csv} to Parquet: {e}")
+
+
+def write_panelist_parquet(combined_csv, prefix, panelist, output_folder, compression="zstd"):
+    """
+    Streams one consolidated CSV into the panelist's partitions of a Parquet dataset.
+
+    Args:
+        combined_csv (str): Path of the consolidated CSV.
+        prefix (str): Dataset prefix, a key of PARQUET_SCHEMAS.
+        panelist (str): Panelist folder name, stored as the panelist_id partition.
+        output_folder (str): Root folder of the prefix's Parquet dataset.
+        compression (str): Parquet compression codec.
+    Returns:
+        int: Number of rows written.
+    """
+    with open(combined_csv, newline="") as csv_file:
+        header = next(csv.reader(csv_file), None)
+    if not header:
+        return 0
+
+    schema = PARQUET_SCHEMAS[prefix]
+    column_types = {column: schema.get(column, pa.string()) for column in header}
+    reader = pacsv.open_csv(
+        combined_csv,
+        read_options=pacsv.ReadOptions(block_size=16 * 1024 * 1024),
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(column_types=column_types, null_values=PARQUET_NULL_VALUES,
+                                             strings_can_be_null=False),
+    )
+
+    time_column = TIME_COLUMNS[prefix]
+    output_schema = reader.schema.append(pa.field("panelist_id", pa.string())).append(pa.field("day", pa.string()))
+    row_count = 0
+
+    def batches():
+        nonlocal row_count
+        for batch in reader:
+            row_count += batch.num_rows
+            day = partition_day(batch.column(time_column)) if time_column in header \
+                else pa.nulls(batch.num_rows, pa.string())
+            yield pa.RecordBatch.from_arrays(
+                batch.columns + [pa.array([panelist] * batch.num_rows, pa.string()), day], schema=output_schema)
+
+    # Replace whatever an earlier run wrote for this panelist
+    shutil.rmtree(os.path.join(output_folder, f"panelist_id={panelist}"), ignore_errors=True)
+
+    ds.write_dataset(
+        batches(),
+        output_folder,
+        schema=output_schema,
+        format="parquet",
+        partitioning=PARQUET_PARTITIONING,
+        basename_template="part-{i}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        file_options=ds.ParquetFileFormat().make_write_options(compression=compression),
+        max_rows_per_group=PARQUET_ROW_GROUP_SIZE,
+        min_rows_per_group=min(PARQUET_ROW_GROUP_SIZE, 16 * 1024),
+    )
+    return row_count
+
+
+def partition_day(times):
+    """
+    Computes the UTC day partition of a batch from its time column.
+
+    Args:
+        times (pyarrow.Array): Epoch milliseconds or seconds, or ISO 8601 strings.
+    Returns:
+        pyarrow.Array: Days as YYYY-MM-DD strings, null where the time is missing.
+    """
+    if pa.types.is_string(times.type):
+        return pc.utf8_slice_codeunits(times, 0, 10)
+
+    millis = pc.if_else(pc.less(times, EPOCH_SECONDS_LIMIT), pc.multiply(times, 1000), times)
+    return pc.strftime(pc.cast(millis, pa.timestamp("ms", tz="UTC")), format="%Y-%m-%d")
+
+
+def read_parquet_dataset(query_id, prefix, **filters):
+    """
+    Loads a Parquet dataset written by write_parquet_datasets, reading only the matching partitions.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+        prefix (str): Dataset prefix, e.g. "screenshot_data".
+        **filters: Partition values to keep, e.g. panelist_id="abc", day="2024-05-01".
+    Returns:
+        pyarrow.Table: The matching rows.
+    """
+    dataset = ds.dataset(os.path.join(query_id, "combined", "parquet", prefix), format="parquet",
+                         partitioning=PARQUET_PARTITIONING)
+    expression = None
+    for column, value in filters.items():
+        condition = ds.field(column) == value
+        expression = condition if expression is None else expression & condition
+    return dataset.to_table(filter=expression)
@@ -0,0 +1,248 @@
+import contextlib
+import cProfile
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Metrics of every stage run so far in this process, by stage name
+_stages = {}
+
+# Names of the stages currently running, innermost last
+_active = []
+
+# Stages run under cProfile, and the folder their profiles are written to
+_profiling = {"stages": set(), "folder": None}
+
+
+def configure(profile_stages=(), profile_folder=None):
+    """
+    Selects the stages that are profiled with cProfile.
+
+    Profiles only cover the calling process, so work done inside pool workers is not included.
+
+    Args:
+        profile_stages: Names of the stages to profile.
+        profile_folder (str): Folder the `<stage>.prof` files are written to.
+    """
+    _profiling["stages"] = set(profile_stages)
+    _profiling["folder"] = profile_folder
+
+
+def new_stage_metrics():
+    """
+    Returns the empty metrics of a stage.
+    """
+    return {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "items": 0, "bytes": 0, "errors": 0,
+            "workers": {}}
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Measures a block of work as a pipeline stage.
+
+    CPU time includes the pool worker processes that exit during the stage, which the pools of run_work_queue do
+    when they shut down. Stages can be nested, counts and worker time then go to the innermost one.
+
+    Args:
+        name (str): Stage name, e.g. "download".
+    """
+    metrics = _stages.setdefault(name, new_stage_metrics())
+    profiler = cProfile.Profile() if name in _profiling["stages"] else None
+    cpu_before = process_cpu_seconds()
+    started = time.perf_counter()
+    _active.append(name)
+    if profiler:
+        profiler.enable()
+    try:
+        yield metrics
+    finally:
+        if profiler:
+            profiler.disable()
+            os.makedirs(_profiling["folder"], exist_ok=True)
+            profiler.dump_stats(os.path.join(_profiling["folder"], f"{name}.prof"))
+        _active.pop()
+        metrics["calls"] += 1
+        metrics["wall_seconds"] += time.perf_counter() - started
+        metrics["cpu_seconds"] += process_cpu_seconds() - cpu_before
+        metrics["peak_rss_mb"] = peak_rss_mb()
+
+
+def instrument(name):
+    """
+    Decorator running every call of a function as the given stage, see stage.
+
+    Generator functions run interleaved with whatever consumes them, so for them only the wall time until they are
+    exhausted and the number of items they yield are recorded, and they never become the innermost stage.
+
+    Args:
+        name (str): Stage name.
+    """
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                metrics = _stages.setdefault(name, new_stage_metrics())
+                started = time.perf_counter()
+                try:
+                    for item in func(*args, **kwargs):
+                        metrics["items"] += 1
+                        yield item
+                finally:
+                    metrics["calls"] += 1
+                    metrics["wall_seconds"] += time.perf_counter() - started
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(items=0, nbytes=0, errors=0, stage_name=None):
+    """
+    Adds to the item, byte and error counts of a stage.
+
+    Args:
+        items (int): Items handled, e.g. files or images.
+        nbytes (int): Bytes read or written.
+        errors (int): Items that failed.
+        stage_name (str): Stage to count for, defaults to the innermost running stage. Ignored outside of stages.
+    """
+    name = stage_name or (_active[-1] if _active else None)
+    if name is None:
+        return
+    metrics = _stages.setdefault(name, new_stage_metrics())
+    metrics["items"] += items
+    metrics["bytes"] += nbytes
+    metrics["errors"] += errors
+
+
+def timed_call(func, item):
+    """
+    Calls func on a work item inside a pool worker and measures how long the worker was busy with it.
+
+    Args:
+        func: Function of the work item.
+        item: Work item.
+    Returns:
+        tuple: (result, worker id, busy seconds)
+    """
+    started = time.perf_counter()
+    result = func(item)
+    return result, f"{os.getpid()}-{threading.get_ident()}", time.perf_counter() - started
+
+
+def record_worker(worker, busy_seconds):
+    """
+    Adds the busy time of one work item to its worker in the innermost running stage, see timed_call.
+    """
+    if _active:
+        workers = _stages[_active[-1]]["workers"]
+        workers[worker] = workers.get(worker, 0.0) + busy_seconds
+
+
+def process_cpu_seconds():
+    """
+    Returns the user and system CPU time of this process and its exited children.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def peak_rss_mb():
+    """
+    Returns the largest resident set size of this process or any of its exited children, in megabytes.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def report(**run_info):
+    """
+    Builds the run report from the metrics of every stage.
+
+    Args:
+        **run_info: Fields describing the run, e.g. query_id and arguments.
+    Returns:
+        dict: {"run": run_info, "stages": {name: metrics}}, with throughput and worker utilization per stage.
+    """
+    stages = {}
+    for name, metrics in _stages.items():
+        wall = metrics["wall_seconds"]
+        busy = sum(metrics["workers"].values())
+        stages[name] = {
+            **{key: value for key, value in metrics.items() if key != "workers"},
+            "items_per_second": metrics["items"] / wall if wall else None,
+            "bytes_per_second": metrics["bytes"] / wall if wall else None,
+            "worker_count": len(metrics["workers"]),
+            "worker_busy_seconds": busy,
+            # Share of the stage's wall time the workers that took part spent on work items
+            "worker_utilization": busy / (wall * len(metrics["workers"])) if wall and metrics["workers"] else None,
+        }
+    return {"run": {**run_info, "peak_rss_mb": peak_rss_mb()}, "stages": stages}
+
+
+def write_run_report(report_path, **run_info):
+    """
+    Writes the run report as JSON, see report.
+
+    Args:
+        report_path (str): Path of the JSON file.
+        **run_info: Fields describing the run.
+    Returns:
+        dict: The report.
+    """
+    run_report = report(**run_info)
+    os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+    with open(report_path, "w") as report_file:
+        json.dump(run_report, report_file, indent=4)
+    return run_report
+
+
+def write_prometheus_textfile(path, run_report, job="consolidatecsvs"):
+    """
+    Writes the stage metrics of a run report in the Prometheus text format, for the node exporter's textfile
+    collector.
+
+    The file is replaced atomically so the collector never reads a partial file.
+
+    Args:
+        path (str): Path of the .prom file.
+        run_report (dict): Report returned by write_run_report.
+        job (str): Value of the job label.
+    """
+    gauges = {
+        "wall_seconds": "Wall clock time spent in the stage.",
+        "cpu_seconds": "CPU time of the pipeline process and its workers during the stage.",
+        "items": "Items handled by the stage.",
+        "bytes": "Bytes handled by the stage.",
+        "errors": "Items the stage failed on.",
+        "worker_utilization": "Share of the stage's wall time its workers were busy.",
+        "peak_rss_mb": "Peak resident set size of any pipeline process at the end of the stage, in megabytes.",
+    }
+    lines = []
+    for metric, description in gauges.items():
+        name = f"{job}_stage_{metric}"
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+        for stage_name, metrics in run_report["stages"].items():
+            if metrics.get(metric) is not None:
+                lines.append(f'{name}{{job="{job}",stage="{stage_name}"}} {metrics[metric]}')
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as textfile:
+        textfile.write("\n".join(lines) + "\n")
+    os.replace(temp_path, path)
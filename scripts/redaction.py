@@ -0,0 +1,329 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import cv2
+import numpy as np
+
+# Pre-trained face detection model, loaded once per worker by get_face_cascade
+FACE_CASCADE_PATH = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+
+# Side of the grey thumbnail compared between consecutive frames for temporal reuse
+FRAME_SIGNATURE_SIZE = 32
+
+# Hex digits of the redaction and output settings in the name of an image store blob, see settings_digest
+SETTINGS_DIGEST_LENGTH = 8
+
+# Per-thread (and therefore per-process) face detection model of extraction workers
+_worker_state = threading.local()
+
+
+def new_reuse_state(threshold):
+    """
+    Creates the state carried between consecutive frames of one panelist for temporal reuse.
+
+    When a frame differs from the last frame faces were detected in by less than the threshold, that frame's face
+    boxes are reused instead of running face detection again. The difference is the largest absolute difference of
+    any cell, on a 0-255 scale, between FRAME_SIGNATURE_SIZE x FRAME_SIGNATURE_SIZE grey thumbnails of the two
+    frames, so a change confined to one part of the screen, such as a face appearing in a corner, is not averaged
+    away by the unchanged rest.
+
+    Args:
+        threshold (float): Largest difference at which faces are reused, 0 to always run detection.
+    Returns:
+        dict: Reuse state to pass to redact_image_bytes.
+    """
+    return {'threshold': threshold, 'signature': None, 'faces': [], 'skipped': 0}
+
+
+def frame_signature(image):
+    """
+    Returns a small grey thumbnail of an image, cheap to compare with the next frame.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (FRAME_SIGNATURE_SIZE, FRAME_SIGNATURE_SIZE), interpolation=cv2.INTER_AREA)
+
+
+def get_face_cascade():
+    """
+    Returns the face detection model of the calling worker, loading it on first use.
+
+    The model is not safe to share between threads, so every thread and process gets its own.
+    """
+    if getattr(_worker_state, 'cascade_pid', None) != os.getpid():
+        _worker_state.cascade_pid = os.getpid()
+        _worker_state.face_cascade = cv2.CascadeClassifier(FACE_CASCADE_PATH)
+    return _worker_state.face_cascade
+
+
+def detect_faces(image, detect_scale=1.0):
+    """
+    Detects faces in an image, optionally on a downscaled copy for speed.
+
+    Args:
+        image: The image array.
+        detect_scale (float): Scale the image is shrunk to before detection, e.g. 0.5 for half size. The
+            minimum face size shrinks with it and the boxes are mapped back to full resolution.
+    Returns:
+        list: Face bounding boxes as (x, y, w, h) in full resolution pixels.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if detect_scale < 1.0:
+        gray = cv2.resize(gray, None, fx=detect_scale, fy=detect_scale, interpolation=cv2.INTER_AREA)
+
+    min_size = max(1, round(30 * detect_scale))
+    faces = get_face_cascade().detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_size, min_size))
+
+    if detect_scale >= 1.0:
+        return [tuple(int(v) for v in face) for face in faces]
+
+    # Round outwards so a box never shrinks when it is mapped back
+    return [(int(x / detect_scale), int(y / detect_scale),
+             int(np.ceil(w / detect_scale)) + 1, int(np.ceil(h / detect_scale)) + 1)
+            for (x, y, w, h) in faces]
+
+
+def detect_faces_with_reuse(image, detect_scale, reuse_state):
+    """
+    Detects faces in an image, or reuses the faces of the last detected frame when the two are near-identical.
+
+    Args:
+        image: The image array.
+        detect_scale (float): Scale the image is shrunk to for face detection, see detect_faces.
+        reuse_state (dict): State from new_reuse_state, updated with this frame when detection runs on it.
+    Returns:
+        list: Face bounding boxes as (x, y, w, h) in full resolution pixels.
+    """
+    signature = frame_signature(image)
+    previous = reuse_state['signature']
+
+    if (previous is not None and previous.shape == signature.shape
+            and cv2.absdiff(signature, previous).max() <= reuse_state['threshold']):
+        reuse_state['skipped'] += 1
+        faces = reuse_state['faces']
+    else:
+        faces = detect_faces(image, detect_scale)
+        reuse_state['faces'] = faces
+        # Compare later frames against this detected one rather than their predecessor, so drift that stays under
+        # the threshold at every step, such as a face scrolling or fading in, still triggers detection
+        reuse_state['signature'] = signature
+    return faces
+
+
+def redact_image_bytes(image_bytes, output_image_path, redaction_type='redact', detect_scale=1.0, reuse_state=None,
+                       image_output=None, thumbnail_output_path=None):
+    """
+    Decodes an encoded image in memory, redacts or blurs its faces and saves it.
+
+    Faces are found and covered at full resolution, before the image is shrunk or re-encoded, so the image is
+    decoded only once.
+
+    Args:
+        image_bytes (bytes): The encoded image, e.g. a JPEG zip member.
+        output_image_path (str): Path where the processed image will be saved, its extension sets the format.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detect_scale (float): Scale the image is shrunk to for face detection, see detect_faces.
+        reuse_state (dict): State from new_reuse_state shared by consecutive frames, or None to always detect.
+        image_output (dict): Output settings from new_image_output, or None to save the image at full size.
+        thumbnail_output_path (str): Path of the thumbnail when image_output asks for one, see write_output_image.
+    Returns:
+        int: Number of faces found.
+    """
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not decode image for {output_image_path}")
+
+    if reuse_state and reuse_state['threshold'] > 0:
+        faces = detect_faces_with_reuse(image, detect_scale, reuse_state)
+    else:
+        faces = detect_faces(image, detect_scale)
+    for (x, y, w, h) in faces:
+        if redaction_type == 'blur':
+            blur_face(image, x, y, w, h)
+        else:  # Default to 'redact' for any other input
+            redact_face(image, x, y, w, h)
+
+    write_output_image(image, output_image_path, image_output, thumbnail_output_path)
+    return len(faces)
+
+
+def settings_digest(redaction_type='redact', detect_scale=1.0, reuse_state=None, image_output=None):
+    """
+    Returns a short digest of the settings a redacted image depends on, so blobs written with other settings are
+    not reused for it.
+
+    Args:
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detect_scale (float): Scale the image is shrunk to for face detection, see detect_faces.
+        reuse_state (dict): State from new_reuse_state, whose threshold is part of the settings.
+        image_output (dict): Output settings from new_image_output, or None to store images at full size.
+    Returns:
+        str: SETTINGS_DIGEST_LENGTH hex digits.
+    """
+    settings = {
+        'redaction_type': 'blur' if redaction_type == 'blur' else 'redact',
+        'detect_scale': float(detect_scale),
+        'reuse_threshold': float(reuse_state['threshold']) if reuse_state else 0.0,
+        'image_output': image_output,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:SETTINGS_DIGEST_LENGTH]
+
+
+def store_redacted_image(image_bytes, output_image_path, image_store, redaction_type='redact', detect_scale=1.0,
+                         reuse_state=None, image_output=None):
+    """
+    Redacts an image into the content-addressed image store and links it to its output path.
+
+    Redacted images are stored once per distinct source image and settings, as `blobs/<aa>/<sha256>-<settings><ext>`
+    under image_store where the hash is that of the image as uploaded and the settings are from settings_digest. An
+    image whose blob already exists, because the same bytes came in another zip, as a repeated frame or in an earlier
+    run with the same settings, is neither decoded nor redacted again. The output path
+    is a hard link to the blob, or a copy where the file system cannot link. Thumbnails are stored and linked the
+    same way, as `<sha256>-<settings>.thumb<ext>`.
+
+    Args:
+        image_bytes (bytes): The encoded image, e.g. a JPEG zip member.
+        output_image_path (str): Path the image is expected at, e.g. in the panelist's images folder.
+        image_store (str): Folder of the image store, see image_store_folder.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detect_scale (float): Scale the image is shrunk to for face detection, see detect_faces.
+        reuse_state (dict): State from new_reuse_state shared by consecutive frames, or None to always detect.
+        image_output (dict): Output settings from new_image_output, or None to store images at full size.
+    Returns:
+        str: SHA-256 hex digest of the source image.
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    blob_name = f"{digest}-{settings_digest(redaction_type, detect_scale, reuse_state, image_output)}"
+    extension = os.path.splitext(output_image_path)[1].lower()
+    blob_path = os.path.join(image_store, 'blobs', digest[:2], blob_name + extension)
+    thumbnail_blob_path = None
+    if image_output and image_output['thumbnail_size']:
+        thumbnail_blob_path = os.path.join(image_store, 'blobs', digest[:2], f"{blob_name}.thumb{extension}")
+
+    if not os.path.exists(blob_path) or (thumbnail_blob_path and not os.path.exists(thumbnail_blob_path)):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        # Workers storing the same image at the same time each write their own temp files, the last rename wins.
+        # The image is renamed last, so its blob only exists once its thumbnail does.
+        temp_suffix = f".{os.getpid()}-{threading.get_ident()}{extension}"
+        temp_thumbnail_path = thumbnail_blob_path + temp_suffix if thumbnail_blob_path else None
+        redact_image_bytes(image_bytes, blob_path + temp_suffix, redaction_type, detect_scale, reuse_state,
+                           image_output, temp_thumbnail_path)
+        if temp_thumbnail_path:
+            os.replace(temp_thumbnail_path, thumbnail_blob_path)
+        os.replace(blob_path + temp_suffix, blob_path)
+
+    link_or_copy(blob_path, output_image_path)
+    if thumbnail_blob_path:
+        os.makedirs(os.path.dirname(thumbnail_path(output_image_path)), exist_ok=True)
+        link_or_copy(thumbnail_blob_path, thumbnail_path(output_image_path))
+    return digest
+
+
+def link_or_copy(source_path, target_path):
+    """
+    Hard links a file to a new path, or copies it where the file system cannot link. Existing targets are kept.
+    """
+    try:
+        os.link(source_path, target_path)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+
+def thumbnail_path(output_image_path):
+    """
+    Returns where the thumbnail of a redacted image goes: a thumbnails folder next to its image folder.
+    """
+    image_folder = os.path.dirname(output_image_path)
+    return os.path.join(os.path.dirname(image_folder), 'thumbnails', os.path.basename(output_image_path))
+
+
+def write_output_image(image, output_image_path, image_output=None, thumbnail_output_path=None):
+    """
+    Shrinks and encodes a redacted image, and its thumbnail, according to its output settings.
+
+    Args:
+        image: The redacted image array.
+        output_image_path (str): Path of the image, whose extension sets the format.
+        image_output (dict): Settings from new_image_output, or None to write the image as it is.
+        thumbnail_output_path (str): Path of the thumbnail, defaults to thumbnail_path of the image.
+    Returns:
+        int: Size of the written image in bytes, not counting the thumbnail.
+    """
+    if image_output is None:
+        return write_encoded_image(image, output_image_path)
+
+    if image_output['max_dimension']:
+        image = shrink_image(image, image_output['max_dimension'])
+    written = write_encoded_image(image, output_image_path, image_output['quality'])
+
+    if image_output['thumbnail_size']:
+        thumbnail_output_path = thumbnail_output_path or thumbnail_path(output_image_path)
+        os.makedirs(os.path.dirname(thumbnail_output_path), exist_ok=True)
+        write_encoded_image(shrink_image(image, image_output['thumbnail_size']), thumbnail_output_path,
+                            image_output['quality'])
+    return written
+
+
+def shrink_image(image, max_dimension):
+    """
+    Scales an image down so its longest side is at most max_dimension pixels, keeping its aspect ratio.
+    """
+    height, width = image.shape[:2]
+    if max(height, width) <= max_dimension:
+        return image
+    scale = max_dimension / max(height, width)
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def write_encoded_image(image, path, quality=None):
+    """
+    Encodes an image in the format given by the extension of its path and writes it.
+
+    Args:
+        image: The image array.
+        path (str): Output path, e.g. ending in .jpg or .webp.
+        quality (int): Encoding quality from 0 to 100, or None for OpenCV's default.
+    Returns:
+        int: Size of the written file in bytes.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    params = []
+    if quality is not None:
+        params = [cv2.IMWRITE_WEBP_QUALITY if extension == '.webp' else cv2.IMWRITE_JPEG_QUALITY, quality]
+    encoded, buffer = cv2.imencode(extension, image, params)
+    if not encoded:
+        raise ValueError(f"Could not encode image for {path}")
+    with open(path, 'wb') as image_file:
+        image_file.write(buffer.tobytes())
+    return len(buffer)
+
+
+def blur_face(image, x, y, w, h):
+    """
+    Applies Gaussian blurring to a face region in the image.
+
+    Args:
+        image: The image array.
+        x, y: The top-left corner of the face bounding box.
+        w, h: The width and height of the bounding box.
+    """
+    region_of_interest = image[y:y + h, x:x + w]
+    blurred = cv2.GaussianBlur(region_of_interest, (99, 99), 30)
+    image[y:y + h, x:x + w] = blurred
+
+
+def redact_face(image, x, y, w, h):
+    """
+    Fills a face region in the image with black to redact it.
+
+    Args:
+        image: The image array.
+        x, y: The top-left corner of the face bounding box.
+        w, h: The width and height of the bounding box.
+    """
+    image[y:y + h, x:x + w] = (0, 0, 0)
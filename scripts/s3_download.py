@@ -0,0 +1,174 @@
+import asyncio
+import itertools
+import os
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+# Requests to S3 in flight at once, which is also the size of the shared connection pool
+DOWNLOAD_MAX_IN_FLIGHT = 64
+
+# Objects larger than this are fetched as parallel ranged GETs of this size
+RANGED_GET_PART_SIZE = 16 * 1024 * 1024
+
+# Objects scheduled per in-flight request, so a long listing is consumed lazily
+SCHEDULED_PER_REQUEST = 2
+
+# Bytes copied from a response body to disk at a time
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def download_objects(objects, bucket_name, local_path, max_in_flight=DOWNLOAD_MAX_IN_FLIGHT,
+                     part_size=RANGED_GET_PART_SIZE, desc="Downloading files"):
+    """
+    Downloads S3 objects from a single process, with an asyncio event loop driving many requests at once.
+
+    All requests share one S3 client whose connection pool holds max_in_flight connections, and a semaphore keeps
+    at most that many requests in flight. boto3 is blocking, so each request runs on a thread of an executor of the
+    same size while the event loop schedules them. Objects larger than part_size are split into ranged GETs that are
+    fetched in parallel and written into place, pinned to the listed ETag so a concurrent upload cannot mix versions.
+
+    The objects are consumed on the calling thread, lazily and at most SCHEDULED_PER_REQUEST per in-flight request
+    ahead, so generators that must stay on their thread (e.g. reading an SQLite connection) can be passed.
+    Files are written under a .part name and renamed when complete, and files that already exist are kept.
+
+    Args:
+        objects: Iterable of S3 object refs with Key, and Size and ETag when known.
+        bucket_name: Name of the S3 bucket.
+        local_path: Function of an S3 key returning the path to download it to.
+        max_in_flight: Requests in flight at once.
+        part_size: Size of the ranged GETs of large objects, in bytes.
+        desc: Label of the progress bar.
+    Yields:
+        tuple: (object ref, local path, error) per object, in completion order. error is None when the download
+        succeeded.
+    """
+    # Imported here so the pipeline can be imported, e.g. for stages that never reach S3, without loading boto3
+    import boto3
+    from botocore.config import Config
+
+    s3 = boto3.session.Session().client('s3', config=Config(max_pool_connections=max_in_flight))
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(executor)
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+
+    semaphore = asyncio.run_coroutine_threadsafe(new_semaphore(max_in_flight), loop).result()
+    max_scheduled = max_in_flight * SCHEDULED_PER_REQUEST
+    objects = iter(objects)
+    completed = queue.Queue()
+    scheduled = {}
+
+    try:
+        with tqdm(desc=desc) as pbar:
+            while True:
+                for obj in itertools.islice(objects, max_scheduled - len(scheduled)):
+                    future = asyncio.run_coroutine_threadsafe(
+                        download_object(s3, bucket_name, obj, local_path(obj['Key']), semaphore, part_size), loop)
+                    future.add_done_callback(completed.put)
+                    scheduled[future] = obj
+
+                if not scheduled:
+                    break
+
+                future = completed.get()
+                obj = scheduled.pop(future)
+                pbar.update(1)
+                error = future.exception()
+                yield obj, None if error else future.result(), error
+    finally:
+        # Only left early when the consumer stops reading; in-flight requests are abandoned
+        for future in scheduled:
+            future.cancel()
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        executor.shutdown(wait=True)
+        loop.close()
+
+
+async def new_semaphore(value):
+    """
+    Creates a semaphore on the running event loop.
+    """
+    return asyncio.Semaphore(value)
+
+
+async def download_object(s3, bucket_name, obj, file_path, semaphore, part_size=RANGED_GET_PART_SIZE):
+    """
+    Downloads one object, as parallel ranged GETs when it is larger than part_size.
+
+    Args:
+        s3: Shared boto3 S3 client.
+        bucket_name: Name of the S3 bucket.
+        obj: S3 object ref.
+        file_path (str): Path to download the object to.
+        semaphore (asyncio.Semaphore): Bounds the requests in flight.
+        part_size (int): Size of the ranged GETs, in bytes.
+    Returns:
+        str: file_path
+    """
+    if os.path.exists(file_path):
+        return file_path
+
+    loop = asyncio.get_running_loop()
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    temp_path = file_path + '.part'
+    size = obj.get('Size') or 0
+
+    async def fetch(byte_range=None):
+        async with semaphore:
+            await loop.run_in_executor(None, fetch_range, s3, bucket_name, obj, temp_path, byte_range)
+
+    try:
+        if size <= part_size:
+            await fetch()
+        else:
+            # The file is created at its full size, and every part writes its own slice of it
+            with open(temp_path, 'wb') as part_file:
+                part_file.truncate(size)
+            results = await asyncio.gather(
+                *(fetch((start, min(start + part_size, size) - 1)) for start in range(0, size, part_size)),
+                return_exceptions=True)
+            errors = [result for result in results if isinstance(result, BaseException)]
+            if errors:
+                raise errors[0]
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return file_path
+
+
+def fetch_range(s3, bucket_name, obj, temp_path, byte_range=None):
+    """
+    Fetches a whole object, or one byte range of it into an existing file, with a single blocking GET.
+
+    Args:
+        s3: boto3 S3 client.
+        bucket_name: Name of the S3 bucket.
+        obj: S3 object ref.
+        temp_path (str): File to write to.
+        byte_range (tuple): Inclusive (first, last) byte offsets, or None for the whole object.
+    """
+    if byte_range is None:
+        response = s3.get_object(Bucket=bucket_name, Key=obj['Key'])
+        with open(temp_path, 'wb') as output:
+            shutil.copyfileobj(response['Body'], output, DOWNLOAD_CHUNK_SIZE)
+        return
+
+    first, last = byte_range
+    request = {"Bucket": bucket_name, "Key": obj['Key'], "Range": f"bytes={first}-{last}"}
+    if obj.get('ETag'):
+        request["IfMatch"] = obj['ETag']
+    response = s3.get_object(**request)
+    if response['ContentLength'] != last - first + 1:
+        raise IOError(f"Expected {last - first + 1} bytes of {obj['Key']} at offset {first}, "
+                      f"got {response['ContentLength']}")
+    with open(temp_path, 'r+b') as output:
+        output.seek(first)
+        shutil.copyfileobj(response['Body'], output, DOWNLOAD_CHUNK_SIZE)
@@ -0,0 +1,271 @@
+import collections
+import csv
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from time_index import file_fingerprint
+
+# Text column scored in each consolidated dataset, OCR text for screenshots and accessibility text
+SENTIMENT_TEXT_COLUMNS = {
+    "screenshot_data": "text",
+    "app_accessibility_data": "text",
+}
+
+# Columns added to the scored datasets: mean valence, arousal and dominance of the lexicon words in the text, and
+# how many words of the text are in the lexicon
+SENTIMENT_COLUMNS = ("valence", "arousal", "dominance", "lexicon_tokens")
+
+# Rows scored per work item
+SENTIMENT_CHUNK_ROWS = 100_000
+
+# Chunks scored ahead of the one being written, per worker
+SENTIMENT_CHUNKS_PER_WORKER = 2
+
+# Suffix of the file next to each scored CSV recording how much of it was scored, see score_csv_file
+SENTIMENT_STATE_SUFFIX = ".sentiment.json"
+
+# Words as runs of letters, with inner apostrophes as in "don't"
+TOKEN_PATTERN = r"[^\W\d_]+(?:'[^\W\d_]+)*"
+
+# Lexicon loaded once by each scoring worker, see load_worker_lexicon
+_worker_lexicon = {}
+
+
+def load_lexicon(lexicon_path):
+    """
+    Loads a valence, arousal and dominance lexicon such as NRC-VAD-Lexicon.txt.
+
+    The file is tab-separated with one word per line followed by its valence, arousal and dominance. A header
+    line, as in newer releases of the NRC lexicon, is skipped. Multi-word terms are dropped since text is scored
+    word by word.
+
+    Args:
+        lexicon_path (str): Path of the lexicon file.
+    Returns:
+        tuple: (pandas.Index of lower-case words, float array of shape (words, 3))
+    """
+    lexicon = pd.read_csv(lexicon_path, sep="\t", header=None, names=["word", "valence", "arousal", "dominance"],
+                          usecols=[0, 1, 2, 3], dtype={"word": str}, keep_default_na=False, quoting=csv.QUOTE_NONE)
+    scores = lexicon[["valence", "arousal", "dominance"]].apply(pd.to_numeric, errors="coerce")
+
+    # Drop the header line and multi-word terms, and keep the first entry of words listed twice
+    keep = scores.notna().all(axis=1) & ~lexicon["word"].str.contains(" ")
+    words = lexicon.loc[keep, "word"].str.lower()
+    first = ~words.duplicated()
+    return pd.Index(words[first]), scores.loc[keep][first].to_numpy(dtype=np.float64)
+
+
+def score_texts(texts, words, values):
+    """
+    Scores texts against a lexicon, all rows at once.
+
+    Texts are split into lower-case words, and each matched word adds its scores to its row. This is the product of
+    a sparse row-by-word count matrix with the lexicon scores, computed with np.bincount over the matched words.
+
+    Args:
+        texts (pandas.Series): Texts to score.
+        words (pandas.Index): Lexicon words, see load_lexicon.
+        values (numpy.ndarray): Lexicon scores, see load_lexicon.
+    Returns:
+        pandas.DataFrame: SENTIMENT_COLUMNS per text, with the same index. Scores are NaN for texts without any
+        lexicon word.
+    """
+    row_count = len(texts)
+    tokens = texts.fillna("").str.lower().str.findall(TOKEN_PATTERN)
+    lengths = tokens.str.len().to_numpy()
+    rows = np.repeat(np.arange(row_count), lengths)
+    positions = words.get_indexer(np.concatenate(tokens.to_numpy()) if lengths.sum() else [])
+
+    matched = positions >= 0
+    rows, positions = rows[matched], positions[matched]
+    counts = np.bincount(rows, minlength=row_count)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.column_stack([np.bincount(rows, weights=values[positions, column], minlength=row_count) / counts
+                                 for column in range(values.shape[1])])
+
+    scores = pd.DataFrame(means, columns=list(SENTIMENT_COLUMNS[:3]), index=texts.index)
+    scores["lexicon_tokens"] = counts
+    return scores
+
+
+def load_worker_lexicon(lexicon_path):
+    """
+    Loads the lexicon once per scoring worker, as the initializer of its pool.
+    """
+    _worker_lexicon["words"], _worker_lexicon["values"] = load_lexicon(lexicon_path)
+
+
+def score_chunk(texts):
+    """
+    Scores one chunk of texts inside a scoring worker, see score_texts.
+    """
+    return score_texts(texts, _worker_lexicon["words"], _worker_lexicon["values"])
+
+
+def lexicon_digest(lexicon_path):
+    """
+    Returns the SHA-256 hex digest of a lexicon file, so files scored with another lexicon are scored again.
+    """
+    digest = hashlib.sha256()
+    with open(lexicon_path, "rb") as lexicon_file:
+        for block in iter(lambda: lexicon_file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scored_size(csv_path, lexicon):
+    """
+    Returns how many bytes at the start of a CSV file were already scored with a lexicon.
+
+    A file that was only appended to since it was scored still has the size and fingerprint recorded in its state
+    file, see time_index.file_fingerprint. A file rewritten since, by --dedup or by widened columns, or scored with
+    another lexicon, is scored again from the start.
+
+    Args:
+        csv_path (str): Path of the CSV file.
+        lexicon (str): Digest of the lexicon, see lexicon_digest.
+    Returns:
+        int: Size of the scored part, 0 if the whole file needs scoring.
+    """
+    try:
+        with open(csv_path + SENTIMENT_STATE_SUFFIX) as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return 0
+
+    if state.get("lexicon") != lexicon or not 0 < state.get("size", 0) <= os.path.getsize(csv_path):
+        return 0
+    with open(csv_path, "rb") as csv_file:
+        return state["size"] if file_fingerprint(csv_file, state["size"]) == state.get("fingerprint") else 0
+
+
+def write_scored_state(csv_path, lexicon):
+    """
+    Records that a CSV file is scored up to its current end, see scored_size.
+    """
+    size = os.path.getsize(csv_path)
+    with open(csv_path, "rb") as csv_file:
+        state = {"lexicon": lexicon, "size": size, "fingerprint": file_fingerprint(csv_file, size)}
+    state_path = csv_path + SENTIMENT_STATE_SUFFIX
+    with open(state_path + ".tmp", "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def score_csv_file(csv_path, text_column, pool, max_pending, chunk_rows=SENTIMENT_CHUNK_ROWS, lexicon=None):
+    """
+    Adds the sentiment columns to a CSV file, replacing them if the file already has them.
+
+    The file is read in chunks of chunk_rows rows, which are scored in parallel and written back in order, so memory
+    is bounded by the chunks in flight. Other values are written back unchanged. With a lexicon digest, only the rows
+    appended since the file was last scored with that lexicon are scored, see scored_size; the rows scored before are
+    copied as raw bytes.
+
+    Args:
+        csv_path (str): Path of the CSV file.
+        text_column (str): Column holding the text to score.
+        pool (ProcessPoolExecutor): Scoring workers, see open_scoring_pool.
+        max_pending (int): Chunks scored ahead of the one being written.
+        chunk_rows (int): Rows per chunk.
+        lexicon (str): Digest of the lexicon, see lexicon_digest, or None to score every row.
+    Returns:
+        int: Number of rows scored, 0 if the file has no text column.
+    """
+    header = pd.read_csv(csv_path, nrows=0, encoding_errors="replace").columns
+    if text_column not in header:
+        return 0
+
+    start = scored_size(csv_path, lexicon) if lexicon else 0
+    if start == os.path.getsize(csv_path):
+        return 0
+
+    temp_path = csv_path + ".tmp"
+    rows = 0
+    pending = collections.deque()
+
+    with open(csv_path, "rb") as source, open(temp_path, "wb") as output:
+        if start:
+            # The scored rows keep their bytes, and the appended ones follow in the file's own column order
+            while source.tell() < start:
+                output.write(source.read(min(shutil.COPY_BUFSIZE, start - source.tell())))
+            chunks = pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunk_rows, header=None,
+                                 names=list(header), encoding_errors="replace")
+        else:
+            chunks = pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunk_rows,
+                                 encoding_errors="replace")
+
+        def write_next():
+            nonlocal rows
+            chunk, future = pending.popleft()
+            scored = pd.concat([chunk, future.result()], axis=1)
+            if start:
+                scored = scored[list(header)]
+            scored.to_csv(output, header=not start and rows == 0, index=False, lineterminator="\n",
+                          encoding="utf-8")
+            rows += len(scored)
+
+        for chunk in chunks:
+            chunk = chunk.drop(columns=[column for column in SENTIMENT_COLUMNS if column in chunk.columns])
+            pending.append((chunk, pool.submit(score_chunk, chunk[text_column])))
+            if len(pending) >= max_pending:
+                write_next()
+        while pending:
+            write_next()
+
+    if rows:
+        os.replace(temp_path, csv_path)
+        if lexicon:
+            write_scored_state(csv_path, lexicon)
+    else:
+        os.remove(temp_path)
+    return rows
+
+
+def open_scoring_pool(lexicon_path, num_workers):
+    """
+    Starts the scoring workers, each of which loads the lexicon once.
+
+    Args:
+        lexicon_path (str): Path of the lexicon, see load_lexicon.
+        num_workers (int): Number of scoring processes.
+    Returns:
+        ProcessPoolExecutor: The pool, to be shut down by the caller.
+    """
+    return ProcessPoolExecutor(max_workers=num_workers, initializer=load_worker_lexicon, initargs=(lexicon_path,))
+
+
+def score_consolidated_csvs(query_id, lexicon_path, num_workers=1):
+    """
+    Adds the sentiment columns to the consolidated files of every panelist that hold text, see
+    SENTIMENT_TEXT_COLUMNS. Rows scored by an earlier run with the same lexicon are not scored again.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+        lexicon_path (str): Path of the lexicon, see load_lexicon.
+        num_workers (int): Number of scoring processes.
+    Returns:
+        int: Number of rows scored.
+    """
+    # Fail early on a missing or malformed lexicon, rather than inside the workers
+    words, _ = load_lexicon(lexicon_path)
+    logging.info(f"Loaded {len(words)} words from {lexicon_path}.")
+    lexicon = lexicon_digest(lexicon_path)
+
+    total = 0
+    with open_scoring_pool(lexicon_path, num_workers) as pool:
+        for prefix, text_column in SENTIMENT_TEXT_COLUMNS.items():
+            pattern = os.path.join(query_id, "combined", "panelists", "*", "metadata", f"{prefix}-consolidated.csv")
+            for combined_csv in sorted(glob.glob(pattern)):
+                rows = score_csv_file(combined_csv, text_column, pool, num_workers * SENTIMENT_CHUNKS_PER_WORKER,
+                                      lexicon=lexicon)
+                logging.info(f"Scored the sentiment of {rows} new rows of {combined_csv}.")
+                total += rows
+    return total
@@ -0,0 +1,313 @@
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+
+from external_sort import TIME_COLUMNS, merge_sorted_csvs
+
+# Stage metrics that add up across shards; wall time is the longest shard's, since shards run side by side
+SUMMED_STAGE_METRICS = ("calls", "cpu_seconds", "items", "bytes", "errors", "worker_busy_seconds", "worker_count")
+
+# Tables of the SQLite files of a query that are unions of their shards' rows, by path within the query folder
+MERGED_SQLITE_TABLES = {
+    "manifest.sqlite": "objects",
+    os.path.join("combined", "image_store", "images.sqlite"): "images",
+}
+
+
+def parse_shard(value):
+    """
+    Parses a shard given as i/N, the i-th of N shards counting from 0.
+
+    Returns:
+        tuple: (i, N)
+    Raises:
+        argparse.ArgumentTypeError: If the value is not a valid shard.
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, e.g. 0/4, got {value}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard {value} is not one of 0/{count} to {count - 1}/{count}")
+    return index, count
+
+
+def shard_name(shard):
+    """
+    Returns the name of a shard used in folder names, e.g. shard-0-of-4.
+    """
+    return f"shard-{shard[0]}-of-{shard[1]}"
+
+
+def shard_of(panelist, count):
+    """
+    Assigns a panelist to one of count shards, by a hash of its folder name that is the same on every machine.
+    """
+    return int(hashlib.sha1(panelist.encode("utf-8")).hexdigest()[:16], 16) % count
+
+
+def in_shard(obj, shard):
+    """
+    Returns whether an S3 object belongs to a shard, by the panelist folder it is in, see group_zips_by_panelist.
+
+    Args:
+        obj: S3 object ref.
+        shard (tuple): (i, N) as returned by parse_shard, or None for all objects.
+    """
+    return shard is None or shard_of(obj['Key'].split('/')[-2], shard[1]) == shard[0]
+
+
+def link_tree(source, target):
+    """
+    Copies a folder tree, hard linking files where the file system allows it and replacing files already there.
+    """
+    def link_file(source_path, target_path):
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        try:
+            os.link(source_path, target_path)
+        except OSError:
+            shutil.copy2(source_path, target_path)
+
+    shutil.copytree(source, target, copy_function=link_file, dirs_exist_ok=True)
+
+
+def merge_sqlite_table(source_path, target_path, table):
+    """
+    Adds the rows of a table of one SQLite file to the same table of another, replacing rows with the same key.
+
+    The table is created in the target with the source's definition if it does not exist yet.
+    """
+    conn = sqlite3.connect(target_path)
+    try:
+        conn.execute("ATTACH DATABASE ? AS shard", (source_path,))
+        found = conn.execute("SELECT sql FROM shard.sqlite_master WHERE type = 'table' AND name = ?",
+                             (table,)).fetchone()
+        if found:
+            with conn:
+                conn.execute(found[0].replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+                conn.execute(f"INSERT OR REPLACE INTO main.{table} SELECT * FROM shard.{table}")
+        conn.execute("DETACH DATABASE shard")
+    finally:
+        conn.close()
+
+
+def merge_global_datasets(shard_folders, query_id):
+    """
+    Merges the global datasets of the shards, each sorted by time, into the global datasets of the query.
+
+    Shards can have different columns, since each adds the columns of its own panelists. Their files are then
+    copied into the union of the columns first.
+
+    Returns:
+        int: Number of rows written.
+    """
+    global_folder = os.path.join(query_id, "combined", "global")
+    rows = 0
+    for prefix, time_column in TIME_COLUMNS.items():
+        csv_paths = [path for path in (os.path.join(folder, "combined", "global", f"{prefix}-consolidated.csv")
+                                       for folder in shard_folders) if os.path.exists(path)]
+        if not csv_paths:
+            continue
+        os.makedirs(global_folder, exist_ok=True)
+
+        headers = []
+        for csv_path in csv_paths:
+            with open(csv_path, newline="", encoding="utf-8", errors="replace") as csv_file:
+                headers.append(next(csv.reader(csv_file), []))
+        columns = []
+        for header in headers:
+            columns.extend(column for column in header if column not in columns)
+
+        with tempfile.TemporaryDirectory(dir=global_folder, prefix=f".{prefix}-") as run_folder:
+            runs = []
+            for number, (csv_path, header) in enumerate(zip(csv_paths, headers)):
+                if header == columns:
+                    runs.append(csv_path)
+                    continue
+                run_path = os.path.join(run_folder, f"{number}.csv")
+                with open(csv_path, newline="", encoding="utf-8", errors="replace") as source, \
+                        open(run_path, "w", newline="", encoding="utf-8") as run:
+                    writer = csv.DictWriter(run, columns, lineterminator="\n")
+                    writer.writeheader()
+                    writer.writerows(csv.DictReader(source))
+                runs.append(run_path)
+            # Panelists with rows at the same time come in the order build_global_datasets merges them in
+            written = merge_sorted_csvs(runs, os.path.join(global_folder, f"{prefix}-consolidated.csv"), time_column,
+                                        key_columns=("panelist_id",))
+        logging.info(f"Merged {written} global {prefix} rows of {len(csv_paths)} shards.")
+        rows += written
+    return rows
+
+
+def latest_run_report(shard_folder):
+    """
+    Loads the most recent run report of a shard, or returns None if it has none.
+    """
+    report_paths = sorted(glob.glob(os.path.join(shard_folder, "reports", "run-*.json")))
+    if not report_paths:
+        return None
+    with open(report_paths[-1]) as report_file:
+        return json.load(report_file)
+
+
+def merge_run_reports(shard_folders, query_id, merged_at):
+    """
+    Copies the run reports of the shards into the query, and writes a report of the whole sharded run.
+
+    The merged report holds the latest run of each shard: stage counts and CPU time are summed, wall time and peak
+    memory are the largest of any shard, and throughput is recomputed from the totals.
+
+    Returns:
+        str: Path of the merged report.
+    """
+    stages, runs = {}, []
+    os.makedirs(os.path.join(query_id, "reports"), exist_ok=True)
+    for folder in shard_folders:
+        if os.path.isdir(os.path.join(folder, "reports")):
+            link_tree(os.path.join(folder, "reports"), os.path.join(query_id, "reports", "shards",
+                                                                    os.path.basename(os.path.normpath(folder))))
+        run_report = latest_run_report(folder)
+        if run_report is None:
+            continue
+        runs.append(run_report["run"])
+        for name, metrics in run_report["stages"].items():
+            merged = stages.setdefault(name, {"wall_seconds": 0.0, **dict.fromkeys(SUMMED_STAGE_METRICS, 0)})
+            merged["wall_seconds"] = max(merged["wall_seconds"], metrics.get("wall_seconds") or 0.0)
+            merged["peak_rss_mb"] = max(merged.get("peak_rss_mb") or 0.0, metrics.get("peak_rss_mb") or 0.0)
+            for metric in SUMMED_STAGE_METRICS:
+                merged[metric] += metrics.get(metric) or 0
+
+    for merged in stages.values():
+        wall = merged["wall_seconds"]
+        merged["items_per_second"] = merged["items"] / wall if wall else None
+        merged["bytes_per_second"] = merged["bytes"] / wall if wall else None
+
+    report_path = os.path.join(query_id, "reports", f"merge-{merged_at.strftime('%Y%m%dT%H%M%SZ')}.json")
+    merged_report = {
+        "run": {
+            "query_id": query_id,
+            "shards": [os.path.normpath(folder) for folder in shard_folders],
+            "merged_at": merged_at.isoformat(),
+            "wall_seconds": max((run.get("wall_seconds") or 0.0 for run in runs), default=0.0),
+            "objects_processed": sum(run.get("objects_processed") or 0 for run in runs),
+            "objects_failed": sum(run.get("objects_failed") or 0 for run in runs),
+            "shard_runs": runs,
+        },
+        "stages": stages,
+    }
+    with open(report_path, "w") as report_file:
+        json.dump(merged_report, report_file, indent=4)
+    return report_path
+
+
+def merge_shards(shard_folders, query_id):
+    """
+    Combines the output folders of the shards of a run into one query folder with the layout of an unsharded run.
+
+    Shards hold disjoint panelists, so panelist folders and their Parquet partitions are linked into place, the
+    manifests and image store catalogs are unions of the shards', and image store blobs, being named by content,
+    are shared. The global datasets are merged by time, and the time index is rebuilt if the shards have one.
+    Merging again after some shards were rerun replaces their panelists.
+
+    Args:
+        shard_folders (list): Output folders of the shards, see --shard.
+        query_id (str): Folder to merge into.
+    Returns:
+        str: Path of the merged run report.
+    """
+    merged_at = datetime.now(timezone.utc)
+    os.makedirs(os.path.join(query_id, "combined"), exist_ok=True)
+    config = {"queryId": query_id, "numFilesToDownload": 0, "numFilesDownloaded": 0, "lastSyncedAt": "",
+              "shards": []}
+
+    for folder in shard_folders:
+        panelists = sorted(glob.glob(os.path.join(folder, "combined", "panelists", "*")))
+        for panelist_folder in panelists:
+            target = os.path.join(query_id, "combined", "panelists", os.path.basename(panelist_folder))
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            link_tree(panelist_folder, target)
+
+        for dataset in glob.glob(os.path.join(folder, "combined", "parquet", "*", "panelist_id=*")):
+            target = os.path.join(query_id, os.path.relpath(dataset, folder))
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            link_tree(dataset, target)
+
+        blobs = os.path.join(folder, "combined", "image_store", "blobs")
+        if os.path.isdir(blobs):
+            link_tree(blobs, os.path.join(query_id, "combined", "image_store", "blobs"))
+        for relative_path, table in MERGED_SQLITE_TABLES.items():
+            if os.path.exists(os.path.join(folder, relative_path)):
+                os.makedirs(os.path.dirname(os.path.join(query_id, relative_path)), exist_ok=True)
+                merge_sqlite_table(os.path.join(folder, relative_path), os.path.join(query_id, relative_path), table)
+
+        config_path = os.path.join(folder, "query_config.json")
+        if os.path.exists(config_path):
+            with open(config_path) as config_file:
+                shard_config = json.load(config_file)
+            config["numFilesToDownload"] += shard_config.get("numFilesToDownload", 0)
+            config["numFilesDownloaded"] += shard_config.get("numFilesDownloaded", 0)
+            config["lastSyncedAt"] = max(config["lastSyncedAt"], shard_config.get("lastSyncedAt", ""))
+            config["shards"].append(shard_config.get("shard", os.path.normpath(folder)))
+            # Shards of one run list the same path, which a consolidate-only run of the merge reads back
+            for field in ("bucket", "path"):
+                if field in shard_config:
+                    config.setdefault(field, shard_config[field])
+        logging.info(f"Merged {len(panelists)} panelists of {folder}.")
+
+    merge_global_datasets(shard_folders, query_id)
+    if any(os.path.exists(os.path.join(folder, "combined", "time_index.sqlite")) for folder in shard_folders):
+        from time_index import build_time_index
+        build_time_index(query_id)
+
+    with open(os.path.join(query_id, "query_config.json"), "w") as config_file:
+        json.dump(config, config_file)
+    return merge_run_reports(shard_folders, query_id, merged_at)
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line options of the shard tools.
+
+    Args:
+        argv: Argument list to parse, defaults to sys.argv.
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Combine the outputs of a run sharded with consolidatecsvs.py "
+                                                 "--shard.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    merge = subparsers.add_parser("merge", help="Merge the output folders of the shards into one query folder.")
+    merge.add_argument("shard_folders", nargs="+", help="Output folders of the shards.")
+    merge.add_argument("--query-id", required=True, help="Folder to merge into.")
+
+    assign = subparsers.add_parser("assign", help="Print the shard each panelist folder is assigned to.")
+    assign.add_argument("--shards", type=int, required=True, help="Number of shards.")
+    assign.add_argument("panelists", nargs="+", help="Panelist folder names.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "merge":
+        report_path = merge_shards(args.shard_folders, args.query_id)
+        logging.info(f"Merged run report written to {report_path}.")
+    else:
+        for panelist in args.panelists:
+            print(f"{panelist}\t{shard_of(panelist, args.shards)}/{args.shards}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+import argparse
+import csv
+import glob
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+
+import pandas as pd
+
+from external_sort import TIME_COLUMNS, to_epoch_ms
+
+# Name of the index database, in the combined folder of a query
+TIME_INDEX_FILE = "time_index.sqlite"
+
+# Rows inserted into the index at a time
+INDEX_BATCH_ROWS = 50_000
+
+# Largest gap between two selected rows of a file that is read through rather than skipped with a seek
+READ_GAP_BYTES = 64 * 1024
+
+# Bytes at the start of a file, and before the end of its indexed part, hashed to recognize it on the next build
+FINGERPRINT_BYTES = 64 * 1024
+
+
+def time_index_path(query_id):
+    """
+    Returns the path of the time index of a query.
+    """
+    return os.path.join(query_id, "combined", TIME_INDEX_FILE)
+
+
+def open_time_index(query_id):
+    """
+    Opens the time index of a query, creating it if needed.
+
+    The index has one row per consolidated CSV file, with the size, inode, modification time and fingerprint it was
+    indexed at, see file_fingerprint, the time and byte range of every record of those files, and the capture time
+    and path of every redacted image.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+    Returns:
+        sqlite3.Connection: Connection to the index database.
+    """
+    conn = sqlite3.connect(time_index_path(query_id))
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            panelist TEXT NOT NULL,
+            prefix TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            fingerprint TEXT,
+            UNIQUE (panelist, prefix)
+        );
+        CREATE TABLE IF NOT EXISTS rows (
+            file_id INTEGER NOT NULL,
+            time_ms REAL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS rows_by_time ON rows (file_id, time_ms);
+        CREATE TABLE IF NOT EXISTS images (
+            panelist TEXT NOT NULL,
+            time_ms REAL NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (panelist, path)
+        );
+        CREATE INDEX IF NOT EXISTS images_by_time ON images (panelist, time_ms);
+    """)
+    if "fingerprint" not in {row[1] for row in conn.execute("PRAGMA table_info(files)")}:
+        # Indexes built before fingerprints were kept are rebuilt file by file
+        conn.execute("ALTER TABLE files ADD COLUMN fingerprint TEXT")
+    return conn
+
+
+def file_fingerprint(csv_file, size):
+    """
+    Hashes the first FINGERPRINT_BYTES of a file and the FINGERPRINT_BYTES before the given size.
+
+    A file that was only appended to since it was indexed still has the same bytes there, while a file rewritten by
+    --dedup, --sentiment-lexicon or widened columns has a new header or rows in another order, even when it reuses
+    the inode of the old file and is no smaller.
+
+    Args:
+        csv_file: Binary file object.
+        size (int): Size of the part of the file that was indexed.
+    Returns:
+        str: Hex digest.
+    """
+    digest = hashlib.sha256()
+    for start in (0, max(0, size - FINGERPRINT_BYTES)):
+        csv_file.seek(start)
+        digest.update(csv_file.read(min(size, FINGERPRINT_BYTES)))
+    return digest.hexdigest()
+
+
+def epoch_ms_list(values):
+    """
+    Converts a list of time values with to_epoch_ms.
+
+    Args:
+        values (list): Time values as written in the CSV, "" where missing.
+    Returns:
+        list: Epoch milliseconds per value, None where it is missing or cannot be parsed.
+    """
+    times = to_epoch_ms(pd.Series(values, dtype=object))
+    return [None if pd.isna(time_ms) else time_ms for time_ms in times]
+
+
+def read_records(csv_file):
+    """
+    Reads the records of a binary CSV file with their byte ranges.
+
+    A record ends at the first line break outside quotes, so quoted text spanning several lines stays one record.
+
+    Args:
+        csv_file: Binary file object, positioned at the start of a record.
+    Yields:
+        tuple: (offset, raw record bytes including its line break)
+    """
+    offset = csv_file.tell()
+    lines, quotes = [], 0
+    for line in iter(csv_file.readline, b""):
+        lines.append(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            record = b"".join(lines)
+            yield offset, record
+            offset += len(record)
+            lines, quotes = [], 0
+    if lines:
+        yield offset, b"".join(lines)
+
+
+def read_header(csv_file):
+    """
+    Reads the column names of a binary CSV file, leaving it at its first record.
+
+    Returns:
+        list: Column names, empty for an empty file.
+    """
+    for _, record in read_records(csv_file):
+        return next(csv.reader([record.decode("utf-8", errors="replace").lstrip("\ufeff")]), [])
+    return []
+
+
+def index_csv_file(index, query_id, panelist, prefix, csv_path):
+    """
+    Indexes the records of one consolidated CSV file by time, unless it is unchanged since it was last indexed.
+
+    combine_csv_files appends to consolidated files in place while --dedup, --sentiment-lexicon and widened columns
+    replace them with a new file. A file that only grew and still has the fingerprint of its indexed part, see
+    file_fingerprint, is therefore indexed from where the previous index ended, and any other change reindexes the
+    whole file.
+
+    Args:
+        index (sqlite3.Connection): Connection returned by open_time_index.
+        query_id (str): Unique identifier for the query/download session.
+        panelist (str): Name of the panelist folder.
+        prefix (str): Prefix of the dataset, see TIME_COLUMNS.
+        csv_path (str): Path of the consolidated file.
+    Returns:
+        int: Number of records indexed.
+    """
+    stat = os.stat(csv_path)
+    previous = index.execute("SELECT id, size, inode, mtime_ns, fingerprint FROM files "
+                             "WHERE panelist = ? AND prefix = ?", (panelist, prefix)).fetchone()
+    if previous and previous[1:4] == (stat.st_size, stat.st_ino, stat.st_mtime_ns) and previous[4]:
+        return 0
+
+    with open(csv_path, "rb") as csv_file:
+        appended = (previous and previous[2] == stat.st_ino and previous[1] <= stat.st_size
+                    and previous[4] == file_fingerprint(csv_file, previous[1]))
+        csv_file.seek(0)
+        header = read_header(csv_file)
+        time_position = header.index(TIME_COLUMNS[prefix]) if TIME_COLUMNS[prefix] in header else None
+
+        if appended:
+            file_id = previous[0]
+            csv_file.seek(previous[1])
+        else:
+            if previous:
+                index.execute("DELETE FROM rows WHERE file_id = ?", (previous[0],))
+                index.execute("DELETE FROM files WHERE id = ?", (previous[0],))
+            file_id = index.execute(
+                "INSERT INTO files (panelist, prefix, path, size, inode, mtime_ns) VALUES (?, ?, ?, 0, 0, 0)",
+                (panelist, prefix, os.path.relpath(csv_path, query_id))).lastrowid
+
+        indexed = 0
+        batch = []
+        for offset, record in read_records(csv_file):
+            if not record.strip():
+                continue
+            value = ""
+            if time_position is not None:
+                row = next(csv.reader([record.decode("utf-8", errors="replace")]), [])
+                if time_position < len(row):
+                    value = row[time_position]
+            batch.append((value, offset, len(record)))
+            if len(batch) >= INDEX_BATCH_ROWS:
+                indexed += insert_rows(index, file_id, batch)
+                batch = []
+        indexed += insert_rows(index, file_id, batch)
+        fingerprint = file_fingerprint(csv_file, stat.st_size)
+
+    index.execute("UPDATE files SET size = ?, inode = ?, mtime_ns = ?, fingerprint = ? WHERE id = ?",
+                  (stat.st_size, stat.st_ino, stat.st_mtime_ns, fingerprint, file_id))
+    index.commit()
+    return indexed
+
+
+def insert_rows(index, file_id, batch):
+    """
+    Converts the times of a batch of records to epoch milliseconds and adds the records to the index.
+
+    Args:
+        index (sqlite3.Connection): Connection returned by open_time_index.
+        file_id (int): Id of the file of the records.
+        batch (list): (time value, byte offset, byte length) per record.
+    Returns:
+        int: Number of records added.
+    """
+    times = epoch_ms_list([value for value, _, _ in batch])
+    index.executemany("INSERT INTO rows VALUES (?, ?, ?, ?)",
+                      [(file_id, time_ms, offset, length) for time_ms, (_, offset, length) in zip(times, batch)])
+    return len(batch)
+
+
+def index_images(index, query_id, panelist):
+    """
+    Indexes the redacted images of a panelist by the time of their screenshot_data record.
+
+    Images are matched to records by file name, ignoring the extension since --image-format may change it. The
+    file column of a record holds the image's path on the device, so only its last component is compared. Images
+    without a record are left out of the index.
+
+    Args:
+        index (sqlite3.Connection): Connection returned by open_time_index.
+        query_id (str): Unique identifier for the query/download session.
+        panelist (str): Name of the panelist folder.
+    Returns:
+        int: Number of images indexed.
+    """
+    panelist_folder = os.path.join(query_id, "combined", "panelists", panelist)
+    screenshot_csv = os.path.join(panelist_folder, "metadata", "screenshot_data-consolidated.csv")
+    image_folder = os.path.join(panelist_folder, "images")
+    index.execute("DELETE FROM images WHERE panelist = ?", (panelist,))
+    if not os.path.exists(screenshot_csv) or not os.path.isdir(image_folder):
+        index.commit()
+        return 0
+
+    with open(screenshot_csv, newline="", encoding="utf-8", errors="replace") as csv_file:
+        rows = [(row.get("file"), row.get(TIME_COLUMNS["screenshot_data"]) or "") for row in csv.DictReader(csv_file)]
+    times = {}
+    for (file, _), time_ms in zip(rows, epoch_ms_list([value for _, value in rows])):
+        if file and time_ms is not None:
+            times.setdefault(os.path.splitext(os.path.basename(file))[0], time_ms)
+
+    images = []
+    for name in sorted(os.listdir(image_folder)):
+        time_ms = times.get(os.path.splitext(name)[0])
+        if time_ms is not None:
+            images.append((panelist, time_ms, os.path.relpath(os.path.join(image_folder, name), query_id)))
+    index.executemany("INSERT INTO images VALUES (?, ?, ?)", images)
+    index.commit()
+    return len(images)
+
+
+def build_time_index(query_id):
+    """
+    Brings the time index of a query up to date with its consolidated CSVs and redacted images.
+
+    Args:
+        query_id (str): Unique identifier for the query/download session.
+    Returns:
+        tuple: (records indexed, images indexed)
+    """
+    index = open_time_index(query_id)
+    try:
+        present = set()
+        records = images = 0
+        for metadata_folder in sorted(glob.glob(os.path.join(query_id, "combined", "panelists", "*", "metadata"))):
+            panelist = os.path.basename(os.path.dirname(metadata_folder))
+            for prefix in TIME_COLUMNS:
+                csv_path = os.path.join(metadata_folder, f"{prefix}-consolidated.csv")
+                if os.path.exists(csv_path):
+                    present.add((panelist, prefix))
+                    records += index_csv_file(index, query_id, panelist, prefix, csv_path)
+            images += index_images(index, query_id, panelist)
+
+        # Files removed since the last build, e.g. by --full-rerun
+        for file_id, panelist, prefix in index.execute("SELECT id, panelist, prefix FROM files").fetchall():
+            if (panelist, prefix) not in present:
+                index.execute("DELETE FROM rows WHERE file_id = ?", (file_id,))
+                index.execute("DELETE FROM files WHERE id = ?", (file_id,))
+        index.commit()
+    finally:
+        index.close()
+    logging.info(f"Indexed {records} new records and {images} images of {query_id}.")
+    return records, images
+
+
+def indexed_file(index, query_id, panelist, prefix):
+    """
+    Looks up an indexed file and checks that the index still describes it.
+
+    Returns:
+        tuple: (file id, path of the file), or None if the panelist has no such file.
+    Raises:
+        ValueError: If the file was replaced, rewritten or truncated since it was indexed.
+    """
+    found = index.execute("SELECT id, path, size, inode, fingerprint FROM files WHERE panelist = ? AND prefix = ?",
+                          (panelist, prefix)).fetchone()
+    if found is None:
+        return None
+    file_id, path, size, inode, fingerprint = found
+    csv_path = os.path.join(query_id, path)
+    stat = os.stat(csv_path)
+    rewritten = stat.st_ino != inode or stat.st_size < size
+    if not rewritten:
+        with open(csv_path, "rb") as csv_file:
+            rewritten = file_fingerprint(csv_file, size) != fingerprint
+    if rewritten:
+        raise ValueError(f"{csv_path} changed since it was indexed, rebuild the index with: "
+                         f"python time_index.py build {query_id}")
+    if stat.st_size > size:
+        logging.warning(f"{csv_path} grew since it was indexed, rows appended since are left out.")
+    return file_id, csv_path
+
+
+def query_rows(index, query_id, panelist, prefix, start_ms, end_ms):
+    """
+    Reads the records of one panelist and dataset in a time window, without scanning the file.
+
+    Records are looked up in the index and read with seeks. Records less than READ_GAP_BYTES apart are read as
+    one span, so a window of a file sorted by time, as after --dedup, takes a single read.
+
+    Args:
+        index (sqlite3.Connection): Connection returned by open_time_index.
+        query_id (str): Unique identifier for the query/download session.
+        panelist (str): Name of the panelist folder.
+        prefix (str): Prefix of the dataset, see TIME_COLUMNS.
+        start_ms (float): Start of the window in epoch milliseconds, inclusive.
+        end_ms (float): End of the window in epoch milliseconds, exclusive.
+    Returns:
+        tuple: (raw header bytes, list of raw records sorted by time). Both are empty when the panelist has no
+        such file.
+    """
+    found = indexed_file(index, query_id, panelist, prefix)
+    if found is None:
+        return b"", []
+    file_id, csv_path = found
+    ranges = index.execute("""
+        SELECT offset, length FROM rows WHERE file_id = ? AND time_ms >= ? AND time_ms < ?
+        ORDER BY time_ms, offset""", (file_id, start_ms, end_ms)).fetchall()
+
+    spans = []
+    for offset, length in sorted(ranges):
+        if spans and offset - spans[-1][1] <= READ_GAP_BYTES:
+            spans[-1][1] = max(spans[-1][1], offset + length)
+        else:
+            spans.append([offset, offset + length])
+
+    records = {}
+    with open(csv_path, "rb") as csv_file:
+        header = next(read_records(csv_file), (0, b""))[1]
+        ranges_by_offset = iter(sorted(ranges))
+        for span_start, span_end in spans:
+            csv_file.seek(span_start)
+            block = csv_file.read(span_end - span_start)
+            for offset, length in ranges_by_offset:
+                records[offset] = block[offset - span_start:offset - span_start + length]
+                if offset + length >= span_end:
+                    break
+    return header, [records[offset] for offset, _ in ranges]
+
+
+def query_images(index, panelist, start_ms, end_ms):
+    """
+    Lists the redacted images of a panelist captured in a time window.
+
+    Args:
+        index (sqlite3.Connection): Connection returned by open_time_index.
+        panelist (str): Name of the panelist folder.
+        start_ms (float): Start of the window in epoch milliseconds, inclusive.
+        end_ms (float): End of the window in epoch milliseconds, exclusive.
+    Returns:
+        list: (epoch milliseconds, image path relative to the query folder) per image, sorted by time.
+    """
+    return index.execute("""
+        SELECT time_ms, path FROM images WHERE panelist = ? AND time_ms >= ? AND time_ms < ?
+        ORDER BY time_ms, path""", (panelist, start_ms, end_ms)).fetchall()
+
+
+def parse_time(value):
+    """
+    Parses a window bound given on the command line, as epoch milliseconds or an ISO 8601 time.
+    """
+    time_ms = epoch_ms_list([value])[0]
+    if time_ms is None:
+        raise argparse.ArgumentTypeError(f"not epoch milliseconds or an ISO 8601 time: {value}")
+    return time_ms
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line options of the time index.
+
+    Args:
+        argv: Argument list to parse, defaults to sys.argv.
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Build and query the time index of the consolidated outputs of a "
+                                                 "query.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Index new and changed consolidated CSVs and images.")
+    build.add_argument("query_id", help="Output folder of the query.")
+
+    query = subparsers.add_parser("query", help="Write the rows of a panelist in a time window as CSV.")
+    query.add_argument("query_id", help="Output folder of the query.")
+    query.add_argument("--panelist", required=True, help="Name of the panelist folder.")
+    query.add_argument("--prefix", choices=list(TIME_COLUMNS), default="screenshot_data",
+                       help="Dataset to read (default: screenshot_data).")
+    query.add_argument("--start", type=parse_time, required=True,
+                       help="Start of the window, inclusive, as epoch milliseconds or ISO 8601 (UTC if no offset).")
+    query.add_argument("--end", type=parse_time, required=True,
+                       help="End of the window, exclusive, in the same formats.")
+    query.add_argument("--images", action="store_true",
+                       help="List the panelist's images in the window, as time_ms,path rows, instead of the rows.")
+    query.add_argument("--output", help="File to write to (default: standard output).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "build":
+        build_time_index(args.query_id)
+        return
+
+    if not os.path.exists(time_index_path(args.query_id)):
+        raise SystemExit(f"{args.query_id} has no time index, build it with: python time_index.py build "
+                         f"{args.query_id}")
+    index = open_time_index(args.query_id)
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        if args.images:
+            output.write(b"time_ms,path\n")
+            for time_ms, path in query_images(index, args.panelist, args.start, args.end):
+                output.write(f"{int(time_ms)},{path}\n".encode("utf-8"))
+        else:
+            try:
+                header, records = query_rows(index, args.query_id, args.panelist, args.prefix, args.start, args.end)
+            except ValueError as e:
+                raise SystemExit(str(e))
+            output.write(header)
+            for record in records:
+                output.write(record if record.endswith(b"\n") else record + b"\n")
+    finally:
+        index.close()
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()